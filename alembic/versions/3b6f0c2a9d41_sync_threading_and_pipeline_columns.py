@@ -0,0 +1,141 @@
+"""Sync, threading and pipeline columns on existing tables
+
+Revision ID: 3b6f0c2a9d41
+Revises:
+Create Date: 2026-10-16 23:30:00
+
+New tables are created by Base.metadata.create_all at startup; this adds
+the columns and indexes that create_all cannot add to the emails,
+sent_emails and mailbox_configs tables of an existing database. Tables or
+columns that are already in place, e.g. on a database create_all built, are
+left alone.
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "3b6f0c2a9d41"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def _columns():
+    """{table: columns to add}, new Column objects for every call"""
+    return {
+        "mailbox_configs": [
+            sa.Column("inbox_uid_validity", sa.BigInteger()),
+            sa.Column("inbox_last_uid", sa.BigInteger()),
+            sa.Column("sent_uid_validity", sa.BigInteger()),
+            sa.Column("sent_last_uid", sa.BigInteger()),
+            sa.Column("backfill_state", sa.JSON()),
+        ],
+        "emails": [
+            sa.Column("clean_body", sa.Text()),
+            sa.Column("message_id", sa.String()),
+            sa.Column("in_reply_to", sa.String()),
+            sa.Column("references", sa.JSON()),
+            sa.Column("triage", sa.String()),
+        ],
+        "sent_emails": [
+            sa.Column("mailbox_config_id", sa.Integer()),
+            sa.Column("in_reply_to", sa.String()),
+            sa.Column("references", sa.Text()),
+            sa.Column("subject", sa.String()),
+            sa.Column("last_error", sa.Text()),
+        ],
+    }
+
+
+# (table, name, columns, unique)
+INDEXES = [
+    ("emails", "uq_emails_user_message_id", ["user_id", "message_id"], True),
+    ("emails", "ix_emails_user_thread", ["user_id", "thread_id"], False),
+    ("sent_emails", "uq_sent_emails_user_message_id", ["user_id", "message_id"], True),
+    (
+        "sent_emails",
+        "ix_sent_emails_original_user",
+        ["original_email_id", "user_id"],
+        False,
+    ),
+]
+
+SENT_MAILBOX_FK = "sent_emails_mailbox_config_id_fkey"
+
+
+def _dedupe_message_ids(table: str):
+    """Keep the Message-ID on the oldest copy so the unique index can build"""
+    op.execute(
+        f"UPDATE {table} SET message_id = NULL "
+        f"WHERE id IN (SELECT later.id FROM {table} later JOIN {table} earlier "
+        f"ON earlier.user_id = later.user_id "
+        f"AND earlier.message_id = later.message_id AND earlier.id < later.id)"
+    )
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+
+    for table, columns in _columns().items():
+        if table not in tables:
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table)}
+        for column in columns:
+            if column.name not in existing:
+                op.add_column(table, column)
+
+    if "sent_emails" in tables and SENT_MAILBOX_FK not in {
+        fk["name"] for fk in inspector.get_foreign_keys("sent_emails")
+    }:
+        op.create_foreign_key(
+            SENT_MAILBOX_FK,
+            "sent_emails",
+            "mailbox_configs",
+            ["mailbox_config_id"],
+            ["id"],
+            ondelete="SET NULL",
+        )
+
+    if "emails" in tables:
+        # Received mail used to keep its Message-ID in thread_id
+        op.execute(
+            "UPDATE emails SET message_id = TRIM(thread_id) "
+            "WHERE message_id IS NULL AND thread_id IS NOT NULL AND NOT EXISTS "
+            "(SELECT 1 FROM emails other WHERE other.user_id = emails.user_id "
+            "AND other.message_id = TRIM(emails.thread_id))"
+        )
+        _dedupe_message_ids("emails")
+    if "sent_emails" in tables:
+        op.execute("UPDATE sent_emails SET message_id = TRIM(message_id)")
+        _dedupe_message_ids("sent_emails")
+
+    for table, name, columns, unique in INDEXES:
+        if table not in tables:
+            continue
+        if name not in {index["name"] for index in inspector.get_indexes(table)}:
+            op.create_index(name, table, columns, unique=unique)
+
+
+def downgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+
+    for table, name, _, _ in INDEXES:
+        if table in tables and name in {
+            index["name"] for index in inspector.get_indexes(table)
+        }:
+            op.drop_index(name, table_name=table)
+
+    if "sent_emails" in tables and SENT_MAILBOX_FK in {
+        fk["name"] for fk in inspector.get_foreign_keys("sent_emails")
+    }:
+        op.drop_constraint(SENT_MAILBOX_FK, "sent_emails", type_="foreignkey")
+
+    for table, columns in _columns().items():
+        if table not in tables:
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table)}
+        for column in columns:
+            if column.name in existing:
+                op.drop_column(table, column.name)
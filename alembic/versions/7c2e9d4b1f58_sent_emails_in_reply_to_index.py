@@ -0,0 +1,39 @@
+"""Index sent_emails by In-Reply-To
+
+Revision ID: 7c2e9d4b1f58
+Revises: 3b6f0c2a9d41
+Create Date: 2026-10-16 23:50:00
+
+Storing a received email links the sent replies that were synced before it,
+looked up by (user_id, in_reply_to).
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+revision = "7c2e9d4b1f58"
+down_revision = "3b6f0c2a9d41"
+branch_labels = None
+depends_on = None
+
+INDEX = "ix_sent_emails_user_in_reply_to"
+
+
+def _sent_email_indexes():
+    """Index names on sent_emails, or None before create_all made the table"""
+    inspector = sa.inspect(op.get_bind())
+    if "sent_emails" not in inspector.get_table_names():
+        return None
+    return {index["name"] for index in inspector.get_indexes("sent_emails")}
+
+
+def upgrade() -> None:
+    indexes = _sent_email_indexes()
+    if indexes is not None and INDEX not in indexes:
+        op.create_index(INDEX, "sent_emails", ["user_id", "in_reply_to"])
+
+
+def downgrade() -> None:
+    indexes = _sent_email_indexes()
+    if indexes is not None and INDEX in indexes:
+        op.drop_index(INDEX, table_name="sent_emails")
@@ -0,0 +1,402 @@
+"""
+Historical import of a mailbox.
+
+    python backfill.py MAILBOX_ID [--folder INBOX] [--workers 4] [--categorize skip]
+
+Every UID up to the highest one in the folder when the run first started is
+split into chunks that are fetched over parallel IMAP connections, parsed in
+a process pool and bulk-inserted; newer mail is left to the live sync. Every
+finished chunk is checkpointed on MailboxConfig.backfill_state, so an
+interrupted run resumes where it stopped.
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from typing import Dict
+
+from sqlalchemy.dialects.postgresql import insert
+
+import email_threads
+import imap_client
+import job_queue
+import mime_parser
+from db_sync import SyncSessionLocal
+from email_service import SENT_FOLDER, EmailService
+from imap_pool import PooledSession
+from models import Email, EmailAttachment, MailboxConfig, SentEmail
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", 4))
+BACKFILL_PARSE_WORKERS = int(os.getenv("BACKFILL_PARSE_WORKERS", os.cpu_count() or 1))
+BACKFILL_CHUNK_SIZE = int(os.getenv("BACKFILL_CHUNK_SIZE", 1000))
+# Download budget shared by all connections of one backfill
+BACKFILL_BYTES_PER_SEC = float(os.getenv("BACKFILL_BYTES_PER_SEC", 5 * 1024 * 1024))
+BODY_BATCH_SIZE = int(os.getenv("BACKFILL_BODY_BATCH_SIZE", 100))
+
+# "defer" queues categorize jobs for the pipeline, "skip" leaves emails
+# uncategorized. Backfilled mail is never auto-replied to.
+CATEGORIZE_MODES = ("defer", "skip")
+# Everything outside INBOX is stored as sent mail, so only these are accepted
+FOLDERS = ("INBOX", SENT_FOLDER)
+
+
+def _header_date(email_message):
+    try:
+        return parsedate_to_datetime(email_message.get("Date"))
+    except (TypeError, ValueError):
+        return datetime.utcnow()
+
+
+def _in_ranges(uid, ranges) -> bool:
+    return any(start <= uid <= end for start, end in ranges)
+
+
+class Backfill:
+    def __init__(
+        self,
+        mailbox_id: int,
+        folders=FOLDERS,
+        workers: int = BACKFILL_WORKERS,
+        chunk_size: int = BACKFILL_CHUNK_SIZE,
+        categorize: str = "defer",
+        bytes_per_sec: float = BACKFILL_BYTES_PER_SEC,
+    ):
+        if categorize not in CATEGORIZE_MODES:
+            raise ValueError(f"categorize must be one of {CATEGORIZE_MODES}")
+        unknown = [folder for folder in folders if folder not in FOLDERS]
+        if unknown:
+            raise ValueError(f"Cannot backfill {unknown}, folders must be in {FOLDERS}")
+        self.mailbox_id = mailbox_id
+        self.folders = folders
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.categorize = categorize
+        self.bucket = TokenBucket(bytes_per_sec, bytes_per_sec * 2)
+        self.stop_event = threading.Event()
+        self.parse_executor = None
+        self.service = None
+        self.state: Dict = {}
+        self._local = threading.local()
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
+
+    def run(self):
+        with SyncSessionLocal() as session:
+            mailbox = session.get(MailboxConfig, self.mailbox_id)
+            if mailbox is None:
+                raise ValueError(f"Mailbox {self.mailbox_id} not found")
+            self.service = EmailService(mailbox)
+            self.state = dict(mailbox.backfill_state or {})
+
+        self.save_state(status="running", categorize=self.categorize, error=None)
+        logger.info(f"Backfill of {self.service.username} started")
+        try:
+            with ProcessPoolExecutor(
+                max_workers=BACKFILL_PARSE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            ) as self.parse_executor:
+                failed = 0
+                for folder in self.folders:
+                    failed += self.backfill_folder(folder)
+            if self.stop_event.is_set():
+                status = "stopped"
+            else:
+                status = "failed" if failed else "done"
+            self.save_state(status=status)
+            logger.info(f"Backfill of {self.service.username} finished: {status}")
+        except Exception as e:
+            logger.error(f"Backfill of mailbox {self.mailbox_id} failed: {str(e)}")
+            self.save_state(status="failed", error=str(e))
+            raise
+        finally:
+            self.close_sessions()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def save_state(self, **fields):
+        self.state.update(fields, updated_at=datetime.utcnow().isoformat())
+        with SyncSessionLocal() as session:
+            session.query(MailboxConfig).filter_by(id=self.mailbox_id).update(
+                {MailboxConfig.backfill_state: dict(self.state)}
+            )
+            session.commit()
+
+    def connection(self):
+        """This thread's own IMAP connection, separate from the live monitor's"""
+        pooled = getattr(self._local, "pooled", None)
+        if pooled is None:
+            service = self.service
+            pooled = PooledSession(
+                service.host, service.port, service.username, service.password
+            )
+            self._local.pooled = pooled
+            with self._sessions_lock:
+                self._sessions.append(pooled)
+        return pooled.ensure()
+
+    def close_sessions(self):
+        # Providers cap concurrent IMAP logins, so none are left open idle
+        with self._sessions_lock:
+            for pooled in self._sessions:
+                pooled.discard()
+
+    def backfill_folder(self, folder: str) -> int:
+        """Import every message of ``folder`` up to its ceiling UID"""
+        mail = self.connection()
+        uid_validity = imap_client.select_folder(mail, folder, readonly=True)
+        progress = self.state.get(folder) or {}
+        if progress.get("uid_validity") != uid_validity:
+            # New run, or the server renumbered the folder: start over
+            progress = {
+                "uid_validity": uid_validity,
+                "ceiling": imap_client.highest_uid(mail),
+                "done": [],
+                "total": 0,
+                "imported": 0,
+            }
+        ceiling = progress["ceiling"]
+        uids = []
+        if ceiling:
+            # Servers answer "UID n:*" with the last message even if its UID < n
+            uids = [
+                uid
+                for uid in imap_client.uid_search(mail, f"UID 1:{ceiling}")
+                if uid <= ceiling
+            ]
+        progress["total"] = len(uids)
+        pending = [uid for uid in uids if not _in_ranges(uid, progress["done"])]
+        self.state[folder] = progress
+        self.save_state()
+        if not pending:
+            return 0
+        logger.info(
+            f"Backfilling {len(pending)} of {len(uids)} messages in {folder} "
+            f"for {self.service.username}"
+        )
+
+        failed = 0
+        chunks = list(imap_client.chunked(pending, self.chunk_size))
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="backfill"
+        ) as pool:
+            futures = {
+                pool.submit(self.backfill_chunk, folder, chunk): chunk
+                for chunk in chunks
+            }
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    imported = future.result()
+                except Exception as e:
+                    failed += 1
+                    logger.error(
+                        f"Backfill chunk {chunk[0]}:{chunk[-1]} of {folder} failed: {str(e)}"
+                    )
+                    continue
+                if imported is None:
+                    continue
+                progress["done"].append([chunk[0], chunk[-1]])
+                progress["imported"] += imported
+                self.save_state()
+        self.close_sessions()
+        return failed
+
+    def backfill_chunk(self, folder: str, uids):
+        """Fetch, parse and store one chunk; None if stopped before finishing"""
+        if self.stop_event.is_set():
+            return None
+        mail = self.connection()
+        imap_client.select_folder(mail, folder, readonly=True)
+
+        message_ids, new_uids = self.service.new_message_uids(mail, uids, folder)
+        sizes = imap_client.fetch_sizes(mail, new_uids)
+
+        imported = 0
+        for batch in imap_client.fetch_bodies(
+            mail,
+            new_uids,
+            BODY_BATCH_SIZE,
+            sizes=sizes,
+            max_bytes=mime_parser.MAX_MESSAGE_SIZE,
+            batch_bytes=int(self.bucket.capacity),
+            # The download budget is spent before each FETCH, not after it
+            throttle=lambda size: self.bucket.acquire(size, self.stop_event),
+        ):
+            truncated = [
+                sizes.get(uid, 0) > mime_parser.MAX_MESSAGE_SIZE for uid, _ in batch
+            ]
+            spool = [folder == "INBOX"] * len(batch)
+            parsed = list(
+                self.parse_executor.map(
+                    mime_parser.parse_message,
+                    [raw for _, raw in batch],
+                    spool,
+                    truncated,
+                )
+            )
+            imported += self.store(
+                folder, [(message_ids[uid], p) for (uid, _), p in zip(batch, parsed)]
+            )
+        if self.stop_event.is_set():
+            return None
+        return imported
+
+    def store(self, folder: str, messages) -> int:
+        """Bulk insert parsed messages, skipping ones already stored"""
+        if not messages:
+            return 0
+        service = self.service
+        by_message_id = {}
+        try:
+            with SyncSessionLocal() as session:
+                if folder == "INBOX":
+                    rows = {}
+                    for message_id, parsed in messages:
+                        row = service.inbox_row(parsed, message_id)
+                        row["timestamp"] = _header_date(parsed)
+                        rows[message_id] = row
+                        by_message_id[message_id] = parsed
+                    inserted = session.execute(
+                        insert(Email)
+                        .values(list(rows.values()))
+                        .on_conflict_do_nothing(
+                            index_elements=["user_id", "message_id"]
+                        )
+                        .returning(Email.id, Email.message_id)
+                    ).all()
+                    for email_id, message_id in inserted:
+                        email_threads.link_message(
+                            session,
+                            service.user_id,
+                            email_id,
+                            message_id,
+                            rows[message_id]["in_reply_to"],
+                            rows[message_id]["references"],
+                        )
+                    service.link_sent_replies(
+                        session, originals=[message_id for _, message_id in inserted]
+                    )
+                    attachments = [
+                        attachment
+                        for email_id, message_id in inserted
+                        for attachment in service.attachment_rows(
+                            by_message_id.pop(message_id), email_id
+                        )
+                    ]
+                    if attachments:
+                        session.execute(insert(EmailAttachment), attachments)
+                    if self.categorize == "defer":
+                        for email_id, _ in inserted:
+                            job_queue.enqueue(
+                                session,
+                                job_queue.CATEGORIZE,
+                                service.user_id,
+                                email_id=email_id,
+                                mailbox_config_id=self.mailbox_id,
+                                payload={"auto_reply": False},
+                            )
+                else:
+                    rows = {}
+                    for message_id, parsed in messages:
+                        row = service.sent_row(parsed, message_id)
+                        row["sent_at"] = _header_date(parsed)
+                        rows[message_id] = row
+                    inserted = session.execute(
+                        insert(SentEmail)
+                        .values(list(rows.values()))
+                        .on_conflict_do_nothing(
+                            index_elements=["user_id", "message_id"]
+                        )
+                        .returning(SentEmail.id, SentEmail.message_id)
+                    ).all()
+                    for _, message_id in inserted:
+                        service.link_sent_thread(session, rows[message_id])
+                    service.link_sent_replies(
+                        session, [message_id for message_id, _ in messages]
+                    )
+                session.commit()
+        except Exception:
+            by_message_id = dict(messages)
+            raise
+        finally:
+            # Duplicates, and everything after a failed insert, keep no files
+            for parsed in by_message_id.values():
+                parsed.discard_attachments()
+        return len(inserted)
+
+
+_running: Dict[int, Backfill] = {}
+_running_lock = threading.Lock()
+
+
+def start_background(mailbox_id: int, **options) -> bool:
+    """Run a backfill on a daemon thread; False if one is already running"""
+    with _running_lock:
+        if mailbox_id in _running:
+            return False
+        backfill = Backfill(mailbox_id, **options)
+        _running[mailbox_id] = backfill
+
+    def run():
+        try:
+            backfill.run()
+        except Exception:
+            # Already logged and recorded in backfill_state
+            pass
+        finally:
+            with _running_lock:
+                _running.pop(mailbox_id, None)
+
+    threading.Thread(target=run, name=f"backfill-{mailbox_id}", daemon=True).start()
+    return True
+
+
+def is_running(mailbox_id: int) -> bool:
+    return mailbox_id in _running
+
+
+def stop_all():
+    with _running_lock:
+        backfills = list(_running.values())
+    for backfill in backfills:
+        backfill.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a mailbox's history")
+    parser.add_argument("mailbox_id", type=int)
+    parser.add_argument(
+        "--folder",
+        action="append",
+        dest="folders",
+        choices=FOLDERS,
+        help="Folder to import, repeatable (default: INBOX and Sent)",
+    )
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS)
+    parser.add_argument("--chunk-size", type=int, default=BACKFILL_CHUNK_SIZE)
+    parser.add_argument("--categorize", choices=CATEGORIZE_MODES, default="defer")
+    parser.add_argument("--bytes-per-sec", type=float, default=BACKFILL_BYTES_PER_SEC)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    Backfill(
+        args.mailbox_id,
+        folders=tuple(args.folders or FOLDERS),
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        categorize=args.categorize,
+        bytes_per_sec=args.bytes_per_sec,
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+"""
+Offline benchmark of EmailCategorizer on a labelled corpus.
+
+    python benchmark_categorizer.py [CORPUS] [--llm stub|replay|record] [--mode batch]
+        [--cache local] [--repeat 3] [--knn] [--triage] [--json]
+        [--min-accuracy 0.9] [--max-p95-ms 50] [--max-llm-call-rate 0.5]
+
+CORPUS holds one directory of RFC822 files per category, named like the
+category, and optionally a categories.json of {name: description}. Emails
+are parsed and cleaned as at ingestion and replayed through the categorizer
+against a deterministic keyword stub, or against LLM answers recorded in
+RECORDINGS with --llm record and replayed offline with --llm replay. The
+report gives p50/p95 latency, estimated LLM tokens per email, LLM calls per
+email and accuracy; any --min/--max threshold that is missed exits with 1,
+so CI can gate changes to categorization. --knn needs the sentence encoder
+available locally.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+from email.header import decode_header, make_header
+from types import SimpleNamespace
+from typing import Dict, List
+
+import mime_parser
+import text_preprocess
+import triage
+from categorizer import EmailCategorizer
+from config_cache import CategorySet
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(__file__), "benchmarks", "corpus")
+DEFAULT_RECORDINGS = os.path.join(
+    os.path.dirname(__file__), "benchmarks", "recordings.json"
+)
+BENCHMARK_USER_ID = 1
+# Label the stub answers with when no keyword matches
+STUB_FALLBACK = "Others"
+
+_WORD_RE = re.compile(r"[a-z]{4,}")
+_EMAIL_SECTION_RE = re.compile(r"^Email \d+:$", re.MULTILINE)
+_STOPWORDS = {
+    "about",
+    "also",
+    "anything",
+    "else",
+    "emails",
+    "from",
+    "into",
+    "other",
+    "that",
+    "their",
+    "there",
+    "this",
+    "with",
+}
+
+
+def _words(text: str) -> set:
+    """Lowercase words of four letters or more, singular"""
+    words = set(_WORD_RE.findall((text or "").lower())) - _STOPWORDS
+    return {word[:-1] if word.endswith("s") else word for word in words}
+
+
+def _decoded(value) -> str:
+    if value is None:
+        return ""
+    try:
+        return str(make_header(decode_header(str(value))))
+    except Exception:
+        return str(value)
+
+
+def load_corpus(root: str):
+    """(CategorySet, [email dict with the expected label]) from ``root``"""
+    descriptions = {}
+    path = os.path.join(root, "categories.json")
+    if os.path.exists(path):
+        with open(path) as f:
+            descriptions = json.load(f)
+    names = sorted(
+        name for name in os.listdir(root) if os.path.isdir(os.path.join(root, name))
+    )
+    categories = CategorySet(
+        SimpleNamespace(id=i, name=name, description=descriptions.get(name))
+        for i, name in enumerate(names, 1)
+    )
+
+    emails = []
+    for name in names:
+        directory = os.path.join(root, name)
+        for filename in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, filename), "rb") as f:
+                parsed = mime_parser.parse_message(f.read(), spool_attachments=False)
+            emails.append(
+                {
+                    "email_id": len(emails) + 1,
+                    "file": os.path.join(name, filename),
+                    "sender": _decoded(parsed.get("From")),
+                    "subject": _decoded(parsed.get("Subject")),
+                    "body": text_preprocess.clean_body(parsed.body),
+                    "triage": triage.classify(parsed),
+                    "expected": categories.by_name[name],
+                }
+            )
+    return categories, emails
+
+
+class StubLLM:
+    """
+    Deterministic stand-in for the chat model: each email in the prompt gets
+    the category whose name and description share the most words with it
+    """
+
+    def __init__(self, categories, latency: float = 0.0):
+        self.keywords = {
+            category.name: _words(f"{category.name} {category.description or ''}")
+            for category in categories
+        }
+        self.fallback = (
+            STUB_FALLBACK if STUB_FALLBACK in self.keywords else categories[0].name
+        )
+        self.latency = latency
+
+    def _label(self, text: str) -> str:
+        words = _words(text)
+        scores = {name: len(words & keys) for name, keys in self.keywords.items()}
+        best = max(scores, key=scores.get)
+        return best if scores[best] else self.fallback
+
+    def invoke(self, messages):
+        if self.latency:
+            time.sleep(self.latency)
+        prompt = messages[-1].content
+        sections = _EMAIL_SECTION_RE.split(prompt)[1:]
+        if sections:
+            content = json.dumps([self._label(section) for section in sections])
+        else:
+            content = self._label(prompt.partition("Email:")[2])
+        return SimpleNamespace(content=content)
+
+
+class RecordedLLM:
+    """
+    Answers from RECORDINGS keyed by a hash of the prompt. With ``backend``
+    unknown prompts are sent there and recorded; without, they fail.
+    """
+
+    def __init__(self, path: str, backend=None):
+        self.path = path
+        self.backend = backend
+        self.responses: Dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.responses = json.load(f)
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(messages) -> str:
+        digest = hashlib.sha256()
+        for message in messages:
+            digest.update(message.content.encode("utf-8", "surrogatepass"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def invoke(self, messages):
+        key = self.key(messages)
+        with self._lock:
+            content = self.responses.get(key)
+        if content is None:
+            if self.backend is None:
+                with self._lock:
+                    self.misses += 1
+                raise KeyError(f"No recorded response for prompt {key[:12]}")
+            content = self.backend.invoke(messages).content
+            with self._lock:
+                self.responses[key] = content
+        return SimpleNamespace(content=content)
+
+    def save(self):
+        with open(self.path, "w") as f:
+            json.dump(self.responses, f, indent=1, sort_keys=True)
+
+
+class MeteredLLM:
+    """Counts calls and estimated prompt and completion tokens of ``llm``"""
+
+    def __init__(self, llm):
+        self.llm = llm
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def invoke(self, messages):
+        prompt_tokens = sum(
+            text_preprocess.estimate_tokens(message.content) for message in messages
+        )
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+        try:
+            response = self.llm.invoke(messages)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        with self._lock:
+            self.completion_tokens += text_preprocess.estimate_tokens(response.content)
+        return response
+
+
+def _percentile(values: List[float], q: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def run(
+    categorizer: EmailCategorizer,
+    categories,
+    emails: List[dict],
+    mode: str = "single",
+    batch_size: int = 20,
+    use_triage: bool = False,
+):
+    """[(email, predicted category id, seconds)] for one pass over ``emails``"""
+    results = []
+    if use_triage:
+        for email in emails:
+            if email["triage"] is not None:
+                # Filed like the pipeline does, without categorizing
+                start = time.perf_counter()
+                category_id = triage.hinted_category(email["triage"], categories)
+                results.append((email, category_id, time.perf_counter() - start))
+        emails = [email for email in emails if email["triage"] is None]
+
+    if mode == "single":
+        for email in emails:
+            start = time.perf_counter()
+            try:
+                category_id = categorizer.categorize_email(
+                    email["subject"],
+                    email["body"],
+                    email["sender"],
+                    BENCHMARK_USER_ID,
+                    categories,
+                    email_id=email["email_id"],
+                )
+            except Exception as e:
+                # The pipeline would retry; here it counts as a miss
+                logger.warning(f"Categorizing {email['file']} failed: {str(e)}")
+                category_id = None
+            results.append((email, category_id, time.perf_counter() - start))
+        return results
+
+    for start_index in range(0, len(emails), batch_size):
+        chunk = emails[start_index : start_index + batch_size]
+        start = time.perf_counter()
+        try:
+            labels = categorizer.categorize_batch(chunk, BENCHMARK_USER_ID, categories)
+        except Exception as e:
+            logger.warning(f"Categorizing a batch failed: {str(e)}")
+            labels = [None] * len(chunk)
+        # Every email of a batch waits for the whole batch
+        elapsed = time.perf_counter() - start
+        results.extend((email, label, elapsed) for email, label in zip(chunk, labels))
+    return results
+
+
+def report(results, categories, llm: MeteredLLM, wall_time: float) -> dict:
+    names = {category.id: category.name for category in categories}
+    latencies = [seconds * 1000 for _, _, seconds in results]
+    count = len(results) or 1
+    per_label: Dict[str, Dict[str, int]] = {}
+    correct = 0
+    for email, predicted, _ in results:
+        stats = per_label.setdefault(names[email["expected"]], {"total": 0, "hits": 0})
+        stats["total"] += 1
+        if predicted == email["expected"]:
+            stats["hits"] += 1
+            correct += 1
+    return {
+        "emails": len(results),
+        "accuracy": correct / count,
+        "accuracy_by_label": {
+            name: stats["hits"] / stats["total"]
+            for name, stats in sorted(per_label.items())
+        },
+        "latency_p50_ms": _percentile(latencies, 50),
+        "latency_p95_ms": _percentile(latencies, 95),
+        "emails_per_sec": len(results) / wall_time if wall_time else 0.0,
+        "llm_calls": llm.calls,
+        "llm_call_rate": llm.calls / count,
+        "llm_errors": llm.errors,
+        "prompt_tokens_per_email": llm.prompt_tokens / count,
+        "completion_tokens_per_email": llm.completion_tokens / count,
+        "tokens_per_email": (llm.prompt_tokens + llm.completion_tokens) / count,
+    }
+
+
+def failed_gates(metrics: dict, args) -> List[str]:
+    failures = []
+    for limit, metric, too_low in (
+        (args.min_accuracy, "accuracy", True),
+        (args.max_p95_ms, "latency_p95_ms", False),
+        (args.max_llm_call_rate, "llm_call_rate", False),
+        (args.max_tokens_per_email, "tokens_per_email", False),
+    ):
+        if limit is None:
+            continue
+        value = metrics[metric]
+        if (value < limit) if too_low else (value > limit):
+            failures.append(f"{metric} {value:.3f} beyond limit {limit}")
+    return failures
+
+
+def build_llm(args, categories):
+    if args.llm == "stub":
+        return StubLLM(categories, latency=args.stub_latency_ms / 1000)
+    backend = None
+    if args.llm == "record":
+        from llm_client import get_llm
+
+        # Same model settings as EmailCategorizer's default client
+        backend = get_llm(
+            temperature=0.1,
+            max_tokens=10000,
+            frequency_penalty=0,
+            presence_penalty=0,
+            stop=None,
+        )
+    return RecordedLLM(args.recordings, backend)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the email categorizer")
+    parser.add_argument("corpus", nargs="?", default=DEFAULT_CORPUS)
+    parser.add_argument("--llm", choices=("stub", "replay", "record"), default="stub")
+    parser.add_argument("--recordings", default=DEFAULT_RECORDINGS)
+    parser.add_argument("--stub-latency-ms", type=float, default=0.0)
+    parser.add_argument("--mode", choices=("single", "batch"), default="single")
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="Passes over the corpus; later passes show the cache warm",
+    )
+    parser.add_argument("--cache", choices=("off", "local"), default="off")
+    parser.add_argument(
+        "--knn", action="store_true", help="Use an in-memory kNN fast path"
+    )
+    parser.add_argument(
+        "--triage", action="store_true", help="File automated mail by headers first"
+    )
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--min-accuracy", type=float)
+    parser.add_argument("--max-p95-ms", type=float)
+    parser.add_argument("--max-llm-call-rate", type=float)
+    parser.add_argument("--max-tokens-per-email", type=float)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    categories, emails = load_corpus(args.corpus)
+    if not emails:
+        parser.error(f"No emails found in {args.corpus}")
+
+    backend = build_llm(args, categories)
+    llm = MeteredLLM(backend)
+    knn = False
+    if args.knn:
+        from knn_categorizer import KNNCategorizer
+
+        knn = KNNCategorizer(persist=False)
+    categorizer = EmailCategorizer(llm=llm, cache=args.cache, knn=knn)
+
+    results = []
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        results.extend(
+            run(
+                categorizer,
+                categories,
+                emails,
+                mode=args.mode,
+                batch_size=args.batch_size,
+                use_triage=args.triage,
+            )
+        )
+    metrics = report(results, categories, llm, time.perf_counter() - start)
+    if isinstance(backend, RecordedLLM):
+        metrics["unrecorded_prompts"] = backend.misses
+        if args.llm == "record":
+            backend.save()
+
+    if args.json:
+        print(json.dumps(metrics, indent=2, sort_keys=True))
+    else:
+        for name, value in metrics.items():
+            if isinstance(value, dict):
+                for label, share in value.items():
+                    print(f"{name}[{label}]: {share:.3f}")
+            elif isinstance(value, float):
+                print(f"{name}: {value:.3f}")
+            else:
+                print(f"{name}: {value}")
+
+    failures = failed_gates(metrics, args)
+    if metrics.get("unrecorded_prompts") and args.llm == "replay":
+        # The prompts changed since recording; the numbers are not comparable
+        failures.append(f"{metrics['unrecorded_prompts']} prompts were not recorded")
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Cache of categorization results for repeated and templated mail. Keys hash
+the user, a version of their category set and the normalized sender, subject
+and body, so editing a category changes every key of that user. Lookups go
+to a per-process LRU first and then to a Postgres table shared by workers.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Dict, Iterable
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from db_sync import SyncSessionLocal
+from models import CategorizationCacheEntry
+
+logger = logging.getLogger(__name__)
+
+CATEGORIZATION_CACHE_SIZE = int(os.getenv("CATEGORIZATION_CACHE_SIZE", 10000))
+# Shared entries older than this are ignored
+CATEGORIZATION_CACHE_TTL_DAYS = int(os.getenv("CATEGORIZATION_CACHE_TTL_DAYS", 30))
+
+_URL_RE = re.compile(r"https?://\S+")
+_NUMBER_RE = re.compile(r"\d+")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    """Drop what varies between copies of a template: links, numbers, spacing"""
+    text = _URL_RE.sub("<url>", (text or "").lower())
+    text = _NUMBER_RE.sub("#", text)
+    return _SPACE_RE.sub(" ", text).strip()
+
+
+def category_version(categories) -> str:
+    """Changes whenever a category is added, removed, renamed or redescribed"""
+    digest = hashlib.sha256()
+    for category in sorted(categories, key=lambda c: c.id):
+        digest.update(
+            f"{category.id}\0{category.name}\0{category.description}\0".encode()
+        )
+    return digest.hexdigest()[:16]
+
+
+def cache_key(user_id: int, version: str, sender: str, subject: str, body: str) -> str:
+    """``version`` is the category_version of the user's categories"""
+    digest = hashlib.sha256()
+    for part in (
+        str(user_id),
+        version,
+        (sender or "").strip().lower(),
+        normalize(subject),
+        normalize(body),
+    ):
+        digest.update(part.encode("utf-8", "surrogatepass"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class LRUCache:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: tuple):
+        with self._lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def drop_user(self, user_id: int):
+        with self._lock:
+            for key in [k for k, (uid, _) in self.entries.items() if uid == user_id]:
+                del self.entries[key]
+
+
+_local = LRUCache(CATEGORIZATION_CACHE_SIZE)
+
+
+def lookup(user_id: int, keys: Iterable[str], shared: bool = True) -> Dict[str, int]:
+    """
+    {key: category_id} for the keys with a cached result; only this
+    process's entries unless ``shared``
+    """
+    found = {}
+    missing = []
+    for key in set(keys):
+        entry = _local.get(key)
+        if entry is not None:
+            found[key] = entry[1]
+        else:
+            missing.append(key)
+    if not missing or not shared:
+        return found
+    try:
+        with SyncSessionLocal() as session:
+            rows = session.execute(
+                select(
+                    CategorizationCacheEntry.key, CategorizationCacheEntry.category_id
+                ).where(
+                    CategorizationCacheEntry.key.in_(missing),
+                    CategorizationCacheEntry.created_at
+                    > func.now() - timedelta(days=CATEGORIZATION_CACHE_TTL_DAYS),
+                )
+            ).all()
+    except Exception as e:
+        logger.warning(f"Categorization cache lookup failed: {str(e)}")
+        return found
+    for key, category_id in rows:
+        _local.put(key, (user_id, category_id))
+        found[key] = category_id
+    return found
+
+
+def store(user_id: int, entries: Dict[str, int], shared: bool = True):
+    entries = {k: v for k, v in entries.items() if v is not None}
+    if not entries:
+        return
+    for key, category_id in entries.items():
+        _local.put(key, (user_id, category_id))
+    if not shared:
+        return
+    try:
+        with SyncSessionLocal() as session:
+            stmt = insert(CategorizationCacheEntry).values(
+                [
+                    {"key": key, "user_id": user_id, "category_id": category_id}
+                    for key, category_id in entries.items()
+                ]
+            )
+            session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=["key"],
+                    set_={
+                        "category_id": stmt.excluded.category_id,
+                        "created_at": func.now(),
+                    },
+                )
+            )
+            session.commit()
+    except Exception as e:
+        logger.warning(f"Categorization cache store failed: {str(e)}")
+
+
+def forget_user(user_id: int):
+    """
+    Drop a user's entries from this process. Other processes never hit them
+    again either, as their keys carry the old category version.
+    """
+    _local.drop_user(user_id)
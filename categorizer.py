@@ -1,25 +1,44 @@
-from langchain_groq import ChatGroq
 from langchain.schema import HumanMessage, SystemMessage
+from typing import Dict, List, Optional
+import json
 import os
 import logging
 
-from models import Category
-from db_sync import SyncSessionLocal
+from llm_client import get_llm
+import categorization_cache
+from knn_categorizer import KNN_ENABLED, embed, knn_categorizer
 
 logger = logging.getLogger(__name__)
 
+# Emails per LLM request in categorize_batch
+CATEGORIZE_BATCH_SIZE = int(os.getenv("CATEGORIZE_BATCH_SIZE", 20))
+# Body characters per email in a batch; the single request keeps 2000
+BATCH_BODY_CHARS = int(os.getenv("CATEGORIZE_BATCH_BODY_CHARS", 1000))
+# "shared" uses both cache tiers, "local" only this process's LRU
+CACHE_MODES = ("shared", "local", "off")
+
 
 class EmailCategorizer:
-    def __init__(self):
-        self.llm = ChatGroq(
-            model="llama-3.3-70b-versatile",
-            api_key="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",
+    def __init__(self, llm=None, cache: str = "shared", knn=None):
+        """
+        ``llm`` is anything with ``invoke(messages)``, by default the shared
+        Groq client. ``cache`` is one of CACHE_MODES. ``knn`` is the kNN
+        index to use, False for none; by default the shared one unless
+        KNN_CATEGORIZER is off.
+        """
+        if cache not in CACHE_MODES:
+            raise ValueError(f"cache must be one of {CACHE_MODES}")
+        self.llm = llm or get_llm(
             temperature=0.1,
             max_tokens=10000,
             frequency_penalty=0,
             presence_penalty=0,
             stop=None,
         )
+        self.cache = cache
+        if knn is None:
+            knn = knn_categorizer if KNN_ENABLED else False
+        self.knn = knn or None
 
         self.system_prompt = """
         You are an email classification system. Your task is to categorize emails into exactly one of these three categories:
@@ -36,8 +55,191 @@ class EmailCategorizer:
         - Base your decision on the email subject and content
         - If uncertain, choose "Others"
         """
+        # Category version -> system prompt with that category list
+        self._prompts: Dict[str, str] = {}
+
+    def _system_prompt(self, categories) -> str:
+        """The system prompt listing ``categories``, built once per version"""
+        prompt = self._prompts.get(categories.version)
+        if prompt is None:
+            prompt = f"{self.system_prompt}\n\nAvailable categories: {categories.names}"
+            self._prompts[categories.version] = prompt
+        return prompt
+
+    def _cached(self, user_id: int, keys: List[str]) -> Dict[str, int]:
+        if self.cache == "off":
+            return {}
+        return categorization_cache.lookup(user_id, keys, shared=self.cache == "shared")
+
+    def _store(self, user_id: int, entries: Dict[str, int]):
+        if self.cache != "off":
+            categorization_cache.store(user_id, entries, shared=self.cache == "shared")
+
+    def _fast_path(self, subject: str, body: str, user_id: int, categories):
+        """(category id or None, embedding or None) from the local kNN"""
+        if self.knn is None or not categories:
+            return None, None
+        try:
+            vector = embed(subject, body)
+            return self.knn.predict(user_id, vector, categories), vector
+        except Exception as e:
+            logger.error(f"kNN categorization failed, using the LLM: {str(e)}")
+            return None, None
+
+    def _remember(self, user_id: int, email_id, category_id, vector):
+        if category_id is None or vector is None or email_id is None:
+            return
+        try:
+            self.knn.remember(user_id, email_id, category_id, vector)
+        except Exception as e:
+            logger.warning(f"Could not store kNN example {email_id}: {str(e)}")
 
     def categorize_email(
+        self,
+        subject: str,
+        body: str,
+        sender: str,
+        user_id: int,
+        categories,
+        email_id: int = None,
+    ) -> int:
+        """
+        Categorize an email and return the category ID. Repeated content is
+        answered from the categorization cache and clear cases by the local
+        kNN fast path; only ambiguous mail reaches the LLM, and its answers
+        for ``email_id`` become new kNN examples.
+        """
+        if not categories:
+            logger.warning(f"No categories found for user {user_id}")
+            return None
+        key = categorization_cache.cache_key(
+            user_id, categories.version, sender, subject, body
+        )
+        category_id = self._cached(user_id, [key]).get(key)
+        if category_id is not None:
+            logger.info(f"Email categorized from cache (ID: {category_id})")
+            return category_id
+
+        category_id, vector = self._fast_path(subject, body, user_id, categories)
+        if category_id is not None:
+            logger.info(f"Email categorized locally (ID: {category_id})")
+        else:
+            category_id = self.categorize_with_llm(
+                subject, body, sender, user_id, categories
+            )
+            self._remember(user_id, email_id, category_id, vector)
+        self._store(user_id, {key: category_id})
+        return category_id
+
+    def categorize_batch(
+        self, emails: List[dict], user_id: int, categories
+    ) -> List[Optional[int]]:
+        """
+        Categorize many emails of one user, each a dict with subject, body,
+        sender and email_id. Cached and identical emails are answered once;
+        mail the kNN cannot decide is sent to the LLM CATEGORIZE_BATCH_SIZE
+        at a time in one request, and emails whose label cannot be parsed
+        from the answer are retried one by one. A failed request raises, so
+        the caller retries later instead of sending every email on its own.
+        """
+        results: List[Optional[int]] = [None] * len(emails)
+        if not categories:
+            logger.warning(f"No categories found for user {user_id}")
+            return results
+
+        keys = [
+            categorization_cache.cache_key(
+                user_id,
+                categories.version,
+                email["sender"],
+                email["subject"],
+                email["body"],
+            )
+            for email in emails
+        ]
+        cached = self._cached(user_id, keys)
+        # First email of each uncached key; copies take its result at the end
+        firsts: Dict[str, int] = {}
+        for i, key in enumerate(keys):
+            if key in cached:
+                results[i] = cached[key]
+            else:
+                firsts.setdefault(key, i)
+
+        vectors = [None] * len(emails)
+        pending = []
+        for i in firsts.values():
+            email = emails[i]
+            results[i], vectors[i] = self._fast_path(
+                email["subject"], email["body"], user_id, categories
+            )
+            if results[i] is None:
+                pending.append(i)
+        logger.info(
+            f"Categorized {len(emails) - len(pending)} of {len(emails)} emails "
+            f"from cache or locally"
+        )
+
+        try:
+            for start in range(0, len(pending), CATEGORIZE_BATCH_SIZE):
+                chunk = pending[start : start + CATEGORIZE_BATCH_SIZE]
+                labels = self._categorize_chunk([emails[i] for i in chunk], categories)
+                for i, category_id in zip(chunk, labels):
+                    email = emails[i]
+                    if category_id is None:
+                        category_id = self.categorize_with_llm(
+                            email["subject"],
+                            email["body"],
+                            email["sender"],
+                            user_id,
+                            categories,
+                        )
+                    results[i] = category_id
+                    self._remember(
+                        user_id, email.get("email_id"), category_id, vectors[i]
+                    )
+        finally:
+            # Labels of earlier chunks survive a failed request
+            self._store(user_id, {key: results[i] for key, i in firsts.items()})
+        for i, key in enumerate(keys):
+            if results[i] is None and key in firsts:
+                results[i] = results[firsts[key]]
+        return results
+
+    def _categorize_chunk(self, emails: List[dict], categories) -> List[Optional[int]]:
+        """
+        One LLM request for ``emails``; None where no valid label came back.
+        Errors of the request itself propagate.
+        """
+        names = categories.names
+        numbered = "\n\n".join(
+            f"Email {n}:\nFrom: {email['sender']}\nSubject: {email['subject']}\n"
+            f"Body:\n{(email['body'] or '')[:BATCH_BODY_CHARS]}"
+            for n, email in enumerate(emails, 1)
+        )
+        messages = [
+            SystemMessage(content=self._system_prompt(categories)),
+            HumanMessage(
+                content=(
+                    f"Categorize each of the following {len(emails)} emails into one "
+                    f"of these categories: {names}\n\n"
+                    f"Respond with ONLY a JSON array of {len(emails)} category names, "
+                    f"one per email, in the order given.\n\n{numbered}"
+                )
+            ),
+        ]
+        content = self.llm.invoke(messages).content.strip()
+        try:
+            # Tolerate a fenced or prefixed answer around the array
+            labels = json.loads(content[content.index("[") : content.rindex("]") + 1])
+            if not isinstance(labels, list) or len(labels) != len(emails):
+                raise ValueError(f"expected {len(emails)} labels, got {content!r}")
+        except Exception as e:
+            logger.warning(f"Unparseable batch answer, falling back: {str(e)}")
+            return [None] * len(emails)
+        return [categories.by_name.get(str(label).strip()) for label in labels]
+
+    def categorize_with_llm(
         self, subject: str, body: str, sender: str, user_id: int, categories
     ) -> int:
         """
@@ -47,63 +249,42 @@ class EmailCategorizer:
             subject: Email subject line
             body: Email body content
             sender: Email sender address
-            user_id: User ID to fetch categories for
+            user_id: User ID the categories belong to
+            categories: The user's config_cache.CategorySet
 
         Returns:
-            Category ID (int): ID of the matching category, or default category ID if not found
+            Category ID (int) of the matching category, or None if the model
+            answered with an unknown label. Request errors propagate so the
+            job queue can retry them.
         """
-        try:
-            with SyncSessionLocal() as session:
-                # Fetch user's categories from database
-                # user_categories = (
-                #     session.query(Category).filter(Category.user_id == user_id).all()
-                # )
-
-                if not categories:
-                    logger.warning(f"No categories found for user {user_id}")
-                    return None  # or create a default category
-
-                # Create a mapping of category names to IDs
-                category_map = {cat.name: cat.id for cat in categories}
-                valid_category_names = list(category_map.keys())
-
-                # Prepare the email content for classification
-                email_content = f"""
-                From: {sender}
-                Subject: {subject}
-                
-                Body:
-                {body[:2000]}  # Limit body to first 2000 characters
-                """
-
-                # Update system prompt to include available categories
-                dynamic_prompt = f"{self.system_prompt}\n\nAvailable categories: {', '.join(valid_category_names)}"
-
-                messages = [
-                    SystemMessage(content=dynamic_prompt),
-                    HumanMessage(
-                        content=f"Please categorize this email into one of these categories: {', '.join(valid_category_names)}\n\nEmail:\n{email_content}"
-                    ),
-                ]
-
-                response = self.llm.invoke(messages)
-                category_name = response.content.strip()
-
-                # Validate the response and return category ID
-                if category_name in category_map:
-                    category_id = category_map[category_name]
-                    logger.info(
-                        f"Email categorized as: {category_name} (ID: {category_id})"
-                    )
-                    return category_id
-                else:
-                    logger.warning(f"Invalid category returned: {category_name}")
-                    # Return the first available category as default, or handle as needed
-                    default_category_id = list(category_map.values())[0]
-                    logger.info(f"Defaulting to category ID: {default_category_id}")
-                    return None
+        if not categories:
+            logger.warning(f"No categories found for user {user_id}")
+            return None  # or create a default category
 
-        except Exception as e:
-            logger.error(f"Error categorizing email: {str(e)}")
-            # Return a default category ID or None based on your requirements
+        # Prepare the email content for classification
+        email_content = f"""
+        From: {sender}
+        Subject: {subject}
+        
+        Body:
+        {body[:2000]}  # Limit body to first 2000 characters
+        """
+
+        messages = [
+            SystemMessage(content=self._system_prompt(categories)),
+            HumanMessage(
+                content=f"Please categorize this email into one of these categories: {categories.names}\n\nEmail:\n{email_content}"
+            ),
+        ]
+
+        response = self.llm.invoke(messages)
+        category_name = response.content.strip()
+
+        # Validate the response and return category ID
+        if category_name in categories.by_name:
+            category_id = categories.by_name[category_name]
+            logger.info(f"Email categorized as: {category_name} (ID: {category_id})")
+            return category_id
+        else:
+            logger.warning(f"Invalid category returned: {category_name}")
             return None
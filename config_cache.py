@@ -0,0 +1,192 @@
+"""
+In-process cache of each user's configuration as the pipeline reads it:
+categories with their prompt fragments and mailbox settings. Mutations
+publish the user id on the ``user_config`` channel with pg_notify in their
+own transaction; every process LISTENs and drops its copy once the change
+commits. Entries also expire after CONFIG_CACHE_TTL in case a notification
+was missed.
+"""
+
+import logging
+import os
+import select as io_select
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from sqlalchemy import select, text
+
+import categorization_cache
+from db_sync import SyncSessionLocal, engine
+from models import Category, MailboxConfig
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "user_config"
+CONFIG_CACHE_TTL = float(os.getenv("CONFIG_CACHE_TTL", 300))
+LISTEN_RECONNECT_DELAY = 5
+
+
+@dataclass(frozen=True)
+class CategoryInfo:
+    id: int
+    name: str
+    description: Optional[str]
+
+
+class CategorySet(tuple):
+    """A user's categories with the lookups and prompt text derived from them"""
+
+    def __new__(cls, categories):
+        self = super().__new__(
+            cls, (CategoryInfo(c.id, c.name, c.description) for c in categories)
+        )
+        self.by_name = {category.name: category.id for category in self}
+        # "A, B, C" as the categorization prompts list them
+        self.names = ", ".join(self.by_name)
+        self.version = categorization_cache.category_version(self)
+        return self
+
+
+@dataclass(frozen=True)
+class MailboxInfo:
+    id: int
+    email: str
+    auto_reply_enabled: bool
+    confidence_threshold: float
+
+
+@dataclass(frozen=True)
+class UserConfig:
+    user_id: int
+    categories: CategorySet
+    mailboxes: Dict[int, MailboxInfo]
+    loaded_at: float
+
+
+_configs: Dict[int, UserConfig] = {}
+# Bumped by every invalidation, so a load that overlapped one is not cached
+_generations: Dict[int, int] = {}
+_epoch = 0
+_lock = threading.Lock()
+
+
+def _load(user_id: int) -> UserConfig:
+    with SyncSessionLocal() as session:
+        categories = session.scalars(
+            select(Category).where(Category.user_id == user_id).order_by(Category.id)
+        ).all()
+        mailboxes = session.scalars(
+            select(MailboxConfig).where(MailboxConfig.user_id == user_id)
+        ).all()
+        return UserConfig(
+            user_id=user_id,
+            categories=CategorySet(categories),
+            mailboxes={
+                mailbox.id: MailboxInfo(
+                    id=mailbox.id,
+                    email=mailbox.email,
+                    auto_reply_enabled=bool(mailbox.auto_reply_enabled),
+                    confidence_threshold=mailbox.confidence_threshold,
+                )
+                for mailbox in mailboxes
+            },
+            loaded_at=time.monotonic(),
+        )
+
+
+def get(user_id: int) -> UserConfig:
+    """The user's configuration, from memory unless changed or expired"""
+    with _lock:
+        config = _configs.get(user_id)
+        generation = (_epoch, _generations.get(user_id, 0))
+    if config is not None and time.monotonic() - config.loaded_at < CONFIG_CACHE_TTL:
+        return config
+    config = _load(user_id)
+    with _lock:
+        # A change notified while loading may not be in what was read
+        if generation == (_epoch, _generations.get(user_id, 0)):
+            _configs[user_id] = config
+    return config
+
+
+def invalidate(user_id: int = None):
+    """Drop one user's configuration, or everyone's"""
+    global _epoch
+    with _lock:
+        if user_id is None:
+            _configs.clear()
+            _epoch += 1
+        else:
+            _configs.pop(user_id, None)
+            _generations[user_id] = _generations.get(user_id, 0) + 1
+
+
+async def notify_changed(db, user_id: int):
+    """
+    Queue the invalidation of ``user_id`` in the caller's transaction;
+    Postgres delivers it to every listening process on commit
+    """
+    await db.execute(
+        text("SELECT pg_notify(:channel, :user_id)"),
+        {"channel": CHANNEL, "user_id": str(user_id)},
+    )
+
+
+class ConfigListener:
+    """Thread holding a LISTEN connection and applying invalidations"""
+
+    def __init__(self):
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.run, name="config-listener", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self, timeout: float = 5):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=timeout)
+            self.thread = None
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.listen()
+            except Exception as e:
+                logger.error(f"Config listener failed, reconnecting: {str(e)}")
+            # Changes made while not listening went unseen
+            invalidate()
+            self.stop_event.wait(LISTEN_RECONNECT_DELAY)
+
+    def listen(self):
+        fairy = engine.raw_connection()
+        # A long-lived LISTEN session does not belong in the pool
+        fairy.detach()
+        conn = fairy.dbapi_connection
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL}")
+            logger.info(f"Listening for configuration changes on {CHANNEL}")
+            while not self.stop_event.is_set():
+                if io_select.select([conn], [], [], 1.0)[0]:
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            invalidate(int(notify.payload))
+                        except ValueError:
+                            invalidate()
+        finally:
+            conn.close()
+
+
+listener = ConfigListener()
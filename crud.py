@@ -1,9 +1,11 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, delete, update, and_
+from sqlalchemy import select, delete, update, and_, func
 from sqlalchemy.orm import selectinload
 from typing import Optional, List
 import models
 import schemas
+import categorization_cache
+import config_cache
 from passlib.context import CryptContext
 import uuid
 
@@ -48,6 +50,7 @@ async def create_category(
     db_category = models.Category(user_id=user_id, **category.model_dump())
     db.add(db_category)
     await db.flush()
+    await invalidate_categorization_cache(db, user_id)
     return db_category
 
 
@@ -82,6 +85,7 @@ async def update_category(
         )
         .values(**category_update.model_dump(exclude_unset=True))
     )
+    await invalidate_categorization_cache(db, user_id)
     return await get_category(db, category_id, user_id)
 
 
@@ -91,9 +95,25 @@ async def delete_category(db: AsyncSession, category_id: int, user_id: int) -> b
             and_(models.Category.id == category_id, models.Category.user_id == user_id)
         )
     )
+    if result.rowcount:
+        await invalidate_categorization_cache(db, user_id)
     return result.rowcount > 0
 
 
+async def invalidate_categorization_cache(db: AsyncSession, user_id: int):
+    """
+    Cached categorizations and configuration of a user are stale once their
+    categories change
+    """
+    await db.execute(
+        delete(models.CategorizationCacheEntry).where(
+            models.CategorizationCacheEntry.user_id == user_id
+        )
+    )
+    categorization_cache.forget_user(user_id)
+    await config_cache.notify_changed(db, user_id)
+
+
 # Document CRUD
 async def create_document(
     db: AsyncSession, name: str, doc_type: str, size: int, user_id: int
@@ -159,6 +179,36 @@ async def get_email(
     return result.scalar_one_or_none()
 
 
+async def get_thread_emails(
+    db: AsyncSession, thread_id: str, user_id: int
+) -> List[models.Email]:
+    result = await db.execute(
+        select(models.Email)
+        .where(
+            and_(models.Email.user_id == user_id, models.Email.thread_id == thread_id)
+        )
+        .order_by(models.Email.timestamp)
+    )
+    return result.scalars().all()
+
+
+async def get_email_attachment(
+    db: AsyncSession, email_id: int, attachment_id: int, user_id: int
+) -> Optional[models.EmailAttachment]:
+    result = await db.execute(
+        select(models.EmailAttachment)
+        .join(models.Email, models.Email.id == models.EmailAttachment.email_id)
+        .where(
+            and_(
+                models.EmailAttachment.id == attachment_id,
+                models.EmailAttachment.email_id == email_id,
+                models.Email.user_id == user_id,
+            )
+        )
+    )
+    return result.scalar_one_or_none()
+
+
 # AI Response CRUD
 async def create_ai_response(
     db: AsyncSession, response_data: dict
@@ -242,10 +292,44 @@ async def get_auto_reply_rule(
 
 async def check_if_email_replied(db: AsyncSession, email_id: int, user_id: int) -> bool:
     result = await db.execute(
-        select(models.SentEmail.id).where(
+        select(models.SentEmail.id)
+        .where(
             models.SentEmail.original_email_id == email_id,
             models.SentEmail.user_id == user_id,
+            models.SentEmail.status == "sent",
+        )
+        .limit(1)
+    )
+    return result.first() is not None
+
+
+async def get_replied_email_ids(
+    db: AsyncSession, email_ids: List[int], user_id: int
+) -> set:
+    """Which of ``email_ids`` have a delivered reply, in one indexed query"""
+    if not email_ids:
+        return set()
+    result = await db.execute(
+        select(models.SentEmail.original_email_id)
+        .where(
+            models.SentEmail.original_email_id.in_(email_ids),
+            models.SentEmail.user_id == user_id,
+            models.SentEmail.status == "sent",
+        )
+        .distinct()
+    )
+    return set(result.scalars().all())
+
+
+async def get_monitored_mailbox_ids(db: AsyncSession, mailbox_ids: List[int]) -> set:
+    """Mailboxes that some worker currently holds a live monitor lease for"""
+    if not mailbox_ids:
+        return set()
+    result = await db.execute(
+        select(models.MailboxLease.mailbox_config_id).where(
+            models.MailboxLease.mailbox_config_id.in_(mailbox_ids),
+            models.MailboxLease.owner.is_not(None),
+            models.MailboxLease.expires_at > func.now(),
         )
     )
-    sent_email = result.scalar_one_or_none()
-    return sent_email is not None
+    return set(result.scalars().all())
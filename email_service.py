@@ -1,22 +1,46 @@
-from email.utils import formatdate, make_msgid, parseaddr
-import imaplib
+from email.utils import parseaddr
 import email
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from email.header import decode_header
 import logging
+import os
 import time
-import threading
 from datetime import datetime
-from models import Category, Email, SentEmail
-from categorizer import EmailCategorizer
+from models import Email, EmailAttachment, MailboxConfig, SentEmail
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert
 from db_sync import SyncSessionLocal
-import models
-from routers.ai_service import ai_reponse  # Importing synchronous session
+import imap_client
+from imap_pool import IMAPBackoff, imap_pool
+import email_threads
+import job_queue
+import mime_parser
+import text_preprocess
+import triage
 
 logger = logging.getLogger(__name__)
 
+# "idle" holds an IMAP IDLE session on INBOX and falls back to polling when the
+# server does not advertise IDLE; "poll" always polls
+MONITOR_MODE = os.getenv("EMAIL_MONITOR_MODE", "idle")
+POLL_INTERVAL = int(os.getenv("EMAIL_POLL_INTERVAL", 30))
+# Servers may drop IDLE after 30 minutes (RFC 2177), Gmail after ~10
+IDLE_TIMEOUT = int(os.getenv("IMAP_IDLE_TIMEOUT", 540))
+SENT_FOLDER = "[Gmail]/Sent Mail"  # Or use "SENT" depending on provider
+# UIDs per header FETCH and messages per body FETCH
+HEADER_BATCH_SIZE = int(os.getenv("IMAP_HEADER_BATCH_SIZE", 500))
+BODY_BATCH_SIZE = int(os.getenv("IMAP_BODY_BATCH_SIZE", 25))
+# Upper bound on the bytes of one body FETCH
+BODY_BATCH_BYTES = int(os.getenv("IMAP_BODY_BATCH_BYTES", 50 * 1024 * 1024))
+# Syncs that may fail to store a message before it is skipped for good
+MAX_MESSAGE_ATTEMPTS = int(os.getenv("IMAP_MAX_MESSAGE_ATTEMPTS", 3))
+
+# MailboxConfig columns holding (UIDVALIDITY, last seen UID) for each folder
+SYNC_STATE_COLUMNS = {
+    "INBOX": ("inbox_uid_validity", "inbox_last_uid"),
+    SENT_FOLDER: ("sent_uid_validity", "sent_last_uid"),
+    "SENT": ("sent_uid_validity", "sent_last_uid"),
+}
+
 
 class EmailService:
     def __init__(self, mailbox_config):
@@ -29,265 +53,423 @@ class EmailService:
         self.mailbox_config_id = mailbox_config.id
         self.auto_reply_enabled = mailbox_config.auto_reply_enabled
         self.confidence_threshold = mailbox_config.confidence_threshold
-        self.categorizer = EmailCategorizer()
+        self.monitor_mode = MONITOR_MODE
+        # Set while the monitor engine runs this mailbox
         self.monitoring = False
-        self.monitor_thread = None
+        self.parse_executor = None
+        self.last_sent_sync = 0.0
+        self.last_sync = mailbox_config.last_sync
+        self.sync_state = {
+            folder: {
+                "uid_validity": getattr(mailbox_config, validity_column),
+                "last_uid": getattr(mailbox_config, uid_column),
+            }
+            for folder, (validity_column, uid_column) in SYNC_STATE_COLUMNS.items()
+        }
+        # Failed store attempts per (folder, UID) since the process started
+        self.failed_uids = {}
 
-    def connect_imap(self):
-        try:
-            mail = imaplib.IMAP4_SSL(self.host, self.port)
-            mail.login(self.username, self.password)
-            return mail
-        except Exception as e:
-            logger.error(f"Failed to connect to IMAP server: {str(e)}")
-            raise
+    def imap_session(self):
+        """Borrow this mailbox's pooled IMAP session"""
+        return imap_pool.session(self.host, self.port, self.username, self.password)
 
     def decode_header_value(self, value):
         if value is None:
             return ""
         decoded_parts = decode_header(value)
         return "".join(
-            part.decode(encoding or "utf-8") if isinstance(part, bytes) else part
+            self._decode_part(part, encoding) if isinstance(part, bytes) else part
             for part, encoding in decoded_parts
         )
 
-    def extract_email_content(self, email_message):
-        body = ""
-        if email_message.is_multipart():
-            for part in email_message.walk():
-                if part.get_content_type() == "text/plain" and "attachment" not in str(
-                    part.get("Content-Disposition")
-                ):
-                    try:
-                        body += part.get_payload(decode=True).decode(
-                            "utf-8", errors="ignore"
-                        )
-                    except Exception as e:
-                        pass
-        else:
-            try:
-                body = email_message.get_payload(decode=True).decode(
-                    "utf-8", errors="ignore"
-                )
-            except Exception as e:
-                pass
-        return body.strip()
-
-    def send_reply_email(
-        self,
-        to_email: str,
-        subject: str,
-        body_text: str,
-        in_reply_to: str = None,
-        references: str = None,
-    ):
+    @staticmethod
+    def _decode_part(part: bytes, encoding) -> str:
         try:
-            msg = MIMEMultipart()
-            msg["From"] = self.username
-            msg["To"] = to_email
-            msg["Subject"] = subject
-            msg["Date"] = formatdate(localtime=True)
-            msg["Message-ID"] = make_msgid()
+            return part.decode(encoding or "utf-8")
+        except (LookupError, UnicodeDecodeError):
+            # Unknown or wrong charsets must not make a message unstorable
+            return part.decode("utf-8", errors="replace")
+
+    def inbox_row(self, email_message, message_id):
+        """Column values of an ``emails`` row for a parsed received message"""
+        sender = self.decode_header_value(email_message.get("From", ""))
+        from_name, from_email = parseaddr(email_message.get("From"))
+        in_reply_to = email_threads.parse_references(email_message.get("In-Reply-To"))
+        kind = triage.classify(email_message)
+        return {
+            "user_id": self.user_id,
+            "from_email": sender if sender else from_email,
+            "from_name": from_name if from_name else None,
+            "to_email": self.username,
+            "subject": self.decode_header_value(email_message.get("Subject", "")),
+            "body": email_message.body,
+            "html_body": email_message.html_body,
+            "clean_body": text_preprocess.clean_body(email_message.body),
+            "timestamp": datetime.utcnow(),
+            "is_read": False,
+            "is_starred": False,
+            "has_attachments": bool(email_message.attachments),
+            "priority": "low" if kind else "normal",
+            "labels": [kind] if kind else [],
+            "message_id": message_id,
+            "in_reply_to": in_reply_to[0] if in_reply_to else None,
+            "references": email_threads.parse_references(
+                email_message.get("References")
+            ),
+            "thread_id": message_id,
+            "ai_analysis": None,
+            "category_id": None,
+            "triage": kind,
+        }
 
-            if in_reply_to:
-                msg["In-Reply-To"] = in_reply_to
-            if references:
-                msg["References"] = references
+    def sent_row(self, email_message, message_id):
+        """Column values of a ``sent_emails`` row for a parsed sent message"""
+        recipients = self.decode_header_value(email_message.get("To", ""))
+        in_reply_to = email_threads.parse_references(email_message.get("In-Reply-To"))
+        references = email_threads.parse_references(email_message.get("References"))
+        return {
+            "message_id": message_id,
+            "in_reply_to": in_reply_to[0] if in_reply_to else None,
+            "references": " ".join(references) or None,
+            "subject": self.decode_header_value(email_message.get("Subject", "")),
+            # Linked to the received email by link_sent_replies
+            "original_email_id": None,
+            "sent_at": datetime.utcnow(),
+            "status": "sent",
+            "recipients": (
+                [r.strip() for r in recipients.split(",")] if recipients else []
+            ),
+            "delivery_status": "success",
+            "content": email_message.body,
+            "html_content": email_message.html_body,
+            "user_id": self.user_id,
+        }
 
-            msg.attach(MIMEText(body_text, "plain"))
+    def attachment_rows(self, email_message, email_id):
+        return [
+            {
+                "email_id": email_id,
+                "name": attachment.name,
+                "size": attachment.size,
+                "type": attachment.content_type,
+                "file_path": attachment.file_path,
+            }
+            for attachment in email_message.attachments
+        ]
 
-            with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-                server.login(self.username, self.password)
-                server.send_message(msg)
+    def link_sent_replies(self, session, message_ids=None, originals=None):
+        """
+        Point unlinked sent messages at the received email their In-Reply-To
+        names, one UPDATE for the whole batch: the sent messages among
+        ``message_ids``, or the replies to the received ``originals``
+        """
+        if message_ids:
+            selected = SentEmail.message_id.in_(message_ids)
+        elif originals:
+            # A reply synced from Sent before its original arrived
+            selected = SentEmail.in_reply_to.in_(originals)
+        else:
+            return 0
+        return session.execute(
+            update(SentEmail)
+            .where(
+                SentEmail.user_id == self.user_id,
+                selected,
+                SentEmail.original_email_id.is_(None),
+                Email.user_id == SentEmail.user_id,
+                Email.message_id == SentEmail.in_reply_to,
+            )
+            .values(original_email_id=Email.id)
+            .execution_options(synchronize_session=False)
+        ).rowcount
 
-            logger.info(f"Reply sent to {to_email} successfully")
-            return msg["Message-ID"]
+    def link_sent_thread(self, session, row):
+        """Thread a sent message, so replies to it join its conversation"""
+        email_threads.link_message(
+            session,
+            self.user_id,
+            None,
+            row["message_id"],
+            row["in_reply_to"],
+            email_threads.parse_references(row["references"]),
+        )
+
+    def reconcile_sent(self, message_ids):
+        try:
+            with SyncSessionLocal() as session:
+                linked = self.link_sent_replies(session, message_ids)
+                session.commit()
+            if linked:
+                logger.info(f"Linked {linked} sent replies for {self.username}")
         except Exception as e:
-            logger.error(f"Failed to send reply email: {str(e)}")
-            raise
+            logger.error(f"Failed to link sent replies for {self.username}: {str(e)}")
 
     def process_email(self, email_message, message_id, mailbox_type):
+        """
+        Store a message parsed by mime_parser.parse_message. Errors are
+        raised, so the caller does not move its sync mark past the message.
+        """
+        stored = False
         try:
             with SyncSessionLocal() as session:
-                sender = self.decode_header_value(email_message.get("From", ""))
-                recipients = self.decode_header_value(email_message.get("To", ""))
-                subject = self.decode_header_value(email_message.get("Subject", ""))
-                body = self.extract_email_content(email_message)
-                html_body = body
-                raw_from = email_message.get("From")
-                from_name, from_email = parseaddr(raw_from)
-
-                # Check if already processed (both tables)
+                # The unique (user_id, message_id) index makes a duplicate a
+                # no-op, even when two workers race on the same message
                 if mailbox_type == "INBOX":
-                    existing_email = (
-                        session.query(Email).filter_by(thread_id=message_id).first()
+                    row = self.inbox_row(email_message, message_id)
+                    new_email_id = session.execute(
+                        insert(Email)
+                        .values(row)
+                        .on_conflict_do_nothing(
+                            index_elements=["user_id", "message_id"]
+                        )
+                        .returning(Email.id)
+                    ).scalar()
+                    if new_email_id is None:
+                        logger.info(f"Email {message_id} already processed")
+                        return
+                    email_threads.link_message(
+                        session,
+                        self.user_id,
+                        new_email_id,
+                        message_id,
+                        row["in_reply_to"],
+                        row["references"],
                     )
-                else:
-                    existing_email = (
-                        session.query(SentEmail)
-                        .filter_by(message_id=message_id)
-                        .first()
+                    self.link_sent_replies(session, originals=[message_id])
+                    attachments = self.attachment_rows(email_message, new_email_id)
+                    if attachments:
+                        session.execute(insert(EmailAttachment), attachments)
+                    # Categorizing, drafting and sending run on the job
+                    # pipeline so LLM latency never stalls ingestion
+                    job_queue.enqueue(
+                        session,
+                        job_queue.CATEGORIZE,
+                        self.user_id,
+                        email_id=new_email_id,
+                        mailbox_config_id=self.mailbox_config_id,
                     )
-
-                if existing_email:
-                    logger.info(f"Email {message_id} already processed")
-                    return
-
-                if mailbox_type == "INBOX":
-                    new_email = Email(
-                        user_id=self.user_id,
-                        from_email=sender if sender else from_email,
-                        from_name=from_name if from_name else None,
-                        to_email=self.username,
-                        subject=subject,
-                        body=body,
-                        html_body=html_body,
-                        timestamp=datetime.utcnow(),
-                        is_read=False,
-                        is_starred=False,
-                        has_attachments=False,
-                        priority="normal",
-                        labels=[],
-                        thread_id=message_id,
-                        ai_analysis=None,
-                        category_id=None,
-                    )
-                    session.add(new_email)
-                    # Categorize email
-                    try:
-                        categories = (
-                            session.query(Category)
-                            .filter_by(user_id=self.user_id)
-                            .all()
-                        )
-                        category = self.categorizer.categorize_email(
-                            subject, body, sender, self.user_id, categories
-                        )
-                        new_email.category_id = category if category else None
-                        session.commit()
-                        logger.info(
-                            f"Processed email from {sender} with subject '{subject}'"
-                        )
-                    except Exception as e:
-                        logger.error(
-                            f"Failed to categorize email {message_id}: {str(e)}"
-                        )
-                        new_email.category_id = None
-                    if self.auto_reply_enabled:
-                        try:
-                            ai_res = ai_reponse(
-                                self.user_id,
-                                "",
-                                self.username,
-                                new_email.subject,
-                                new_email.body,
-                            )
-                            if (
-                                ai_res
-                                and "subject" in ai_res
-                                and "email_body" in ai_res
-                                and "confidence_score" in ai_res
-                            ):
-                                subject = ai_res["subject"]
-                                confidence_score = ai_res["confidence_score"]
-                                body = ai_res["email_body"]
-                                print(f"AI Response: {ai_res}")
-                                print(f"Confidence Score: {confidence_score}")
-                                print(f"Email Subject: {new_email.subject}")
-                                print(f"Email Body: {new_email.body}")
-                                print(
-                                    self.auto_reply_enabled,
-                                    self.confidence_threshold,
-                                    "config",
-                                )
-                                if confidence_score >= self.confidence_threshold:
-                                    new_message_id = self.send_reply_email(
-                                        to_email=new_email.from_email,
-                                        subject=subject,
-                                        body_text=body,
-                                        in_reply_to=message_id,
-                                        references=message_id,
-                                    )
-                                    new_sent_email = models.SentEmail(
-                                        message_id=new_message_id,
-                                        original_email_id=new_email.id,
-                                        sent_at=datetime.utcnow(),
-                                        status="sent",
-                                        recipients=[new_email.from_email],
-                                        delivery_status="success",
-                                        content=body,
-                                        html_content=body,
-                                        user_id=self.user_id,
-                                    )
-                                    session.add(new_sent_email)
-                                    session.commit()
-                                    session.refresh(new_sent_email)
-                        except Exception as e:
-                            logger.error(f"Failed to send auto-reply: {str(e)}")
                 elif mailbox_type == "[Gmail]/Sent Mail" or mailbox_type == "SENT":
-                    sent_email = SentEmail(
-                        message_id=message_id,
-                        original_email_id=None,  # Can be linked later via logic if needed
-                        sent_at=datetime.utcnow(),
-                        status="sent",
-                        recipients=[r.strip() for r in recipients.split(",")]
-                        if recipients
-                        else [],
-                        delivery_status="success",
-                        content=body,
-                        html_content=html_body,
-                        user_id=self.user_id,
-                    )
-                    session.add(sent_email)
+                    row = self.sent_row(email_message, message_id)
+                    new_sent_id = session.execute(
+                        insert(SentEmail)
+                        .values(row)
+                        .on_conflict_do_nothing(
+                            index_elements=["user_id", "message_id"]
+                        )
+                        .returning(SentEmail.id)
+                    ).scalar()
+                    if new_sent_id is None:
+                        logger.info(f"Email {message_id} already processed")
+                        return
+                    self.link_sent_thread(session, row)
+                else:
+                    return
 
                 session.commit()
-                logger.info(f"Processed {mailbox_type} email with subject '{subject}'")
+                stored = mailbox_type == "INBOX"
+                logger.info(
+                    f"Processed {mailbox_type} email with subject "
+                    f"'{self.decode_header_value(email_message.get('Subject', ''))}'"
+                )
 
         except Exception as e:
             logger.error(f"Error processing email {message_id}: {str(e)}")
+            raise
+        finally:
+            if not stored:
+                email_message.discard_attachments()
 
-    def fetch_emails(self, mailbox_type="INBOX", search_type="ALL"):
+    def save_sync_state(self, mailbox_type):
+        validity_column, uid_column = SYNC_STATE_COLUMNS[mailbox_type]
+        state = self.sync_state[mailbox_type]
+        self.last_sync = datetime.utcnow()
         try:
-            mail = self.connect_imap()
-            mail.select(f'"{mailbox_type}"')
-            status, messages = mail.search(None, search_type)
-            if status != "OK":
-                logger.warning(f"No emails found in {mailbox_type}.")
-                return
+            with SyncSessionLocal() as session:
+                session.query(MailboxConfig).filter_by(
+                    id=self.mailbox_config_id
+                ).update(
+                    {
+                        validity_column: state["uid_validity"],
+                        uid_column: state["last_uid"],
+                        MailboxConfig.last_sync: self.last_sync,
+                    }
+                )
+                session.commit()
+        except Exception as e:
+            logger.error(
+                f"Failed to save sync state for {mailbox_type} of {self.username}: {str(e)}"
+            )
 
-            for msg_id in messages[0].split()[-1:]:
-                _, msg_data = mail.fetch(msg_id, "(RFC822)")
-                email_message = email.message_from_bytes(msg_data[0][1])
-                message_id = email_message.get("Message-ID", f"msg_{msg_id.decode()}")
-                self.process_email(email_message, message_id, mailbox_type)
+    def parse_messages(self, raw_messages, mailbox_type, truncated):
+        """Parse a batch of messages, in parallel when a parse executor is set"""
+        # Only received mail keeps its attachments
+        spool = [mailbox_type == "INBOX"] * len(raw_messages)
+        if self.parse_executor is not None and len(raw_messages) > 1:
+            return list(
+                self.parse_executor.map(
+                    mime_parser.parse_message, raw_messages, spool, truncated
+                )
+            )
+        return list(map(mime_parser.parse_message, raw_messages, spool, truncated))
 
-            mail.close()
-            mail.logout()
+    def existing_message_ids(self, mailbox_type, message_ids):
+        """Return which of ``message_ids`` are already stored, in one query"""
+        if not message_ids:
+            return set()
+        with SyncSessionLocal() as session:
+            if mailbox_type == "INBOX":
+                rows = session.query(Email.message_id).filter(
+                    Email.user_id == self.user_id,
+                    Email.message_id.in_(message_ids),
+                )
+            else:
+                rows = session.query(SentEmail.message_id).filter(
+                    SentEmail.user_id == self.user_id,
+                    SentEmail.message_id.in_(message_ids),
+                )
+            return {row[0] for row in rows}
+
+    def new_message_uids(self, mail, uids, mailbox_type):
+        """
+        Fetch the Message-IDs of ``uids`` and return them as {uid: Message-ID}
+        together with the UIDs whose message is not stored yet
+        """
+        headers = imap_client.fetch_headers(mail, uids, ("MESSAGE-ID",))
+        message_ids = {
+            uid: (
+                email.message_from_bytes(raw).get("Message-ID") or f"msg_{uid}"
+            ).strip()
+            for uid, raw in headers.items()
+        }
+        known = self.existing_message_ids(mailbox_type, set(message_ids.values()))
+        new_uids = [
+            uid for uid, message_id in message_ids.items() if message_id not in known
+        ]
+        if len(new_uids) < len(message_ids):
+            logger.info(
+                f"Skipping {len(message_ids) - len(new_uids)} already stored emails in {mailbox_type}"
+            )
+        return message_ids, new_uids
+
+    def fetch_batch(self, mail, uids, mailbox_type):
+        """
+        Header-first fetch: pull Message-IDs for all ``uids`` in one command,
+        drop the ones already stored, then download only the new bodies in
+        batched FETCH commands.
+        """
+        message_ids, new_uids = self.new_message_uids(mail, uids, mailbox_type)
+        state = self.sync_state[mailbox_type]
+        sizes = imap_client.fetch_sizes(mail, new_uids)
+        for batch in imap_client.fetch_bodies(
+            mail,
+            new_uids,
+            BODY_BATCH_SIZE,
+            sizes=sizes,
+            max_bytes=mime_parser.MAX_MESSAGE_SIZE,
+            batch_bytes=BODY_BATCH_BYTES,
+        ):
+            truncated = [
+                sizes.get(uid, 0) > mime_parser.MAX_MESSAGE_SIZE for uid, _ in batch
+            ]
+            email_messages = self.parse_messages(
+                [raw for _, raw in batch], mailbox_type, truncated
+            )
+            for index, (uid, _) in enumerate(batch):
+                try:
+                    self.process_email(
+                        email_messages[index], message_ids[uid], mailbox_type
+                    )
+                except Exception:
+                    if not self.give_up_on(mailbox_type, uid):
+                        # The mark stays below this UID, so the next sync retries it
+                        for email_message in email_messages[index + 1 :]:
+                            email_message.discard_attachments()
+                        raise
+                else:
+                    self.failed_uids.pop((mailbox_type, uid), None)
+                state["last_uid"] = max(state["last_uid"], uid)
+            if mailbox_type != "INBOX":
+                self.reconcile_sent([message_ids[uid] for uid, _ in batch])
+        return len(new_uids)
+
+    def give_up_on(self, mailbox_type, uid) -> bool:
+        """Count a failed store of ``uid``; True once it should be skipped"""
+        attempts = self.failed_uids.get((mailbox_type, uid), 0) + 1
+        if attempts < MAX_MESSAGE_ATTEMPTS:
+            self.failed_uids[(mailbox_type, uid)] = attempts
+            return False
+        self.failed_uids.pop((mailbox_type, uid), None)
+        logger.error(
+            f"Skipping UID {uid} of {mailbox_type} for {self.username} "
+            f"after {attempts} failed attempts"
+        )
+        return True
+
+    def sync_folder(self, mail, mailbox_type):
+        """
+        Fetch only the messages that arrived in ``mailbox_type`` since the last
+        sync, using the UID high-water mark stored on MailboxConfig. A new
+        mailbox starts from its newest message; a UIDVALIDITY change resyncs
+        everything received since the previous sync date. Returns the number
+        of new messages.
+        """
+        state = self.sync_state[mailbox_type]
+        previous_state = dict(state)
+        uid_validity = imap_client.select_folder(mail, mailbox_type, readonly=True)
+
+        resync = state["last_uid"] is None or state["uid_validity"] != uid_validity
+        if resync:
+            # Taken before searching so mail arriving meanwhile is not skipped
+            ceiling = imap_client.highest_uid(mail)
+            if state["uid_validity"] is None or self.last_sync is None:
+                uids = [ceiling] if ceiling else []
+            else:
+                logger.warning(
+                    f"UIDVALIDITY of {mailbox_type} changed for {self.username}, resyncing"
+                )
+                uids = imap_client.uid_search(
+                    mail, f"SINCE {imap_client.imap_date(self.last_sync)}"
+                )
+            state["uid_validity"] = uid_validity
+            # If the resync is interrupted the next cycle resumes from here
+            state["last_uid"] = uids[0] - 1 if uids else ceiling
+        else:
+            uids = imap_client.uids_after(mail, state["last_uid"])
+
+        new_messages = 0
+        try:
+            for batch in imap_client.chunked(uids, HEADER_BATCH_SIZE):
+                new_messages += self.fetch_batch(mail, batch, mailbox_type)
+                state["last_uid"] = max(state["last_uid"], batch[-1])
+            if resync:
+                state["last_uid"] = max(state["last_uid"], ceiling)
+            return new_messages
+        finally:
+            # Idle polls leave the marks untouched and cost no DB write
+            if state != previous_state:
+                self.save_sync_state(mailbox_type)
+
+    def fetch_emails(self, mailbox_type="INBOX"):
+        """Sync one folder and return how many new messages it had"""
+        new_messages = 0
+        try:
+            with self.imap_session() as mail:
+                new_messages = self.sync_folder(mail, mailbox_type)
+        except IMAPBackoff:
+            # Let the scheduler wait out the reconnect backoff
+            raise
         except Exception as e:
             logger.error(f"Error fetching emails from {mailbox_type}: {str(e)}")
+        if mailbox_type != "INBOX":
+            self.last_sent_sync = time.monotonic()
+        return new_messages
 
-    def monitor_loop(self):
-        while self.monitoring:
-            try:
-                self.fetch_emails("INBOX", "ALL")
-                self.fetch_emails(
-                    "[Gmail]/Sent Mail", "ALL"
-                )  # Or use "SENT" depending on provider
-                time.sleep(30)
-            except Exception as e:
-                logger.error(f"Monitoring error: {str(e)}")
-                time.sleep(60)
+    def sent_sync_due(self):
+        return self.sent_sync_in() <= 0
 
-    def start_monitoring(self):
-        if not self.monitoring:
-            self.monitoring = True
-            self.monitor_thread = threading.Thread(target=self.monitor_loop)
-            self.monitor_thread.daemon = True
-            self.monitor_thread.start()
-            logger.info(f"Started monitoring for {self.username}")
+    def sent_sync_in(self) -> float:
+        """Seconds left until the Sent folder is due for another sync"""
+        return self.last_sent_sync + POLL_INTERVAL - time.monotonic()
 
-    def stop_monitoring(self):
-        self.monitoring = False
-        if self.monitor_thread:
-            self.monitor_thread.join(timeout=5)
-        logger.info(f"Stopped monitoring for {self.username}")
+    def poll_once(self):
+        return self.fetch_emails("INBOX") + self.fetch_emails(SENT_FOLDER)
@@ -0,0 +1,132 @@
+"""
+Incremental conversation threading after JWZ (https://www.jwz.org/doc/threading.html).
+
+Every Message-ID seen in a Message-ID, In-Reply-To or References header gets
+a container row keyed by (user_id, message_id) with its parent and the
+thread it belongs to. A thread is named after its root Message-ID and copied
+onto emails.thread_id, so a conversation is one indexed lookup.
+"""
+
+import logging
+import re
+from typing import List, Optional
+
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from models import Email, EmailThreadContainer
+
+logger = logging.getLogger(__name__)
+
+_MESSAGE_ID_RE = re.compile(r"<[^<>\s]+>")
+
+
+def parse_references(*values) -> List[str]:
+    """Message-IDs from References/In-Reply-To values, oldest first, deduped"""
+    seen = []
+    for value in values:
+        for message_id in _MESSAGE_ID_RE.findall(str(value or "")):
+            if message_id not in seen:
+                seen.append(message_id)
+    return seen
+
+
+def link_message(
+    session,
+    user_id: int,
+    email_id: Optional[int],
+    message_id: str,
+    in_reply_to: Optional[str],
+    references: List[str],
+) -> str:
+    """
+    Attach a stored message to its conversation and return the thread id.
+    When the message references two threads that were so far apart, they
+    are merged into the one of its oldest reference.
+    """
+    # Ancestors oldest first; In-Reply-To is the direct parent
+    chain = [ref for ref in references if ref != message_id]
+    if in_reply_to and in_reply_to != message_id:
+        if in_reply_to in chain:
+            chain.remove(in_reply_to)
+        chain.append(in_reply_to)
+
+    known = dict(
+        session.execute(
+            select(EmailThreadContainer.message_id, EmailThreadContainer.thread_id)
+            .where(
+                EmailThreadContainer.user_id == user_id,
+                EmailThreadContainer.message_id.in_(chain + [message_id]),
+            )
+            # One lock order for every writer, so two messages of the same
+            # thread linked at once cannot deadlock
+            .order_by(EmailThreadContainer.message_id)
+            .with_for_update()
+        ).all()
+    )
+
+    thread_ids = []
+    for ref in chain + [message_id]:
+        if ref in known and known[ref] not in thread_ids:
+            thread_ids.append(known[ref])
+    thread_id = thread_ids[0] if thread_ids else (chain[0] if chain else message_id)
+
+    merged = thread_ids[1:]
+    if merged:
+        logger.info(f"Merging threads {merged} into {thread_id} for user {user_id}")
+        session.execute(
+            update(EmailThreadContainer)
+            .where(
+                EmailThreadContainer.user_id == user_id,
+                EmailThreadContainer.thread_id.in_(merged),
+            )
+            .values(thread_id=thread_id)
+        )
+        session.execute(
+            update(Email)
+            .where(Email.user_id == user_id, Email.thread_id.in_(merged))
+            .values(thread_id=thread_id)
+        )
+
+    rows = [
+        {
+            "user_id": user_id,
+            "message_id": ref,
+            "thread_id": thread_id,
+            "parent_message_id": chain[i - 1] if i else None,
+            "email_id": None,
+        }
+        for i, ref in enumerate(chain)
+    ]
+    rows.append(
+        {
+            "user_id": user_id,
+            "message_id": message_id,
+            "thread_id": thread_id,
+            "parent_message_id": chain[-1] if chain else None,
+            "email_id": email_id,
+        }
+    )
+    rows.sort(key=lambda row: row["message_id"])
+    stmt = insert(EmailThreadContainer).values(rows)
+    session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["user_id", "message_id"],
+            set_={
+                "thread_id": thread_id,
+                # A known parent is kept; placeholders learn theirs later
+                "parent_message_id": func.coalesce(
+                    EmailThreadContainer.parent_message_id,
+                    stmt.excluded.parent_message_id,
+                ),
+                "email_id": func.coalesce(
+                    stmt.excluded.email_id, EmailThreadContainer.email_id
+                ),
+            },
+        )
+    )
+    if email_id is not None:
+        session.execute(
+            update(Email).where(Email.id == email_id).values(thread_id=thread_id)
+        )
+    return thread_id
@@ -0,0 +1,224 @@
+import imaplib
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+
+def supports_idle(mail: imaplib.IMAP4) -> bool:
+    """Check whether the server advertised the IDLE extension (RFC 2177)"""
+    return "IDLE" in mail.capabilities
+
+
+def _is_new_mail(line: bytes) -> bool:
+    parts = line.split()
+    return (
+        len(parts) >= 3
+        and parts[0] == b"*"
+        and parts[2].upper() in (b"EXISTS", b"RECENT")
+    )
+
+
+def _is_bye(line: bytes) -> bool:
+    parts = line.split()
+    return len(parts) >= 2 and parts[0] == b"*" and parts[1].upper() == b"BYE"
+
+
+def idle_start(mail: imaplib.IMAP4) -> bytes:
+    """Enter IDLE on the currently selected folder and return the command tag"""
+    tag = mail._new_tag()
+    mail.send(tag + b" IDLE\r\n")
+    line = mail.readline()
+    while line.startswith(b"* "):
+        # Untagged data queued before the continuation still counts
+        if _is_bye(line):
+            raise imaplib.IMAP4.abort(f"Server closed connection: {line!r}")
+        line = mail.readline()
+    if not line.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"IDLE rejected by server: {line!r}")
+    return tag
+
+
+def idle_read_event(mail: imaplib.IMAP4) -> bool:
+    """Read one pushed line while idling; True if it announces new mail"""
+    line = mail.readline()
+    if not line or _is_bye(line):
+        raise imaplib.IMAP4.abort("Connection closed during IDLE")
+    return _is_new_mail(line)
+
+
+def idle_done(mail: imaplib.IMAP4, tag: bytes) -> bool:
+    """Leave IDLE, drain responses up to the tagged OK, report new mail"""
+    mail.send(b"DONE\r\n")
+    has_new = False
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed while leaving IDLE")
+        if line.startswith(tag + b" "):
+            if b" OK" not in line.upper():
+                raise imaplib.IMAP4.error(f"IDLE failed: {line!r}")
+            return has_new
+        has_new = has_new or _is_new_mail(line)
+
+
+_MONTHS = "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()
+
+
+def imap_date(value) -> str:
+    """Format a date for SEARCH SINCE/BEFORE without depending on the locale"""
+    return f"{value.day:02d}-{_MONTHS[value.month - 1]}-{value.year}"
+
+
+def select_folder(mail: imaplib.IMAP4, folder: str, readonly: bool = False) -> int:
+    """SELECT ``folder`` and return its UIDVALIDITY"""
+    status, data = mail.select(f'"{folder}"', readonly=readonly)
+    if status != "OK":
+        raise imaplib.IMAP4.error(f"Cannot select {folder}: {data}")
+    _, values = mail.response("UIDVALIDITY")
+    if not values or values[0] is None:
+        raise imaplib.IMAP4.error(f"Server sent no UIDVALIDITY for {folder}")
+    return int(values[0])
+
+
+def uid_search(mail: imaplib.IMAP4, criteria: str):
+    """Run UID SEARCH on the selected folder and return the matching UIDs"""
+    status, data = mail.uid("SEARCH", None, criteria)
+    if status != "OK":
+        raise imaplib.IMAP4.error(f"UID SEARCH {criteria} failed: {data}")
+    if not data or not data[0]:
+        return []
+    return sorted(int(uid) for uid in data[0].split())
+
+
+def highest_uid(mail: imaplib.IMAP4) -> int:
+    uids = uid_search(mail, "UID *")
+    return uids[-1] if uids else 0
+
+
+def uids_after(mail: imaplib.IMAP4, last_uid: int):
+    """UIDs strictly greater than ``last_uid`` in the selected folder"""
+    # "n:*" always matches the highest UID, even when it is below n (RFC 3501)
+    return [uid for uid in uid_search(mail, f"UID {last_uid + 1}:*") if uid > last_uid]
+
+
+_UID_RE = re.compile(rb"UID (\d+)")
+_SIZE_RE = re.compile(rb"RFC822\.SIZE (\d+)")
+
+
+def uid_set(uids) -> str:
+    """Compress UIDs into an IMAP sequence set, e.g. [1, 2, 3, 7] -> 1:3,7"""
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(
+        str(start) if start == end else f"{start}:{end}" for start, end in ranges
+    )
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def _parse_fetch(data):
+    """
+    Pair each literal in a UID FETCH response with its UID. Servers may send
+    the UID item before or after the literal, so both positions are handled.
+    """
+    results = {}
+    pending = None
+    for item in data:
+        if isinstance(item, tuple):
+            match = _UID_RE.search(item[0])
+            if match:
+                results[int(match.group(1))] = item[1]
+                pending = None
+            else:
+                pending = item[1]
+        elif isinstance(item, bytes) and pending is not None:
+            match = _UID_RE.search(item)
+            if match:
+                results[int(match.group(1))] = pending
+            pending = None
+    return results
+
+
+def uid_fetch(mail: imaplib.IMAP4, uids, items: str):
+    """Run a single UID FETCH for ``uids`` and return {uid: literal}"""
+    if not uids:
+        return {}
+    status, data = mail.uid("FETCH", uid_set(uids), f"(UID {items})")
+    if status != "OK":
+        raise imaplib.IMAP4.error(f"UID FETCH {items} failed: {data}")
+    return _parse_fetch(data)
+
+
+def fetch_headers(mail: imaplib.IMAP4, uids, fields=("MESSAGE-ID",)):
+    """Fetch only the given header fields for many UIDs without marking them read"""
+    return uid_fetch(mail, uids, f"BODY.PEEK[HEADER.FIELDS ({' '.join(fields)})]")
+
+
+def fetch_sizes(mail: imaplib.IMAP4, uids):
+    """Return {uid: RFC822.SIZE} for ``uids`` without downloading anything"""
+    if not uids:
+        return {}
+    status, data = mail.uid("FETCH", uid_set(uids), "(UID RFC822.SIZE)")
+    if status != "OK":
+        raise imaplib.IMAP4.error(f"UID FETCH RFC822.SIZE failed: {data}")
+    sizes = {}
+    for item in data:
+        line = item[0] if isinstance(item, tuple) else item
+        if not isinstance(line, bytes):
+            continue
+        uid, size = _UID_RE.search(line), _SIZE_RE.search(line)
+        if uid and size:
+            sizes[int(uid.group(1))] = int(size.group(1))
+    return sizes
+
+
+def _size_batches(uids, batch_size: int, sizes, batch_bytes):
+    batch, total = [], 0
+    for uid in sorted(uids):
+        size = sizes.get(uid, 0)
+        if batch and (len(batch) >= batch_size or total + size > batch_bytes):
+            yield batch
+            batch, total = [], 0
+        batch.append(uid)
+        total += size
+    if batch:
+        yield batch
+
+
+def fetch_bodies(
+    mail: imaplib.IMAP4,
+    uids,
+    batch_size: int,
+    sizes=None,
+    max_bytes: int = None,
+    batch_bytes: int = None,
+    throttle=None,
+):
+    """
+    Fetch full messages ``batch_size`` at a time, yielding each batch as a
+    list of (uid, raw message) sorted by UID. Given ``sizes``, batches are
+    also kept under ``batch_bytes``; messages are cut off at ``max_bytes``.
+    ``throttle`` is called with the expected bytes of a batch before its
+    FETCH is sent; a false answer ends the fetch.
+    """
+    item = f"BODY.PEEK[]<0.{max_bytes}>" if max_bytes else "BODY.PEEK[]"
+    if sizes and batch_bytes:
+        batches = _size_batches(uids, batch_size, sizes, batch_bytes)
+    else:
+        batches = chunked(sorted(uids), batch_size)
+    for batch in batches:
+        if throttle is not None:
+            limit = max_bytes or float("inf")
+            expected = sum(min((sizes or {}).get(uid, 0), limit) for uid in batch)
+            if not throttle(expected):
+                return
+        bodies = uid_fetch(mail, batch, item)
+        yield sorted(bodies.items())
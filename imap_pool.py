@@ -0,0 +1,194 @@
+import imaplib
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+# Sessions unused for this long get a NOOP before reuse and from the keepalive
+NOOP_INTERVAL = int(os.getenv("IMAP_NOOP_INTERVAL", 60))
+BACKOFF_BASE = float(os.getenv("IMAP_BACKOFF_BASE", 2))
+BACKOFF_MAX = float(os.getenv("IMAP_BACKOFF_MAX", 300))
+
+# Errors after which the connection can no longer be trusted
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, OSError, EOFError)
+
+
+class IMAPBackoff(Exception):
+    """Raised while a mailbox is waiting out its reconnect backoff"""
+
+    def __init__(self, username: str, retry_in: float):
+        super().__init__(f"Reconnect for {username} backing off for {retry_in:.1f}s")
+        self.retry_in = retry_in
+
+
+def backoff_delay(failures: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_MAX):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(cap, base * 2 ** max(failures - 1, 0)))
+
+
+class PooledSession:
+    def __init__(self, host: str, port: int, username: str, password: str):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.mail = None
+        # A plain Lock so an async caller may release it from another thread
+        self.lock = threading.Lock()
+        self.last_used = 0.0
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def connect(self):
+        now = time.monotonic()
+        if now < self.retry_at:
+            raise IMAPBackoff(self.username, self.retry_at - now)
+        try:
+            mail = imaplib.IMAP4_SSL(self.host, self.port)
+            mail.login(self.username, self.password)
+        except Exception as e:
+            self.failures += 1
+            delay = backoff_delay(self.failures)
+            self.retry_at = time.monotonic() + delay
+            logger.error(
+                f"IMAP login for {self.username} failed ({self.failures} in a row), "
+                f"retrying in {delay:.1f}s: {str(e)}"
+            )
+            raise
+        self.failures = 0
+        self.retry_at = 0.0
+        self.mail = mail
+        self.last_used = time.monotonic()
+        logger.info(f"Opened IMAP session for {self.username}")
+        return mail
+
+    def noop(self) -> bool:
+        try:
+            self.mail.noop()
+            self.last_used = time.monotonic()
+            return True
+        except CONNECTION_ERRORS as e:
+            logger.warning(f"IMAP session for {self.username} went stale: {str(e)}")
+            self.discard()
+            return False
+
+    def ensure(self):
+        """Return a live authenticated connection, reconnecting if needed"""
+        if self.mail is not None:
+            if time.monotonic() - self.last_used < NOOP_INTERVAL or self.noop():
+                return self.mail
+        return self.connect()
+
+    def discard(self):
+        mail, self.mail = self.mail, None
+        if mail is not None:
+            try:
+                mail.logout()
+            except Exception:
+                pass
+
+
+class IMAPConnectionPool:
+    """
+    One authenticated IMAP session per mailbox, reused across syncs and
+    folders. Idle sessions are kept alive with NOOP; broken ones are dropped
+    and reopened with jittered exponential backoff.
+    """
+
+    def __init__(self, noop_interval: int = NOOP_INTERVAL):
+        self.noop_interval = noop_interval
+        self._sessions: Dict[str, PooledSession] = {}
+        self._lock = threading.Lock()
+        self._keepalive_thread = None
+
+    def _get(self, host, port, username, password) -> PooledSession:
+        with self._lock:
+            pooled = self._sessions.get(username)
+            if pooled is None:
+                pooled = PooledSession(host, port, username, password)
+                self._sessions[username] = pooled
+            else:
+                # Pick up app password changes without a restart
+                pooled.password = password
+            if self._keepalive_thread is None:
+                self._keepalive_thread = threading.Thread(
+                    target=self._keepalive_loop, name="imap-keepalive", daemon=True
+                )
+                self._keepalive_thread.start()
+            return pooled
+
+    def acquire(self, host: str, port: int, username: str, password: str):
+        """
+        Check out the mailbox's session, blocking while someone else holds it.
+        Must be paired with release(); prefer session() for synchronous code.
+        """
+        pooled = self._get(host, port, username, password)
+        pooled.lock.acquire()
+        try:
+            return pooled, pooled.ensure()
+        except BaseException:
+            pooled.lock.release()
+            raise
+
+    def release(self, pooled: PooledSession, broken: bool = False):
+        if broken:
+            pooled.discard()
+        pooled.last_used = time.monotonic()
+        pooled.lock.release()
+
+    @contextmanager
+    def session(self, host: str, port: int, username: str, password: str):
+        """Borrow the mailbox's session for the duration of the block"""
+        pooled, mail = self.acquire(host, port, username, password)
+        broken = False
+        try:
+            yield mail
+        except CONNECTION_ERRORS:
+            broken = True
+            raise
+        finally:
+            self.release(pooled, broken)
+
+    def keepalive(self):
+        """NOOP every idle session that nobody is currently using"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for pooled in sessions:
+            if not pooled.lock.acquire(blocking=False):
+                continue
+            try:
+                idle_for = time.monotonic() - pooled.last_used
+                if pooled.mail is not None and idle_for >= self.noop_interval:
+                    pooled.noop()
+            finally:
+                pooled.lock.release()
+
+    def _keepalive_loop(self):
+        while True:
+            time.sleep(self.noop_interval)
+            try:
+                self.keepalive()
+            except Exception as e:
+                logger.error(f"IMAP keepalive error: {str(e)}")
+
+    def close(self, username: str):
+        with self._lock:
+            pooled = self._sessions.pop(username, None)
+        if pooled is not None:
+            with pooled.lock:
+                pooled.discard()
+            logger.info(f"Closed IMAP session for {username}")
+
+    def close_all(self):
+        with self._lock:
+            usernames = list(self._sessions)
+        for username in usernames:
+            self.close(username)
+
+
+imap_pool = IMAPConnectionPool()
@@ -0,0 +1,169 @@
+import logging
+import os
+import random
+from datetime import timedelta
+from typing import List
+
+from sqlalchemy import and_, func, or_, select, update
+
+from db_sync import SyncSessionLocal
+from mailbox_leases import WORKER_ID
+from models import EmailJob, JobStatus
+
+logger = logging.getLogger(__name__)
+
+# Pipeline stages after ingestion, in order
+CATEGORIZE = "categorize"
+DRAFT = "draft"
+SEND = "send"
+STAGES = (CATEGORIZE, DRAFT, SEND)
+
+RETRY_BASE = float(os.getenv("JOB_RETRY_BASE", 30))
+RETRY_MAX = float(os.getenv("JOB_RETRY_MAX", 3600))
+# Running jobs not finished within this many seconds are assumed orphaned
+VISIBILITY_TIMEOUT = int(os.getenv("JOB_VISIBILITY_TIMEOUT", 600))
+
+
+class PermanentError(Exception):
+    """Raised by a handler when retrying the job cannot help"""
+
+
+class Deferred(Exception):
+    """Raised by a handler to run the job later without spending an attempt"""
+
+    def __init__(self, delay: float, reason: str = None):
+        super().__init__(reason or f"Deferred for {delay:.0f}s")
+        self.delay = delay
+
+
+def retry_delay(attempts: int) -> float:
+    delay = min(RETRY_MAX, RETRY_BASE * 2 ** max(attempts - 1, 0))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def enqueue(
+    session,
+    stage: str,
+    user_id: int,
+    email_id: int = None,
+    mailbox_config_id: int = None,
+    payload: dict = None,
+    delay: float = 0,
+    max_attempts: int = 5,
+) -> EmailJob:
+    """
+    Add a job in the caller's session so it commits atomically with the
+    change that produced it
+    """
+    if stage not in STAGES:
+        raise ValueError(f"stage must be one of {STAGES}, got {stage!r}")
+    job = EmailJob(
+        stage=stage,
+        status=JobStatus.PENDING,
+        user_id=user_id,
+        email_id=email_id,
+        mailbox_config_id=mailbox_config_id,
+        payload=payload or {},
+        attempts=0,
+        max_attempts=max_attempts,
+        run_after=func.now() + timedelta(seconds=delay),
+    )
+    session.add(job)
+    return job
+
+
+def claim(stage: str, limit: int, worker_id: str = WORKER_ID) -> List[int]:
+    """
+    Lock up to ``limit`` due jobs of ``stage`` for this worker. Jobs left
+    running by a crashed worker become claimable after VISIBILITY_TIMEOUT.
+    """
+    with SyncSessionLocal() as session:
+        job_ids = (
+            session.execute(
+                select(EmailJob.id)
+                .where(
+                    EmailJob.stage == stage,
+                    or_(
+                        and_(
+                            EmailJob.status == JobStatus.PENDING,
+                            EmailJob.run_after <= func.now(),
+                        ),
+                        and_(
+                            EmailJob.status == JobStatus.RUNNING,
+                            EmailJob.locked_at
+                            < func.now() - timedelta(seconds=VISIBILITY_TIMEOUT),
+                        ),
+                    ),
+                )
+                .order_by(EmailJob.run_after, EmailJob.id)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+            )
+            .scalars()
+            .all()
+        )
+        if job_ids:
+            session.execute(
+                update(EmailJob)
+                .where(EmailJob.id.in_(job_ids))
+                .values(
+                    status=JobStatus.RUNNING,
+                    locked_by=worker_id,
+                    locked_at=func.now(),
+                    attempts=EmailJob.attempts + 1,
+                )
+            )
+        session.commit()
+        return job_ids
+
+
+def complete(session, job: EmailJob):
+    """Mark done in the handler's session, together with its side effects"""
+    job.status = JobStatus.DONE
+    job.locked_by = None
+    job.last_error = None
+
+
+def fail(job_id: int, error: str, permanent: bool = False) -> bool:
+    """
+    Schedule a retry with backoff, or dead-letter once attempts run out.
+    Returns True if the job is dead.
+    """
+    with SyncSessionLocal() as session:
+        job = session.get(EmailJob, job_id)
+        if job is None:
+            return True
+        job.last_error = error
+        job.locked_by = None
+        dead = permanent or job.attempts >= job.max_attempts
+        if dead:
+            job.status = JobStatus.DEAD
+            logger.error(
+                f"Job {job.id} ({job.stage}) dead after {job.attempts} attempts: {error}"
+            )
+        else:
+            delay = retry_delay(job.attempts)
+            job.status = JobStatus.PENDING
+            job.run_after = func.now() + timedelta(seconds=delay)
+            logger.warning(
+                f"Job {job.id} ({job.stage}) failed, retrying in {delay:.0f}s: {error}"
+            )
+        session.commit()
+        return dead
+
+
+def defer(job_id: int, delay: float, reason: str = None):
+    """Put a job back without spending one of its attempts"""
+    with SyncSessionLocal() as session:
+        session.execute(
+            update(EmailJob)
+            .where(EmailJob.id == job_id)
+            .values(
+                status=JobStatus.PENDING,
+                locked_by=None,
+                attempts=EmailJob.attempts - 1,
+                run_after=func.now() + timedelta(seconds=delay),
+                last_error=reason,
+            )
+        )
+        session.commit()
@@ -0,0 +1,173 @@
+"""
+Local fast path for categorization. Emails are embedded with the shared
+sentence encoder and compared with the user's previously categorized emails
+and with their category descriptions. A clear majority among the nearest
+neighbours decides the category; anything ambiguous goes to the LLM, whose
+answer then becomes another labelled example.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+from db_sync import SyncSessionLocal
+from models import EmailEmbedding
+from routers.ai_service import get_encoder
+
+logger = logging.getLogger(__name__)
+
+KNN_ENABLED = os.getenv("KNN_CATEGORIZER", "true").lower() == "true"
+KNN_K = int(os.getenv("KNN_K", 7))
+# Neighbours less similar than this do not vote
+KNN_MIN_SIMILARITY = float(os.getenv("KNN_MIN_SIMILARITY", 0.55))
+KNN_MIN_VOTERS = int(os.getenv("KNN_MIN_VOTERS", 3))
+# Required lead of the best category over the runner-up, as a share of all votes
+KNN_MARGIN = float(os.getenv("KNN_MARGIN", 0.5))
+# Most recent labelled emails kept per user
+KNN_MAX_EXAMPLES = int(os.getenv("KNN_MAX_EXAMPLES", 5000))
+# Examples written by other workers are picked up after this many seconds
+KNN_REFRESH_INTERVAL = float(os.getenv("KNN_REFRESH_INTERVAL", 300))
+EMBED_CHARS = 2000
+
+
+def embed(subject: str, body: str) -> np.ndarray:
+    text = f"{subject or ''}\n{(body or '')[:EMBED_CHARS]}"
+    return get_encoder().encode(text, normalize_embeddings=True).astype(np.float32)
+
+
+class UserIndex:
+    """One user's labelled vectors as a matrix, newest last"""
+
+    def __init__(self, vectors: np.ndarray, labels: np.ndarray):
+        self.vectors = vectors
+        self.labels = labels
+        self.loaded_at = time.monotonic()
+
+    def add(self, vector: np.ndarray, category_id: int):
+        self.vectors = np.vstack([self.vectors, vector])[-KNN_MAX_EXAMPLES:]
+        self.labels = np.append(self.labels, category_id)[-KNN_MAX_EXAMPLES:]
+
+
+class KNNCategorizer:
+    def __init__(self, persist: bool = True):
+        """Without ``persist`` examples live only in memory, e.g. for benchmarks"""
+        self.persist = persist
+        self._indexes: Dict[int, UserIndex] = {}
+        # (category id, text) -> vector of the category's name and description
+        self._prototypes: Dict[tuple, np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    def _load(self, user_id: int) -> UserIndex:
+        dim = get_encoder().get_sentence_embedding_dimension()
+        if not self.persist:
+            with self._lock:
+                index = self._indexes.get(user_id)
+            if index is None:
+                index = UserIndex(
+                    np.empty((0, dim), dtype=np.float32), np.empty(0, dtype=np.int64)
+                )
+            index.loaded_at = time.monotonic()
+            return index
+        with SyncSessionLocal() as session:
+            rows = session.execute(
+                select(EmailEmbedding.category_id, EmailEmbedding.embedding)
+                .where(EmailEmbedding.user_id == user_id)
+                .order_by(EmailEmbedding.created_at.desc())
+                .limit(KNN_MAX_EXAMPLES)
+            ).all()
+        rows.reverse()
+        vectors = np.array(
+            [np.frombuffer(row.embedding, dtype=np.float32) for row in rows],
+            dtype=np.float32,
+        ).reshape(len(rows), dim)
+        labels = np.array([row.category_id for row in rows], dtype=np.int64)
+        return UserIndex(vectors, labels)
+
+    def _index(self, user_id: int) -> UserIndex:
+        with self._lock:
+            index = self._indexes.get(user_id)
+        if index is None or time.monotonic() - index.loaded_at > KNN_REFRESH_INTERVAL:
+            index = self._load(user_id)
+            with self._lock:
+                self._indexes[user_id] = index
+        return index
+
+    def _prototype_vectors(self, categories) -> List[np.ndarray]:
+        vectors = []
+        for category in categories:
+            text = f"{category.name}: {category.description or ''}"
+            key = (category.id, text)
+            vector = self._prototypes.get(key)
+            if vector is None:
+                vector = get_encoder().encode(text, normalize_embeddings=True)
+                self._prototypes[key] = vector.astype(np.float32)
+                vector = self._prototypes[key]
+            vectors.append(vector)
+        return vectors
+
+    def predict(self, user_id: int, vector: np.ndarray, categories) -> Optional[int]:
+        """The category id if the neighbours agree clearly enough, else None"""
+        index = self._index(user_id)
+        with self._lock:
+            # remember() replaces both arrays; read them as one snapshot
+            examples, example_labels = index.vectors, index.labels
+        keep = np.isin(example_labels, [category.id for category in categories])
+        vectors = np.vstack([examples[keep]] + self._prototype_vectors(categories))
+        labels = np.concatenate(
+            [example_labels[keep], [category.id for category in categories]]
+        )
+
+        similarities = vectors @ vector
+        nearest = np.argsort(similarities)[::-1][:KNN_K]
+        nearest = nearest[similarities[nearest] >= KNN_MIN_SIMILARITY]
+        if len(nearest) < KNN_MIN_VOTERS:
+            return None
+
+        votes: Dict[int, float] = {}
+        for i in nearest:
+            votes[int(labels[i])] = votes.get(int(labels[i]), 0.0) + similarities[i]
+        ranked = sorted(votes.values(), reverse=True) + [0.0]
+        margin = (ranked[0] - ranked[1]) / sum(votes.values())
+        if margin < KNN_MARGIN:
+            return None
+        return max(votes, key=votes.get)
+
+    def remember(
+        self, user_id: int, email_id: int, category_id: int, vector: np.ndarray
+    ):
+        """Keep an LLM-categorized email as a labelled example"""
+        if not self.persist:
+            index = self._index(user_id)
+            with self._lock:
+                index.add(vector, category_id)
+            return
+        with SyncSessionLocal() as session:
+            stmt = insert(EmailEmbedding).values(
+                email_id=email_id,
+                user_id=user_id,
+                category_id=category_id,
+                embedding=vector.tobytes(),
+            )
+            session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=["email_id"],
+                    set_={
+                        "category_id": category_id,
+                        "embedding": stmt.excluded.embedding,
+                    },
+                )
+            )
+            session.commit()
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is not None:
+                index.add(vector, category_id)
+
+
+knn_categorizer = KNNCategorizer()
@@ -0,0 +1,201 @@
+"""
+One LLM client layer for the process. Chat models are built once per
+configuration on shared keep-alive HTTP clients, every call passes a global
+concurrency cap and a per-API-key rate limit, and 429/5xx answers and
+connection errors are retried with backoff.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import weakref
+from typing import Dict
+
+import groq
+import httpx
+from langchain_groq import ChatGroq
+
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Required; there is no built-in key
+GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile")
+# Requests in flight at once across the process
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", 30))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 4))
+LLM_RETRY_BASE = float(os.getenv("LLM_RETRY_BASE", 1))
+LLM_RETRY_MAX = float(os.getenv("LLM_RETRY_MAX", 30))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 60))
+
+_HTTP_LIMITS = httpx.Limits(
+    max_connections=LLM_MAX_CONCURRENCY * 2,
+    max_keepalive_connections=LLM_MAX_CONCURRENCY,
+)
+
+_slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+_buckets: Dict[str, TokenBucket] = {}
+_clients: Dict[tuple, "LLMClient"] = {}
+_http_client = None
+# httpx.AsyncClient is bound to the event loop it first ran on, so each loop
+# has its own, dropped together with the loop
+_async_http_clients = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def _bucket(api_key: str) -> TokenBucket:
+    with _lock:
+        bucket = _buckets.get(api_key)
+        if bucket is None:
+            rate = LLM_REQUESTS_PER_MINUTE / 60
+            # A few seconds' worth of burst, never less than one request
+            bucket = TokenBucket(rate, max(1.0, rate * 5))
+            _buckets[api_key] = bucket
+        return bucket
+
+
+def _shared_http_client() -> httpx.Client:
+    global _http_client
+    with _lock:
+        if _http_client is None:
+            _http_client = httpx.Client(limits=_HTTP_LIMITS, timeout=LLM_TIMEOUT)
+        return _http_client
+
+
+def _loop_http_client(loop) -> httpx.AsyncClient:
+    with _lock:
+        client = _async_http_clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(limits=_HTTP_LIMITS, timeout=LLM_TIMEOUT)
+            _async_http_clients[loop] = client
+        return client
+
+
+def retry_delay(error: Exception, attempt: int):
+    """Seconds to wait before retrying ``error``, or None if it is final"""
+    if isinstance(error, groq.APIStatusError):
+        if error.status_code != 429 and error.status_code < 500:
+            return None
+        retry_after = error.response.headers.get("retry-after")
+        try:
+            return min(LLM_RETRY_MAX, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+    elif not isinstance(error, (groq.APIConnectionError, httpx.TransportError)):
+        return None
+    delay = min(LLM_RETRY_MAX, LLM_RETRY_BASE * 2**attempt)
+    return delay * random.uniform(0.8, 1.2)
+
+
+class LLMClient:
+    """A shared chat model whose calls are capped, rate limited and retried"""
+
+    def __init__(self, chat: ChatGroq, api_key: str, chat_options: dict = None):
+        self.chat = chat
+        self.bucket = _bucket(api_key)
+        self.chat_options = chat_options or {}
+        # Chat models on the async HTTP client of each event loop
+        self._async_chats = weakref.WeakKeyDictionary()
+
+    def invoke(self, messages):
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            with _slots:
+                try:
+                    return self.chat.invoke(messages)
+                except Exception as e:
+                    delay = retry_delay(e, attempt)
+                    if delay is None or attempt >= LLM_MAX_RETRIES:
+                        raise
+                    logger.warning(
+                        f"LLM call failed, retrying in {delay:.1f}s: {str(e)}"
+                    )
+            time.sleep(delay)
+            attempt += 1
+
+    def _async_chat(self) -> ChatGroq:
+        loop = asyncio.get_running_loop()
+        http_async_client = _loop_http_client(loop)
+        with _lock:
+            chat = self._async_chats.get(loop)
+            if chat is None:
+                chat = ChatGroq(
+                    **self.chat_options, http_async_client=http_async_client
+                )
+                self._async_chats[loop] = chat
+            return chat
+
+    async def ainvoke(self, messages):
+        """invoke for coroutines; waits for the same limits without blocking"""
+        chat = self._async_chat()
+        attempt = 0
+        while True:
+            wait = self.bucket.try_acquire()
+            while wait:
+                await asyncio.sleep(wait)
+                wait = self.bucket.try_acquire()
+            # The slots are shared with threads, so poll instead of blocking
+            while not _slots.acquire(blocking=False):
+                await asyncio.sleep(0.05)
+            try:
+                return await chat.ainvoke(messages)
+            except Exception as e:
+                delay = retry_delay(e, attempt)
+                if delay is None or attempt >= LLM_MAX_RETRIES:
+                    raise
+                logger.warning(f"LLM call failed, retrying in {delay:.1f}s: {str(e)}")
+            finally:
+                _slots.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+def get_llm(
+    model: str = GROQ_MODEL, api_key: str = GROQ_API_KEY, **params
+) -> LLMClient:
+    """The shared client for this model and sampling configuration"""
+    if not api_key:
+        raise RuntimeError("GROQ_API_KEY is not set")
+    key = (model, api_key, tuple(sorted(params.items())))
+    with _lock:
+        client = _clients.get(key)
+    if client is not None:
+        return client
+
+    chat_options = dict(
+        model=model,
+        api_key=api_key,
+        # Retries are ours, so they pass the rate limit and concurrency cap
+        max_retries=0,
+        http_client=_shared_http_client(),
+        **params,
+    )
+    # Built outside the lock, which _bucket takes too
+    client = LLMClient(ChatGroq(**chat_options), api_key, chat_options)
+    with _lock:
+        return _clients.setdefault(key, client)
+
+
+async def aclose():
+    """close(), plus the async HTTP client of the running event loop"""
+    with _lock:
+        client = _async_http_clients.pop(asyncio.get_running_loop(), None)
+    close()
+    if client is not None:
+        await client.aclose()
+
+
+def close():
+    """Close the shared HTTP client; later calls build a new one"""
+    global _http_client
+    with _lock:
+        http_client, _http_client = _http_client, None
+        _clients.clear()
+    if http_client is not None:
+        http_client.close()
@@ -0,0 +1,186 @@
+import logging
+import math
+import os
+import socket
+import uuid
+from datetime import timedelta
+from typing import Set
+
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from db_sync import SyncSessionLocal
+from models import MailboxConfig, MailboxLease, MonitorWorker
+
+logger = logging.getLogger(__name__)
+
+LEASE_TTL = int(os.getenv("MONITOR_LEASE_TTL", 60))
+HEARTBEAT_INTERVAL = int(os.getenv("MONITOR_HEARTBEAT_INTERVAL", 15))
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _lease_expiry():
+    # Database time only, so clock skew between nodes cannot steal leases
+    return func.now() + timedelta(seconds=LEASE_TTL)
+
+
+def _claimable():
+    return or_(MailboxLease.owner.is_(None), MailboxLease.expires_at < func.now())
+
+
+def request(mailbox_id: int):
+    """Record that a mailbox should be monitored by some worker"""
+    with SyncSessionLocal() as session:
+        session.execute(
+            insert(MailboxLease)
+            .values(mailbox_config_id=mailbox_id)
+            .on_conflict_do_nothing(index_elements=["mailbox_config_id"])
+        )
+        session.commit()
+
+
+def claim(mailbox_id: int, worker_id: str = WORKER_ID) -> bool:
+    """Take the lease unless another live worker holds it"""
+    with SyncSessionLocal() as session:
+        claimed = session.execute(
+            update(MailboxLease)
+            .where(
+                MailboxLease.mailbox_config_id == mailbox_id,
+                or_(_claimable(), MailboxLease.owner == worker_id),
+            )
+            .values(
+                owner=worker_id, heartbeat_at=func.now(), expires_at=_lease_expiry()
+            )
+            .returning(MailboxLease.mailbox_config_id)
+        ).first()
+        session.commit()
+        return claimed is not None
+
+
+def claim_orphans(limit: int, worker_id: str = WORKER_ID) -> Set[int]:
+    """Claim up to ``limit`` unowned or expired leases of enabled mailboxes"""
+    if limit <= 0:
+        return set()
+    with SyncSessionLocal() as session:
+        orphans = (
+            select(MailboxLease.id)
+            .join(MailboxConfig, MailboxConfig.id == MailboxLease.mailbox_config_id)
+            .where(MailboxConfig.enabled.is_(True), _claimable())
+            .order_by(MailboxLease.mailbox_config_id)
+            .limit(limit)
+            .with_for_update(of=MailboxLease, skip_locked=True)
+            .scalar_subquery()
+        )
+        claimed = session.execute(
+            update(MailboxLease)
+            .where(MailboxLease.id.in_(orphans))
+            .values(
+                owner=worker_id, heartbeat_at=func.now(), expires_at=_lease_expiry()
+            )
+            .returning(MailboxLease.mailbox_config_id)
+        ).scalars()
+        claimed = set(claimed)
+        session.commit()
+    if claimed:
+        logger.info(f"Worker {worker_id} claimed mailboxes {sorted(claimed)}")
+    return claimed
+
+
+def heartbeat(worker_id: str = WORKER_ID) -> Set[int]:
+    """
+    Mark the worker alive and renew its leases. Returns the mailboxes it still
+    owns; anything missing was stopped or taken over and must not keep running.
+    """
+    with SyncSessionLocal() as session:
+        session.execute(
+            insert(MonitorWorker)
+            .values(worker_id=worker_id, heartbeat_at=func.now())
+            .on_conflict_do_update(
+                index_elements=["worker_id"], set_={"heartbeat_at": func.now()}
+            )
+        )
+        owned = session.execute(
+            update(MailboxLease)
+            .where(MailboxLease.owner == worker_id)
+            .values(heartbeat_at=func.now(), expires_at=_lease_expiry())
+            .returning(MailboxLease.mailbox_config_id)
+        ).scalars()
+        owned = set(owned)
+        session.execute(
+            delete(MonitorWorker).where(
+                MonitorWorker.heartbeat_at
+                < func.now() - timedelta(seconds=LEASE_TTL * 10)
+            )
+        )
+        session.commit()
+        return owned
+
+
+def fair_share() -> int:
+    """How many enabled mailboxes each live worker should monitor"""
+    with SyncSessionLocal() as session:
+        total = session.execute(
+            select(func.count(MailboxLease.id))
+            .join(MailboxConfig, MailboxConfig.id == MailboxLease.mailbox_config_id)
+            .where(MailboxConfig.enabled.is_(True))
+        ).scalar()
+        workers = session.execute(
+            select(func.count(MonitorWorker.worker_id)).where(
+                MonitorWorker.heartbeat_at > func.now() - timedelta(seconds=LEASE_TTL)
+            )
+        ).scalar()
+    return math.ceil(total / max(workers, 1))
+
+
+def yield_leases(mailbox_ids, worker_id: str = WORKER_ID):
+    """Hand leases back so other workers can claim them right away"""
+    if not mailbox_ids:
+        return
+    with SyncSessionLocal() as session:
+        session.execute(
+            update(MailboxLease)
+            .where(
+                MailboxLease.owner == worker_id,
+                MailboxLease.mailbox_config_id.in_(mailbox_ids),
+            )
+            .values(owner=None, expires_at=None)
+        )
+        session.commit()
+
+
+def release(mailbox_id: int):
+    """Stop monitoring a mailbox everywhere; its owner notices on heartbeat"""
+    with SyncSessionLocal() as session:
+        session.execute(
+            delete(MailboxLease).where(MailboxLease.mailbox_config_id == mailbox_id)
+        )
+        session.commit()
+
+
+def is_leased(mailbox_id: int) -> bool:
+    with SyncSessionLocal() as session:
+        return (
+            session.execute(
+                select(MailboxLease.id).where(
+                    MailboxLease.mailbox_config_id == mailbox_id,
+                    MailboxLease.owner.is_not(None),
+                    MailboxLease.expires_at > func.now(),
+                )
+            ).first()
+            is not None
+        )
+
+
+def retire(worker_id: str = WORKER_ID):
+    """Release every lease of a worker that is shutting down"""
+    with SyncSessionLocal() as session:
+        session.execute(
+            update(MailboxLease)
+            .where(MailboxLease.owner == worker_id)
+            .values(owner=None, expires_at=None)
+        )
+        session.execute(
+            delete(MonitorWorker).where(MonitorWorker.worker_id == worker_id)
+        )
+        session.commit()
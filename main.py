@@ -2,6 +2,7 @@ from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
+import asyncio
 from database import engine, Base
 from routers import (
     categories,
@@ -14,7 +15,13 @@ from routers import (
     logs,
     user,
     moniter,
+    ai_service,
 )
+import backfill
+import config_cache
+import llm_client
+import pipeline
+from smtp_sender import smtp_sender
 import sentry_sdk
 from sentry_sdk.integrations.starlette import StarletteIntegration
 from sentry_sdk.integrations.fastapi import FastApiIntegration
@@ -26,7 +33,22 @@ async def lifespan(app: FastAPI):
     # Create tables
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    # Load the encoder and build the response flow before any email needs it
+    await asyncio.to_thread(ai_service.warm_up)
+    # Claim this worker's share of monitored mailboxes
+    moniter.manager.start()
+    # Drop cached user configuration when another process changes it
+    config_cache.listener.start()
+    # Categorize, draft and send workers draining the job queue
+    pipeline.start_pipeline()
     yield
+    # Stop mailbox monitors and close their pooled IMAP sessions
+    moniter.manager.shutdown()
+    pipeline.stop_pipeline()
+    config_cache.listener.stop()
+    backfill.stop_all()
+    smtp_sender.close_all()
+    await llm_client.aclose()
 
 
 sentry_sdk.init(
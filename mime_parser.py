@@ -0,0 +1,436 @@
+import binascii
+import collections
+import logging
+import os
+import quopri
+import re
+import shutil
+import uuid
+from dataclasses import dataclass, field
+from email import policy as email_policy
+from email.header import decode_header, make_header
+from email.message import Message
+from email.parser import BytesFeedParser, BytesHeaderParser
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+ATTACHMENT_DIR = os.getenv("ATTACHMENT_DIR", "attachments")
+# Larger messages are only fetched up to this many bytes
+MAX_MESSAGE_SIZE = int(os.getenv("MAX_MESSAGE_SIZE", 25 * 1024 * 1024))
+# Attachments above this are recorded but not written to disk
+MAX_ATTACHMENT_SIZE = int(os.getenv("MAX_ATTACHMENT_SIZE", 25 * 1024 * 1024))
+# Characters kept from the text and HTML bodies
+MAX_BODY_CHARS = int(os.getenv("MAX_BODY_CHARS", 1_000_000))
+FEED_CHUNK_SIZE = 64 * 1024
+# Base64 characters decoded per write; a multiple of 4
+DECODE_CHUNK_SIZE = 256 * 1024
+
+HEADERS = (
+    "From",
+    "To",
+    "Subject",
+    "Message-ID",
+    "Date",
+    "In-Reply-To",
+    "References",
+    # Read by triage.py
+    "Return-Path",
+    "Auto-Submitted",
+    "X-Autoreply",
+    "X-Autorespond",
+    "Precedence",
+    "List-Id",
+    "List-Unsubscribe",
+)
+
+_UNSAFE_FILENAME_RE = re.compile(r"[^\w.\- ]+")
+
+
+@dataclass
+class ParsedAttachment:
+    name: str
+    content_type: str
+    size: int
+    file_path: Optional[str] = None
+
+
+@dataclass
+class ParsedEmail:
+    """The parts of a message the service stores; small enough to pickle"""
+
+    headers: Dict[str, str]
+    body: str = ""
+    html_body: str = ""
+    attachments: List[ParsedAttachment] = field(default_factory=list)
+    truncated: bool = False
+    spool_dir: Optional[str] = None
+
+    def get(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def discard_attachments(self):
+        """Remove spooled files of a message that will not be stored"""
+        if self.spool_dir:
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+            self.spool_dir = None
+
+
+def _decode_filename(name: str) -> str:
+    try:
+        name = str(make_header(decode_header(name)))
+    except Exception:
+        pass
+    name = _UNSAFE_FILENAME_RE.sub("_", os.path.basename(name)).strip(" .")
+    return name or "attachment"
+
+
+def _decoded_chunks(payload: str, encoding: str):
+    """Decode a transfer-encoded payload piecewise instead of all at once"""
+    if encoding == "base64":
+        leftover = ""
+        for start in range(0, len(payload), DECODE_CHUNK_SIZE):
+            chunk = leftover + "".join(
+                payload[start : start + DECODE_CHUNK_SIZE].split()
+            )
+            usable = len(chunk) - len(chunk) % 4
+            leftover = chunk[usable:]
+            if usable:
+                yield binascii.a2b_base64(chunk[:usable])
+        if leftover.rstrip("="):
+            yield binascii.a2b_base64(leftover + "=" * (-len(leftover) % 4))
+        return
+    data = payload.encode("ascii", "surrogateescape")
+    if encoding == "quoted-printable":
+        data = quopri.decodestring(data)
+    yield data
+
+
+def _transfer_encoding(part: Message) -> str:
+    return str(part.get("Content-Transfer-Encoding", "")).strip().lower()
+
+
+def _estimated_size(encoded: int, encoding: str) -> int:
+    return encoded * 3 // 4 if encoding == "base64" else encoded
+
+
+def _is_attachment(part: Message) -> bool:
+    if part.get_content_maintype() in ("multipart", "message"):
+        return False
+    disposition = str(part.get("Content-Disposition", "")).lower()
+    if disposition.startswith("attachment"):
+        return True
+    return part.get_filename() is not None and part.get_content_maintype() != "text"
+
+
+class AttachmentWriter:
+    """Decodes the body of one attachment into its file as the body is read"""
+
+    def __init__(self, attachment: ParsedAttachment, encoding: str, path: str):
+        self.attachment = attachment
+        self.encoding = encoding
+        self.path = path
+        self.file = open(path, "wb") if path else None
+        self.encoded = 0
+        # Undecodable tail of the last write: partial base64 quantum or QP line
+        self.leftover = b""
+
+    def write(self, data: memoryview):
+        self.encoded += len(data)
+        for start in range(0, len(data), DECODE_CHUNK_SIZE):
+            if self.file is None:
+                return
+            try:
+                decoded = self._decode(data[start : start + DECODE_CHUNK_SIZE])
+            except (binascii.Error, ValueError) as e:
+                logger.warning(
+                    f"Could not decode attachment {self.attachment.name}: {str(e)}"
+                )
+                self._abandon()
+                return
+            self._store(decoded)
+
+    def _decode(self, piece: memoryview) -> bytes:
+        if self.encoding == "base64":
+            chunk = self.leftover + b"".join(piece.tobytes().split())
+            usable = len(chunk) - len(chunk) % 4
+            self.leftover = chunk[usable:]
+            return binascii.a2b_base64(chunk[:usable]) if usable else b""
+        if self.encoding == "quoted-printable":
+            # Soft line breaks and =XX escapes never span a line
+            chunk = self.leftover + piece.tobytes()
+            cut = chunk.rfind(b"\n") + 1
+            self.leftover = chunk[cut:]
+            return binascii.a2b_qp(chunk[:cut])
+        return piece.tobytes()
+
+    def _store(self, decoded: bytes):
+        self.attachment.size += len(decoded)
+        if self.attachment.size > MAX_ATTACHMENT_SIZE:
+            self._abandon()
+        else:
+            self.file.write(decoded)
+
+    def _abandon(self):
+        self.file.close()
+        self.file = None
+        os.remove(self.path)
+
+    def close(self):
+        if self.file is not None and self.leftover:
+            try:
+                if self.encoding == "base64":
+                    if self.leftover.rstrip(b"="):
+                        padding = b"=" * (-len(self.leftover) % 4)
+                        self._store(binascii.a2b_base64(self.leftover + padding))
+                else:
+                    self._store(binascii.a2b_qp(self.leftover))
+            except (binascii.Error, ValueError) as e:
+                logger.warning(
+                    f"Could not decode attachment {self.attachment.name}: {str(e)}"
+                )
+                self._abandon()
+        if self.file is not None:
+            self.file.close()
+            self.attachment.file_path = self.path
+        else:
+            # Not kept on disk; report what the message said it carried
+            self.attachment.size = _estimated_size(self.encoded, self.encoding)
+
+
+class AttachmentSpool:
+    """Collects attachments of one message, writing them under a private dir"""
+
+    def __init__(self, enabled: bool = True, root: str = ATTACHMENT_DIR):
+        self.enabled = enabled
+        self.root = root
+        self.dir = None
+        self.attachments: List[ParsedAttachment] = []
+        # Attachments streamed by parse_message, not yet claimed by their part
+        self.streamed = collections.deque()
+
+    def _add(self, part: Message) -> ParsedAttachment:
+        attachment = ParsedAttachment(
+            name=_decode_filename(part.get_filename() or ""),
+            content_type=part.get_content_type(),
+            size=0,
+        )
+        self.attachments.append(attachment)
+        return attachment
+
+    def _path(self, attachment: ParsedAttachment) -> str:
+        if self.dir is None:
+            self.dir = os.path.join(self.root, uuid.uuid4().hex)
+            os.makedirs(self.dir, exist_ok=True)
+        return os.path.join(self.dir, f"{len(self.attachments)}_{attachment.name}")
+
+    def stream(self, part: Message) -> AttachmentWriter:
+        """A writer for the body of ``part``, whose headers were just read"""
+        attachment = self._add(part)
+        self.streamed.append(attachment)
+        path = self._path(attachment) if self.enabled else None
+        return AttachmentWriter(attachment, _transfer_encoding(part), path)
+
+    def write(self, part: Message, payload: str) -> ParsedAttachment:
+        """Spool an attachment the parser buffered whole"""
+        attachment = self._add(part)
+        name = attachment.name
+        encoding = _transfer_encoding(part)
+        estimated = _estimated_size(len(payload), encoding)
+        if not self.enabled or estimated > MAX_ATTACHMENT_SIZE:
+            attachment.size = estimated
+            return attachment
+
+        path = self._path(attachment)
+        try:
+            with open(path, "wb") as f:
+                for chunk in _decoded_chunks(payload, encoding):
+                    f.write(chunk)
+                    attachment.size += len(chunk)
+            attachment.file_path = path
+        except (binascii.Error, ValueError) as e:
+            logger.warning(f"Could not decode attachment {name}: {str(e)}")
+            os.remove(path)
+        return attachment
+
+    def drop(self, attachment: ParsedAttachment):
+        """Forget the file of an attachment cut off by a truncated fetch"""
+        if attachment.file_path:
+            os.remove(attachment.file_path)
+            attachment.file_path = None
+
+
+class SpoolingMessage(Message):
+    """
+    A Message whose attachment payloads go to the spool the moment the feed
+    parser completes them, so the tree never holds attachment bytes
+    """
+
+    def __init__(self, spool: AttachmentSpool, policy=email_policy.compat32):
+        super().__init__(policy)
+        self._spool = spool
+        self.attachment: Optional[ParsedAttachment] = None
+
+    def is_attachment(self) -> bool:
+        return _is_attachment(self)
+
+    def set_payload(self, payload, charset=None):
+        if isinstance(payload, str) and self.is_attachment():
+            if self._spool.streamed and not payload.strip():
+                # Its body went to disk before the parser saw it
+                self.attachment = self._spool.streamed.popleft()
+            else:
+                self.attachment = self._spool.write(self, payload)
+            payload = ""
+        super().set_payload(payload, charset)
+
+
+def _feed(parser: BytesFeedParser, view: memoryview, start: int, end: int):
+    for offset in range(start, end, FEED_CHUNK_SIZE):
+        parser.feed(view[offset : min(offset + FEED_CHUNK_SIZE, end)].tobytes())
+
+
+def _boundary_line(line: bytes, boundaries):
+    """(depth, closing) of the multipart ``line`` delimits, or None"""
+    if not line.startswith(b"--"):
+        return None
+    text = line.rstrip(b"\r\n").rstrip(b" \t")
+    for depth in range(len(boundaries) - 1, -1, -1):
+        delimiter = b"--" + boundaries[depth]
+        if text == delimiter:
+            return depth, False
+        if text == delimiter + b"--":
+            return depth, True
+    return None
+
+
+def _feed_streaming(parser: BytesFeedParser, raw: bytes, spool: AttachmentSpool):
+    """
+    Feed ``raw`` to ``parser``, except for attachment bodies: those are
+    decoded into the spool as they are scanned, and the parser sees their
+    parts with empty bodies. Whatever this scan cannot follow is fed as is
+    and spooled by SpoolingMessage once the parser completes it.
+    """
+    view = memoryview(raw)
+    header_parser = BytesHeaderParser(policy=email_policy.compat32)
+    boundaries = []
+    # Lines of the header block being read; None inside a body
+    headers = []
+    writer = None
+    fed = pos = 0
+    while pos < len(raw):
+        if writer is not None:
+            # Only a line starting with "--" can end an attachment body
+            if raw.startswith(b"--", pos):
+                candidate = pos
+            else:
+                candidate = raw.find(b"\n--", pos)
+                candidate = len(raw) if candidate < 0 else candidate + 1
+            line_end = raw.find(b"\n", candidate)
+            line_end = len(raw) if line_end < 0 else line_end + 1
+            if _boundary_line(raw[candidate:line_end], boundaries) is None:
+                writer.write(view[pos:line_end])
+                pos = line_end
+                continue
+            # The line break before a delimiter belongs to the delimiter
+            body_end = candidate
+            if raw.endswith(b"\n", pos, body_end):
+                body_end -= 2 if raw.endswith(b"\r\n", pos, body_end) else 1
+            writer.write(view[pos:body_end])
+            writer.close()
+            writer = None
+            fed = pos = candidate
+
+        line_end = raw.find(b"\n", pos)
+        line_end = len(raw) if line_end < 0 else line_end + 1
+        line = raw[pos:line_end]
+        pos = line_end
+        match = _boundary_line(line, boundaries) if boundaries else None
+        if match is not None:
+            depth, closing = match
+            del boundaries[depth if closing else depth + 1 :]
+            headers = None if closing else []
+        elif headers is not None:
+            if line.strip(b"\r\n"):
+                headers.append(line)
+                continue
+            part = header_parser.parsebytes(b"".join(headers))
+            headers = None
+            if part.get_content_maintype() == "multipart":
+                boundary = part.get_boundary()
+                if boundary:
+                    boundaries.append(boundary.encode("ascii", "surrogateescape"))
+            elif part.get_content_maintype() == "message":
+                # An attached message starts with its own headers
+                headers = []
+            elif _is_attachment(part):
+                _feed(parser, view, fed, pos)
+                fed = pos
+                writer = spool.stream(part)
+    if writer is not None:
+        # Cut off before its closing delimiter
+        writer.close()
+        fed = len(raw)
+    _feed(parser, view, fed, len(raw))
+
+
+def _part_text(part: Message) -> str:
+    data = part.get_payload(decode=True)
+    if not data:
+        return ""
+    charset = part.get_content_charset() or "utf-8"
+    try:
+        return data.decode(charset, errors="ignore")
+    except LookupError:
+        return data.decode("utf-8", errors="ignore")
+
+
+def parse_message(
+    raw: bytes, spool_attachments: bool = True, truncated: bool = False
+) -> ParsedEmail:
+    """
+    Parse a raw RFC822 message with a feed parser, feeding it in chunks.
+    Attachment bodies are decoded to disk while the message is scanned, so
+    neither the parser nor the tree ever holds them. Module level so it can
+    run in a process pool.
+    """
+    spool = AttachmentSpool(enabled=spool_attachments)
+    parser = BytesFeedParser(
+        _factory=lambda policy=email_policy.compat32: SpoolingMessage(spool, policy)
+    )
+    _feed_streaming(parser, raw, spool)
+    message = parser.close()
+
+    plain, html = [], []
+    last_part = None
+    for part in message.walk():
+        if part.is_multipart():
+            continue
+        last_part = part
+        if part.is_attachment():
+            continue
+        content_type = part.get_content_type()
+        if content_type == "text/html":
+            html.append(_part_text(part))
+        elif content_type == "text/plain" or not message.is_multipart():
+            plain.append(_part_text(part))
+
+    if truncated and last_part is not None and last_part.attachment is not None:
+        # The fetch stopped inside this attachment; never serve its partial bytes
+        logger.warning(
+            f"Skipping attachment cut off by the {MAX_MESSAGE_SIZE} byte limit"
+        )
+        spool.drop(last_part.attachment)
+
+    body = "".join(plain).strip()
+    html_body = "".join(html).strip()
+    return ParsedEmail(
+        headers={
+            name: message.get(name) for name in HEADERS if message.get(name) is not None
+        },
+        body=(body or html_body)[:MAX_BODY_CHARS],
+        html_body=(html_body or body)[:MAX_BODY_CHARS],
+        attachments=spool.attachments,
+        truncated=truncated,
+        spool_dir=spool.dir,
+    )
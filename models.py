@@ -1,14 +1,18 @@
 from sqlalchemy import (
     Column,
     Integer,
+    BigInteger,
     String,
+    Date,
     DateTime,
     Boolean,
     Text,
     Float,
     ForeignKey,
     JSON,
+    LargeBinary,
     Enum,
+    Index,
 )
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -35,6 +39,13 @@ class ResponseStatus(str, enum.Enum):
     SENT = "sent"
 
 
+class JobStatus(str, enum.Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    DEAD = "dead"
+
+
 class LogType(str, enum.Enum):
     SENT = "sent"
     FAILED = "failed"
@@ -129,12 +140,23 @@ class MailboxConfig(Base):
     last_sync = Column(DateTime(timezone=True))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     auto_reply_enabled = Column(Boolean, default=False)
+    # IMAP sync high-water marks, reset when the server changes UIDVALIDITY
+    inbox_uid_validity = Column(BigInteger)
+    inbox_last_uid = Column(BigInteger)
+    sent_uid_validity = Column(BigInteger)
+    sent_last_uid = Column(BigInteger)
+    # Progress of the historical import, see backfill.py
+    backfill_state = Column(JSON)
 
     user = relationship("User", back_populates="mailbox_configs")
 
 
 class Email(Base):
     __tablename__ = "emails"
+    __table_args__ = (
+        Index("uq_emails_user_message_id", "user_id", "message_id", unique=True),
+        Index("ix_emails_user_thread", "user_id", "thread_id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -145,14 +167,23 @@ class Email(Base):
     subject = Column(String, nullable=False)
     body = Column(Text)
     html_body = Column(Text)
+    # Body without quoted history, signature and disclaimers for LLM prompts,
+    # see text_preprocess.py
+    clean_body = Column(Text)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
     is_read = Column(Boolean, default=False)
     is_starred = Column(Boolean, default=False)
     has_attachments = Column(Boolean, default=False)
     priority = Column(String, default="normal")
     labels = Column(JSON)
+    message_id = Column(String)
+    in_reply_to = Column(String)
+    references = Column(JSON)
+    # Message-ID of the conversation root, see email_threads.py
     thread_id = Column(String)
     ai_analysis = Column(JSON)
+    # Kind of automated mail from triage.py; None for mail from a person
+    triage = Column(String)
 
     user = relationship("User", back_populates="emails")
     category = relationship("Category", back_populates="emails")
@@ -160,6 +191,32 @@ class Email(Base):
     ai_responses = relationship("AIResponse", back_populates="email")
 
 
+class EmailThreadContainer(Base):
+    """
+    One node of a conversation tree, JWZ style. Messages that are only known
+    from References headers are kept as placeholders without an email.
+    """
+
+    __tablename__ = "email_thread_containers"
+    __table_args__ = (
+        Index(
+            "uq_email_thread_containers_user_message_id",
+            "user_id",
+            "message_id",
+            unique=True,
+        ),
+        Index("ix_email_thread_containers_user_thread", "user_id", "thread_id"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    message_id = Column(String, nullable=False)
+    thread_id = Column(String, nullable=False)
+    parent_message_id = Column(String)
+    email_id = Column(Integer, ForeignKey("emails.id", ondelete="SET NULL"))
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
 class EmailAttachment(Base):
     __tablename__ = "email_attachments"
 
@@ -173,6 +230,40 @@ class EmailAttachment(Base):
     email = relationship("Email", back_populates="attachments")
 
 
+class EmailEmbedding(Base):
+    """Sentence embedding of a categorized email, see knn_categorizer.py"""
+
+    __tablename__ = "email_embeddings"
+    __table_args__ = (
+        Index("ix_email_embeddings_user_created", "user_id", "created_at"),
+    )
+
+    email_id = Column(
+        Integer, ForeignKey("emails.id", ondelete="CASCADE"), primary_key=True
+    )
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    category_id = Column(
+        Integer, ForeignKey("categories.id", ondelete="CASCADE"), nullable=False
+    )
+    # Normalized float32 vector
+    embedding = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class CategorizationCacheEntry(Base):
+    """Shared tier of the categorization cache, see categorization_cache.py"""
+
+    __tablename__ = "categorization_cache"
+
+    # Hash of user, category set and normalized content
+    key = Column(String(64), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    category_id = Column(
+        Integer, ForeignKey("categories.id", ondelete="CASCADE"), nullable=False
+    )
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
 class AIResponse(Base):
     __tablename__ = "ai_responses"
 
@@ -248,17 +339,32 @@ class ActivityLog(Base):
 
 class SentEmail(Base):
     __tablename__ = "sent_emails"
+    __table_args__ = (
+        Index("uq_sent_emails_user_message_id", "user_id", "message_id", unique=True),
+        # Reply-status checks read only this index
+        Index("ix_sent_emails_original_user", "original_email_id", "user_id"),
+        # Finds replies synced before the email they answer
+        Index("ix_sent_emails_user_in_reply_to", "user_id", "in_reply_to"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     original_email_id = Column(Integer, ForeignKey("emails.id"))
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    mailbox_config_id = Column(
+        Integer, ForeignKey("mailbox_configs.id", ondelete="SET NULL")
+    )
     message_id = Column(String)
+    in_reply_to = Column(String)
+    references = Column(Text)
+    subject = Column(String)
     sent_at = Column(DateTime(timezone=True), server_default=func.now())
+    # "queued" until the send stage delivers it, then "sent" or "failed"
     status = Column(String, default="sent")
     recipients = Column(JSON)
     delivery_status = Column(String, default="pending")
     content = Column(Text)
     html_content = Column(Text)
+    last_error = Column(Text)
 
 
 class Webhook(Base):
@@ -271,3 +377,72 @@ class Webhook(Base):
     secret = Column(String)
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class MailboxLease(Base):
+    """
+    A row means the mailbox should be monitored; ``owner`` is the worker
+    currently doing it. Leases that are not renewed before ``expires_at``
+    are taken over by another worker.
+    """
+
+    __tablename__ = "mailbox_leases"
+
+    id = Column(Integer, primary_key=True, index=True)
+    mailbox_config_id = Column(
+        Integer,
+        ForeignKey("mailbox_configs.id", ondelete="CASCADE"),
+        unique=True,
+        nullable=False,
+    )
+    owner = Column(String, index=True)
+    heartbeat_at = Column(DateTime(timezone=True))
+    expires_at = Column(DateTime(timezone=True), index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class SendQuota(Base):
+    """Outbound send budget of a mailbox, see send_quota.py"""
+
+    __tablename__ = "send_quotas"
+
+    mailbox_config_id = Column(
+        Integer, ForeignKey("mailbox_configs.id", ondelete="CASCADE"), primary_key=True
+    )
+    tokens = Column(Float, nullable=False)
+    refilled_at = Column(DateTime(timezone=True), nullable=False)
+    # UTC day that sent_today counts
+    day = Column(Date, nullable=False)
+    sent_today = Column(Integer, default=0, nullable=False)
+
+
+class MonitorWorker(Base):
+    __tablename__ = "monitor_workers"
+
+    worker_id = Column(String, primary_key=True)
+    heartbeat_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class EmailJob(Base):
+    """A unit of work for one pipeline stage, claimed with SKIP LOCKED"""
+
+    __tablename__ = "email_jobs"
+    __table_args__ = (Index("ix_email_jobs_claim", "stage", "status", "run_after"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    stage = Column(String, nullable=False)
+    status = Column(Enum(JobStatus), default=JobStatus.PENDING, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    email_id = Column(Integer, ForeignKey("emails.id", ondelete="CASCADE"))
+    mailbox_config_id = Column(
+        Integer, ForeignKey("mailbox_configs.id", ondelete="CASCADE")
+    )
+    payload = Column(JSON)
+    attempts = Column(Integer, default=0, nullable=False)
+    max_attempts = Column(Integer, default=5, nullable=False)
+    run_after = Column(DateTime(timezone=True), server_default=func.now())
+    locked_by = Column(String)
+    locked_at = Column(DateTime(timezone=True))
+    last_error = Column(Text)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
@@ -0,0 +1,275 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict
+
+import imap_client
+from email_service import IDLE_TIMEOUT, POLL_INTERVAL, SENT_FOLDER, EmailService
+from imap_pool import IMAPBackoff, imap_pool
+from poll_scheduler import AdaptiveInterval, TimingWheel, jittered
+
+logger = logging.getLogger(__name__)
+
+# Threads for short blocking calls (IMAP commands, DB, LLM, SMTP)
+IO_WORKERS = int(os.getenv("MONITOR_IO_WORKERS", 16))
+# Processes for MIME parsing; 0 parses on the IO threads
+PARSE_WORKERS = int(os.getenv("MONITOR_PARSE_WORKERS", min(4, os.cpu_count() or 1)))
+ERROR_RETRY_DELAY = 60
+
+
+def _release_abandoned(acquiring):
+    """Done callback returning a session checked out for a cancelled task"""
+    if not acquiring.cancelled() and acquiring.exception() is None:
+        pooled, _ = acquiring.result()
+        imap_pool.release(pooled)
+
+
+class MonitorEngine:
+    """
+    Runs every mailbox monitor on a single event loop thread. IDLE sessions
+    wait for socket readiness on the loop itself, polled mailboxes share one
+    timing wheel that spaces each by its own arrival rate, and the short
+    blocking steps are pushed to bounded executors, so thread and process
+    counts stay fixed no matter how many mailboxes are monitored.
+    """
+
+    def __init__(
+        self, io_workers: int = IO_WORKERS, parse_workers: int = PARSE_WORKERS
+    ):
+        self.io_workers = io_workers
+        self.parse_workers = parse_workers
+        self.loop = None
+        self.thread = None
+        self.io_executor = None
+        self.parse_executor = None
+        self.wheel = None
+        self.services: Dict[int, EmailService] = {}
+        self.intervals: Dict[int, AdaptiveInterval] = {}
+        # In-flight work per mailbox: its IDLE session or a running poll
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self.thread is not None:
+                return
+            self.io_executor = ThreadPoolExecutor(
+                max_workers=self.io_workers, thread_name_prefix="monitor-io"
+            )
+            if self.parse_workers > 0:
+                self.parse_executor = ProcessPoolExecutor(
+                    max_workers=self.parse_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            self.loop = asyncio.new_event_loop()
+            self.loop.set_default_executor(self.io_executor)
+            self.thread = threading.Thread(
+                target=self.loop.run_forever, name="monitor-engine", daemon=True
+            )
+            self.thread.start()
+            self.wheel = TimingWheel()
+            asyncio.run_coroutine_threadsafe(self.wheel.run(), self.loop)
+            logger.info("Monitor engine started")
+
+    def shutdown(self):
+        with self._start_lock:
+            if self.thread is None:
+                return
+            for mailbox_id in list(self.services):
+                self.stop_monitor(mailbox_id)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=5)
+            self.io_executor.shutdown(wait=False, cancel_futures=True)
+            if self.parse_executor is not None:
+                self.parse_executor.shutdown(wait=False, cancel_futures=True)
+            self.thread = None
+            logger.info("Monitor engine stopped")
+
+    def submit(self, coro):
+        """Schedule a coroutine on the engine loop from any other thread"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def is_running(self, mailbox_id: int) -> bool:
+        return mailbox_id in self.services
+
+    def start_monitor(self, mailbox_id: int, service: EmailService) -> bool:
+        """Run ``service``; False if the mailbox is already monitored here"""
+        self.start()
+
+        async def spawn():
+            task = self.tasks.get(mailbox_id)
+            if mailbox_id in self.services or (task is not None and not task.done()):
+                return False
+            service.parse_executor = self.parse_executor
+            service.monitoring = True
+            self.services[mailbox_id] = service
+            if service.monitor_mode == "idle":
+                self._spawn(mailbox_id, self._monitor_idle(mailbox_id, service))
+            else:
+                # Spread first polls so a restart does not hit every server at once
+                self._schedule_poll(
+                    mailbox_id, service, random.uniform(0, POLL_INTERVAL)
+                )
+            return True
+
+        return asyncio.run_coroutine_threadsafe(spawn(), self.loop).result()
+
+    def stop_monitor(self, mailbox_id: int, timeout: float = 5):
+        if mailbox_id not in self.services:
+            return
+
+        async def cancel():
+            self.wheel.cancel(mailbox_id)
+            self.intervals.pop(mailbox_id, None)
+            service = self.services.pop(mailbox_id, None)
+            if service is not None:
+                service.monitoring = False
+            task = self.tasks.get(mailbox_id)
+            if task is not None:
+                task.cancel()
+                await asyncio.wait([task], timeout=timeout)
+            logger.info(f"Stopped monitoring mailbox {mailbox_id}")
+
+        asyncio.run_coroutine_threadsafe(cancel(), self.loop).result()
+
+    def _spawn(self, mailbox_id: int, coro):
+        task = asyncio.create_task(coro)
+        self.tasks[mailbox_id] = task
+
+        def forget(_):
+            if self.tasks.get(mailbox_id) is task:
+                del self.tasks[mailbox_id]
+
+        task.add_done_callback(forget)
+
+    def _schedule_poll(self, mailbox_id: int, service: EmailService, delay: float):
+        if self.services.get(mailbox_id) is not service:
+            return
+        self.wheel.schedule(
+            mailbox_id,
+            jittered(delay),
+            lambda: self._spawn(mailbox_id, self._poll(mailbox_id, service)),
+        )
+
+    async def _io(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.io_executor, func, *args
+        )
+
+    async def _poll(self, mailbox_id: int, service: EmailService):
+        """One scheduled poll; the next is timed by the mailbox's arrival rate"""
+        interval = self.intervals.get(mailbox_id)
+        if interval is None:
+            interval = self.intervals[mailbox_id] = AdaptiveInterval(POLL_INTERVAL)
+        try:
+            new_messages = await self._io(service.poll_once)
+            delay = interval.observe(new_messages)
+        except IMAPBackoff as e:
+            logger.warning(str(e))
+            delay = e.retry_in
+        except Exception as e:
+            logger.error(f"Monitoring error for {service.username}: {str(e)}")
+            delay = ERROR_RETRY_DELAY
+        self._schedule_poll(mailbox_id, service, delay)
+
+    async def _monitor_idle(self, mailbox_id: int, service: EmailService):
+        logger.info(f"Started monitoring for {service.username}")
+        while service.monitor_mode == "idle":
+            try:
+                await self._idle_loop(service)
+            except IMAPBackoff as e:
+                logger.warning(str(e))
+                await asyncio.sleep(e.retry_in)
+            except Exception as e:
+                logger.error(f"Monitoring error for {service.username}: {str(e)}")
+                await asyncio.sleep(ERROR_RETRY_DELAY)
+        # No IDLE support: continue on the shared poll schedule
+        self._schedule_poll(mailbox_id, service, POLL_INTERVAL)
+
+    async def _idle_loop(self, service: EmailService):
+        if not await self._io(self._supports_idle, service):
+            logger.info(
+                f"IMAP server for {service.username} lacks IDLE, falling back to polling"
+            )
+            service.monitor_mode = "poll"
+            return
+
+        await self._io(service.poll_once)
+        while True:
+            has_new = await self._idle_once(service)
+            if has_new:
+                await self._io(service.fetch_emails, "INBOX")
+            if service.sent_sync_due():
+                await self._io(service.fetch_emails, SENT_FOLDER)
+
+    def _supports_idle(self, service: EmailService) -> bool:
+        with service.imap_session() as mail:
+            return imap_client.supports_idle(mail)
+
+    async def _idle_once(self, service: EmailService) -> bool:
+        """One IDLE round on INBOX that parks on the loop instead of a thread"""
+        acquiring = self.io_executor.submit(
+            imap_pool.acquire,
+            service.host,
+            service.port,
+            service.username,
+            service.password,
+        )
+        try:
+            pooled, mail = await asyncio.wrap_future(acquiring)
+        except asyncio.CancelledError:
+            # The IO thread may still check the session out; hand it back then
+            acquiring.add_done_callback(_release_abandoned)
+            raise
+        broken = True
+        try:
+            await self._io(imap_client.select_folder, mail, "INBOX", True)
+            tag = await self._io(imap_client.idle_start, mail)
+            # End the round in time for the next Sent sync, which only runs
+            # between rounds
+            timeout = min(IDLE_TIMEOUT, max(1.0, service.sent_sync_in()))
+            has_new = await self._wait_for_push(mail, timeout)
+            has_new = await self._io(imap_client.idle_done, mail, tag) or has_new
+            broken = False
+            return has_new
+        finally:
+            # A cancelled or failed IDLE leaves the session mid-command. The
+            # release logs out broken sessions, so it runs on an IO thread,
+            # and it completes even if this task is cancelled again.
+            releasing = self.io_executor.submit(imap_pool.release, pooled, broken)
+            await asyncio.shield(asyncio.wrap_future(releasing))
+
+    async def _wait_for_push(self, mail, timeout: float) -> bool:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0 or not await self._readable(mail, remaining):
+                return False
+            if await self._io(imap_client.idle_read_event, mail):
+                return True
+
+    async def _readable(self, mail, timeout: float) -> bool:
+        sock = mail.socket()
+        pending = getattr(sock, "pending", None)
+        if pending and pending() > 0:
+            return True
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = sock.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(True))
+        try:
+            await asyncio.wait_for(ready, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(fd)
+
+
+engine = MonitorEngine()
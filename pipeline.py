@@ -0,0 +1,425 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List
+
+import email_threads
+import config_cache
+import job_queue
+import send_quota
+import smtp_sender as smtp
+import triage
+from categorizer import EmailCategorizer
+from db_sync import SyncSessionLocal
+from models import (
+    AIResponse,
+    Email,
+    EmailJob,
+    JobStatus,
+    MailboxConfig,
+    ResponseStatus,
+    SentEmail,
+)
+from routers.ai_service import ai_reponse
+from smtp_sender import smtp_sender
+
+logger = logging.getLogger(__name__)
+
+# Worker threads per stage; LLM-bound stages get more since they mostly wait
+STAGE_WORKERS = {
+    job_queue.CATEGORIZE: int(os.getenv("JOB_WORKERS_CATEGORIZE", 4)),
+    job_queue.DRAFT: int(os.getenv("JOB_WORKERS_DRAFT", 4)),
+    job_queue.SEND: int(os.getenv("JOB_WORKERS_SEND", 2)),
+}
+JOB_BATCH_SIZE = int(os.getenv("JOB_BATCH_SIZE", 10))
+# How long an idle worker waits before polling the queue again
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 2))
+STAGE_BATCH_SIZES = {
+    # Claimed together so they can share batched LLM requests
+    job_queue.CATEGORIZE: int(os.getenv("JOB_BATCH_SIZE_CATEGORIZE", 20)),
+}
+# Delivery attempts before a queued reply is marked failed
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", 8))
+
+_categorizer = None
+_categorizer_lock = threading.Lock()
+
+# Default ``prepared`` of handlers, as None is a valid prepared result
+NOT_PREPARED = object()
+
+
+def get_categorizer() -> EmailCategorizer:
+    global _categorizer
+    with _categorizer_lock:
+        if _categorizer is None:
+            _categorizer = EmailCategorizer()
+        return _categorizer
+
+
+def prepare_categorize(job_ids: List[int]) -> Dict[int, object]:
+    """
+    Categorize the emails of claimed jobs with one batched request per user
+    and return {job_id: category_id or None}. Jobs of a user whose request
+    failed map to the exception, so they are retried instead of each being
+    sent to the LLM on its own.
+    """
+    with SyncSessionLocal() as session:
+        rows = (
+            session.query(EmailJob.id, EmailJob.user_id, Email)
+            .join(Email, Email.id == EmailJob.email_id)
+            # Triaged mail is filed by its headers, see handle_categorize
+            .filter(EmailJob.id.in_(job_ids), Email.triage.is_(None))
+            .all()
+        )
+        by_user: Dict[int, list] = {}
+        for job_id, user_id, email in rows:
+            by_user.setdefault(user_id, []).append((job_id, email))
+
+        prepared = {}
+        for user_id, jobs in by_user.items():
+            categories = config_cache.get(user_id).categories
+            try:
+                labels = get_categorizer().categorize_batch(
+                    [
+                        {
+                            "subject": email.subject,
+                            "body": email.clean_body or email.body,
+                            "sender": email.from_email,
+                            "email_id": email.id,
+                        }
+                        for _, email in jobs
+                    ],
+                    user_id,
+                    categories,
+                )
+            except Exception as e:
+                labels = [e] * len(jobs)
+            for (job_id, _), category_id in zip(jobs, labels):
+                prepared[job_id] = category_id
+        return prepared
+
+
+def handle_categorize(session, job: EmailJob, prepared=NOT_PREPARED):
+    email = session.get(Email, job.email_id)
+    if email is None:
+        return
+    config = config_cache.get(job.user_id)
+    if email.triage is not None:
+        # Lists, bulk mail and autoresponders never reach the LLM
+        email.category_id = triage.hinted_category(email.triage, config.categories)
+        logger.info(f"Filed {email.triage} email {email.id} without drafting")
+        return
+    if isinstance(prepared, Exception):
+        raise prepared
+    if prepared is not NOT_PREPARED:
+        # None when even the single retries gave no valid label
+        email.category_id = prepared
+    else:
+        email.category_id = get_categorizer().categorize_email(
+            email.subject,
+            email.clean_body or email.body,
+            email.from_email,
+            job.user_id,
+            config.categories,
+            email_id=email.id,
+        )
+    logger.info(f"Categorized email {email.id} with subject '{email.subject}'")
+
+    if not (job.payload or {}).get("auto_reply", True):
+        # Backfilled history is categorized but never answered
+        return
+    mailbox = config.mailboxes.get(job.mailbox_config_id)
+    if mailbox is not None and mailbox.auto_reply_enabled:
+        job_queue.enqueue(
+            session,
+            job_queue.DRAFT,
+            job.user_id,
+            email_id=email.id,
+            mailbox_config_id=mailbox.id,
+        )
+
+
+def handle_draft(session, job: EmailJob):
+    email = session.get(Email, job.email_id)
+    mailbox = config_cache.get(job.user_id).mailboxes.get(job.mailbox_config_id)
+    if email is None or mailbox is None or email.triage is not None:
+        return
+    started = time.monotonic()
+    ai_res = ai_reponse(
+        job.user_id,
+        "",
+        mailbox.email,
+        email.subject,
+        email.clean_body or email.body,
+    )
+    if not ai_res or not ai_res.get("email_body"):
+        raise ValueError(f"Empty draft for email {email.id}")
+
+    draft = AIResponse(
+        email_id=email.id,
+        suggestion=ai_res["email_body"],
+        confidence=ai_res["confidence_score"],
+        processing_time_ms=int((time.monotonic() - started) * 1000),
+        status=ResponseStatus.GENERATED,
+    )
+    session.add(draft)
+    session.flush()
+    logger.info(
+        f"Drafted reply {draft.id} for email {email.id} "
+        f"with confidence {ai_res['confidence_score']}"
+    )
+
+    if ai_res["confidence_score"] >= mailbox.confidence_threshold:
+        sent = new_reply(
+            email,
+            mailbox,
+            to_email=email.from_email,
+            subject=ai_res.get("subject") or f"Re: {email.subject}",
+            body=draft.suggestion,
+        )
+        session.add(sent)
+        session.flush()
+        enqueue_delivery(session, sent, ai_response_id=draft.id)
+
+
+def new_reply(
+    email: Email, mailbox, to_email: str, subject: str, body: str
+) -> SentEmail:
+    """
+    A queued reply to ``email`` from ``mailbox``, a MailboxConfig or its
+    config_cache.MailboxInfo. Its Message-ID is fixed here so every
+    delivery attempt and the later Sent folder sync agree on it.
+    """
+    # Rows stored before message_id existed kept it in thread_id
+    original_message_id = email.message_id or email.thread_id
+    references = " ".join(
+        email_threads.parse_references(email.references, original_message_id)
+    )
+    return SentEmail(
+        user_id=email.user_id,
+        original_email_id=email.id,
+        mailbox_config_id=mailbox.id,
+        message_id=smtp.new_message_id(mailbox.email),
+        in_reply_to=original_message_id,
+        references=references or None,
+        subject=subject,
+        sent_at=None,
+        status="queued",
+        recipients=[to_email],
+        delivery_status="pending",
+        content=body,
+        html_content=body,
+    )
+
+
+def enqueue_delivery(session, sent: SentEmail, ai_response_id: int = None):
+    """Queue a flushed SentEmail for the send stage"""
+    payload = {"sent_email_id": sent.id}
+    if ai_response_id is not None:
+        payload["ai_response_id"] = ai_response_id
+    job_queue.enqueue(
+        session,
+        job_queue.SEND,
+        sent.user_id,
+        email_id=sent.original_email_id,
+        mailbox_config_id=sent.mailbox_config_id,
+        payload=payload,
+        max_attempts=SEND_MAX_ATTEMPTS,
+    )
+
+
+def handle_send(session, job: EmailJob):
+    sent = session.get(SentEmail, job.payload["sent_email_id"])
+    if sent is None or sent.status == "sent":
+        # Delivered by an earlier attempt that died before completing the job
+        return
+    mailbox = session.get(MailboxConfig, sent.mailbox_config_id)
+    if mailbox is None:
+        raise job_queue.PermanentError("Mailbox config was removed")
+    wait = send_quota.acquire(mailbox.id)
+    if wait:
+        raise job_queue.Deferred(wait, f"Send budget of {mailbox.email} exhausted")
+
+    msg = smtp.build_reply(
+        mailbox.email,
+        sent.recipients[0],
+        sent.subject,
+        sent.content,
+        in_reply_to=sent.in_reply_to,
+        references=sent.references,
+        message_id=sent.message_id,
+        # Drafted replies are marked so other autoresponders stay quiet
+        auto_submitted="ai_response_id" in job.payload,
+    )
+    try:
+        smtp_sender.send(mailbox.email, mailbox.app_password, msg)
+    except Exception as e:
+        if smtp.is_permanent(e):
+            raise job_queue.PermanentError(str(e)) from e
+        raise
+    logger.info(f"Delivered reply {sent.id} to {sent.recipients[0]}")
+
+    sent.status = "sent"
+    sent.delivery_status = "success"
+    sent.sent_at = datetime.utcnow()
+    sent.last_error = None
+    draft_id = job.payload.get("ai_response_id")
+    draft = session.get(AIResponse, draft_id) if draft_id else None
+    if draft is not None:
+        draft.status = ResponseStatus.SENT
+    # Recorded before the job completes so a retry never sends twice
+    session.commit()
+
+
+def on_send_failure(job_id: int, error: str, dead: bool):
+    """Reflect a failed delivery attempt on the queued SentEmail"""
+    with SyncSessionLocal() as session:
+        job = session.get(EmailJob, job_id)
+        sent = job and session.get(SentEmail, (job.payload or {}).get("sent_email_id"))
+        if sent is None or sent.status == "sent":
+            return
+        sent.last_error = error
+        if dead:
+            sent.status = "failed"
+            sent.delivery_status = "failed"
+        else:
+            sent.delivery_status = "retrying"
+        session.commit()
+
+
+HANDLERS: Dict[str, Callable] = {
+    job_queue.CATEGORIZE: handle_categorize,
+    job_queue.DRAFT: handle_draft,
+    job_queue.SEND: handle_send,
+}
+
+# Called with the claimed job ids before a batch runs; the returned
+# {job_id: value} is handed to the handler as ``prepared``
+PREPARE_HOOKS: Dict[str, Callable] = {
+    job_queue.CATEGORIZE: prepare_categorize,
+}
+
+# Called with (job_id, error, dead) after a failed attempt was recorded
+FAILURE_HOOKS: Dict[str, Callable] = {
+    job_queue.SEND: on_send_failure,
+}
+
+
+class StageWorkerPool:
+    """
+    Threads that claim jobs of one stage and run its handler. A handler's
+    writes, the jobs it enqueues and the job's completion commit together;
+    any exception rolls them back and schedules a retry.
+    """
+
+    def __init__(
+        self,
+        stage: str,
+        handler: Callable,
+        workers: int,
+        batch_size: int = JOB_BATCH_SIZE,
+        on_failure: Callable = None,
+        prepare: Callable = None,
+    ):
+        self.stage = stage
+        self.handler = handler
+        self.on_failure = on_failure
+        self.prepare = prepare
+        self.workers = workers
+        self.batch_size = batch_size
+        self.stop_event = threading.Event()
+        self.threads: List[threading.Thread] = []
+
+    def start(self):
+        self.stop_event.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self.worker_loop, name=f"job-{self.stage}-{i}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+        logger.info(f"Started {self.workers} {self.stage} workers")
+
+    def stop(self, timeout: float = 5):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout=timeout)
+        self.threads = []
+
+    def worker_loop(self):
+        while not self.stop_event.is_set():
+            try:
+                job_ids = job_queue.claim(self.stage, self.batch_size)
+            except Exception as e:
+                logger.error(f"Failed to claim {self.stage} jobs: {str(e)}")
+                job_ids = []
+            prepared = {}
+            if self.prepare is not None and len(job_ids) > 1:
+                try:
+                    prepared = self.prepare(job_ids)
+                except Exception as e:
+                    # Each job then does its own work
+                    logger.error(f"Failed to prepare {self.stage} batch: {str(e)}")
+            for job_id in job_ids:
+                if self.stop_event.is_set():
+                    # Unstarted jobs become claimable again after the timeout
+                    break
+                self.run_job(job_id, prepared.get(job_id, NOT_PREPARED))
+            if not job_ids:
+                self.stop_event.wait(JOB_POLL_INTERVAL)
+
+    def run_job(self, job_id: int, prepared=NOT_PREPARED):
+        try:
+            with SyncSessionLocal() as session:
+                job = session.get(EmailJob, job_id)
+                if job is None or job.status != JobStatus.RUNNING:
+                    return
+                if job.attempts > job.max_attempts:
+                    # Reclaimed after crashing the worker on its last attempt
+                    job.status = JobStatus.DEAD
+                    session.commit()
+                    return
+                if prepared is NOT_PREPARED:
+                    self.handler(session, job)
+                else:
+                    self.handler(session, job, prepared=prepared)
+                job_queue.complete(session, job)
+                session.commit()
+        except job_queue.Deferred as e:
+            try:
+                job_queue.defer(job_id, e.delay, str(e))
+            except Exception as e:
+                logger.error(f"Failed to defer job {job_id}: {str(e)}")
+        except Exception as e:
+            logger.error(f"{self.stage} job {job_id} failed: {str(e)}")
+            try:
+                permanent = isinstance(e, job_queue.PermanentError)
+                dead = job_queue.fail(job_id, str(e), permanent=permanent)
+                if self.on_failure is not None:
+                    self.on_failure(job_id, str(e), dead)
+            except Exception as e:
+                logger.error(f"Failed to reschedule job {job_id}: {str(e)}")
+
+
+pools: Dict[str, StageWorkerPool] = {}
+
+
+def start_pipeline():
+    for stage, handler in HANDLERS.items():
+        if stage not in pools and STAGE_WORKERS[stage] > 0:
+            pools[stage] = StageWorkerPool(
+                stage,
+                handler,
+                STAGE_WORKERS[stage],
+                batch_size=STAGE_BATCH_SIZES.get(stage, JOB_BATCH_SIZE),
+                on_failure=FAILURE_HOOKS.get(stage),
+                prepare=PREPARE_HOOKS.get(stage),
+            )
+            pools[stage].start()
+
+
+def stop_pipeline():
+    for stage in list(pools):
+        pools.pop(stage).stop()
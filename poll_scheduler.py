@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import math
+import os
+import random
+import time
+from typing import Callable, Dict, Hashable, List
+
+logger = logging.getLogger(__name__)
+
+POLL_MIN_INTERVAL = float(os.getenv("EMAIL_POLL_MIN_INTERVAL", 10))
+POLL_MAX_INTERVAL = float(os.getenv("EMAIL_POLL_MAX_INTERVAL", 600))
+# Fraction by which each delay is randomly stretched or shortened
+POLL_JITTER = float(os.getenv("EMAIL_POLL_JITTER", 0.1))
+WHEEL_TICK = float(os.getenv("SCHEDULER_TICK", 1))
+WHEEL_SLOTS = 512
+
+
+def jittered(delay: float, jitter: float = POLL_JITTER) -> float:
+    return delay * random.uniform(1 - jitter, 1 + jitter)
+
+
+class AdaptiveInterval:
+    """
+    Picks a mailbox's next poll delay from an EWMA of its arrival rate, aiming
+    for about one new message per poll. Busy mailboxes converge on the minimum;
+    each empty poll stretches a dormant one's delay until the maximum.
+    """
+
+    def __init__(
+        self,
+        initial: float,
+        minimum: float = POLL_MIN_INTERVAL,
+        maximum: float = POLL_MAX_INTERVAL,
+        alpha: float = 0.3,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.alpha = alpha
+        self.rate = 1 / initial
+        self.last_observed = time.monotonic()
+
+    def observe(self, new_messages: int) -> float:
+        """Record the result of a poll and return the delay until the next one"""
+        now = time.monotonic()
+        elapsed = max(now - self.last_observed, 1e-3)
+        self.last_observed = now
+        sample = new_messages / elapsed
+        self.rate = self.alpha * sample + (1 - self.alpha) * self.rate
+        return self.interval()
+
+    def interval(self) -> float:
+        if self.rate <= 0:
+            return self.maximum
+        return min(self.maximum, max(self.minimum, 1 / self.rate))
+
+
+class TimingWheel:
+    """
+    Hashed timing wheel for many recurring timers on one event loop. Adding,
+    rescheduling and cancelling a key are O(1) and each tick only touches one
+    slot, so thousands of mailboxes cost a single timer. Not thread-safe: use
+    it from the loop it runs on.
+    """
+
+    def __init__(self, tick: float = WHEEL_TICK, slots: int = WHEEL_SLOTS):
+        self.tick = tick
+        self.slots: List[Dict[Hashable, list]] = [{} for _ in range(slots)]
+        self.position = 0
+        self.entries: Dict[Hashable, int] = {}
+
+    def __contains__(self, key) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def schedule(self, key, delay: float, callback: Callable[[], None]):
+        """Run ``callback`` after ``delay`` seconds, replacing any timer of ``key``"""
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self.position + ticks) % len(self.slots)
+        rounds = (ticks - 1) // len(self.slots)
+        self.slots[slot][key] = [rounds, callback]
+        self.entries[key] = slot
+
+    def cancel(self, key) -> bool:
+        slot = self.entries.pop(key, None)
+        if slot is None:
+            return False
+        self.slots[slot].pop(key, None)
+        return True
+
+    def advance(self):
+        self.position = (self.position + 1) % len(self.slots)
+        bucket = self.slots[self.position]
+        due = []
+        for key, entry in list(bucket.items()):
+            if entry[0] > 0:
+                entry[0] -= 1
+            else:
+                del bucket[key]
+                del self.entries[key]
+                due.append(entry[1])
+        for callback in due:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Scheduled callback failed: {str(e)}")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += self.tick
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            self.advance()
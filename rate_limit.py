@@ -0,0 +1,45 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. ``rate`` tokens are added per second up to
+    ``capacity``. A request larger than the capacity is let through once the
+    bucket is full and leaves it in debt, so big items are never starved.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """Take ``tokens`` if available; otherwise return seconds to wait"""
+        with self._lock:
+            self._refill()
+            needed = min(tokens, self.capacity)
+            if self.tokens >= needed:
+                self.tokens -= tokens
+                return 0.0
+            return (needed - self.tokens) / self.rate
+
+    def acquire(self, tokens: float = 1, stop_event: threading.Event = None) -> bool:
+        """Block until ``tokens`` are taken; False if ``stop_event`` fired first"""
+        if self.rate <= 0:
+            return True
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return True
+            if stop_event is None:
+                time.sleep(wait)
+            elif stop_event.wait(wait):
+                return False
@@ -1,7 +1,7 @@
 from typing import Optional
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
-from .ai_service import ai_reponse
+from .ai_service import ai_reponse_async
 import schemas
 import crud
 import models
@@ -32,8 +32,12 @@ async def generate_ai_response(
         print(f"Generating AI response for email ID: {request.email_id}")
         print(f"Email Subject: {email.subject}")
 
-        ai_res = ai_reponse(
-            current_user.id, "user", current_user.email, email.subject, email.body
+        ai_res = await ai_reponse_async(
+            current_user.id,
+            "user",
+            current_user.email,
+            email.subject,
+            email.clean_body or email.body,
         )
 
     except HTTPException:
@@ -1,10 +1,12 @@
+import asyncio
 import os
 import logging
 from typing import Dict, List, Any, TypedDict
 from dataclasses import dataclass
 import json
+import threading
 
-from langchain_groq import ChatGroq
+from llm_client import LLMClient, get_llm
 from langchain.schema import HumanMessage
 from qdrant_client import QdrantClient
 from qdrant_client.models import Filter, FieldCondition, MatchValue
@@ -22,13 +24,26 @@ from typing import Optional
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-GROQ_API_KEY = os.getenv(
-    "GROQ_API_KEY", "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"
-)
-GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile")
 QDRANT_HOST = os.getenv("QDRANT_HOST", "192.168.0.242")
 QDRANT_PORT = int(os.getenv("QDRANT_PORT", 6334))
 COLLECTION_NAME = os.getenv("QDRANT_COLLECTION_NAME", "Crail_data")
+SENTENCE_TRANSFORMER_MODEL = os.getenv(
+    "SENTENCE_TRANSFORMER_MODEL", "all-MiniLM-L6-v2"
+)
+
+_encoder = None
+_encoder_lock = threading.Lock()
+_flow = None
+_flow_lock = threading.Lock()
+
+
+def get_encoder() -> SentenceTransformer:
+    """The sentence encoder, loaded once per process and shared"""
+    global _encoder
+    with _encoder_lock:
+        if _encoder is None:
+            _encoder = SentenceTransformer(SENTENCE_TRANSFORMER_MODEL)
+        return _encoder
 
 
 @dataclass
@@ -53,20 +68,27 @@ class EmailResponseState(TypedDict):
 
 
 class EmailResponseFlow:
-    """Main class for handling email response generation flow"""
+    """
+    Main class for handling email response generation flow. Steps keep
+    their data in the graph state, never on the instance, so one flow
+    serves concurrent requests; use get_flow() for the shared one.
+    """
 
     def __init__(self):
         """Initialize the email response flow components"""
         self.llm = self._init_llm()
         self.qdrant_client = self._init_qdrant()
-        self.encoder = SentenceTransformer("all-MiniLM-L6-v2")
-        self.graph = self._build_graph()
-
-    def _init_llm(self) -> ChatGroq:
-        """Initialize ChatGroq LLM"""
-        return ChatGroq(
-            model=GROQ_MODEL,
-            api_key=GROQ_API_KEY,
+        self.encoder = get_encoder()
+        self.graph = self._build_graph(self._blocking_node)
+        self.async_graph = self._build_graph(self._async_node)
+
+    def warm_up(self):
+        """Run the encoder once so the first request does not pay for it"""
+        self.encoder.encode("warm up")
+
+    def _init_llm(self) -> LLMClient:
+        """Get the shared, rate-limited ChatGroq client"""
+        return get_llm(
             temperature=0.5,
             max_tokens=5000,
             top_p=0.95,
@@ -85,15 +107,56 @@ class EmailResponseFlow:
             logger.error(f"Failed to connect to Qdrant: {e}")
             raise
 
-    def _build_graph(self) -> StateGraph:
-        """Build the LangGraph workflow"""
+    def _blocking_node(self, step):
+        """A node driving ``step`` with LLM calls that block the thread"""
+
+        def node(state):
+            steps = step(state)
+            try:
+                messages = next(steps)
+                while True:
+                    try:
+                        response = self.llm.invoke(messages)
+                    except Exception as e:
+                        messages = steps.throw(e)
+                    else:
+                        messages = steps.send(response)
+            except StopIteration as done:
+                return done.value
+
+        return node
+
+    def _async_node(self, step):
+        """A node driving ``step`` with LLM calls awaited on the event loop"""
+
+        async def node(state):
+            steps = step(state)
+            try:
+                messages = next(steps)
+                while True:
+                    try:
+                        response = await self.llm.ainvoke(messages)
+                    except Exception as e:
+                        messages = steps.throw(e)
+                    else:
+                        messages = steps.send(response)
+            except StopIteration as done:
+                return done.value
+
+        return node
+
+    def _build_graph(self, llm_node) -> StateGraph:
+        """
+        Build the LangGraph workflow. The LLM steps are generators that yield
+        their messages and get the answer back; ``llm_node`` runs them.
+        """
         graph = StateGraph(EmailResponseState)
 
         # Add nodes
-        graph.add_node("summarize_email", self.summarize_email_intent)
+        graph.add_node("summarize_email", llm_node(self.summarize_email_intent))
         graph.add_node("search_qdrant", self.search_knowledge_base)
-        graph.add_node("generate_response", self.generate_email_response)
-        graph.add_node("validate_response", self.validate_email_response)
+        graph.add_node("generate_response", llm_node(self.generate_email_response))
+        graph.add_node("validate_response", llm_node(self.validate_email_response))
 
         # Define edges
         graph.set_entry_point("summarize_email")
@@ -119,7 +182,7 @@ class EmailResponseFlow:
             Please provide only the summary of the main intent, without any additional commentary.
             """
 
-            response = self.llm.invoke([HumanMessage(content=prompt)])
+            response = yield [HumanMessage(content=prompt)]
             email_summary = response.content.strip()
 
             logger.info(f"Email summary: {email_summary}")
@@ -225,7 +288,7 @@ class EmailResponseFlow:
                         Only return valid JSON. Do not include any explanations or text outside the JSON.
                     """
 
-            response = self.llm.invoke([HumanMessage(content=prompt)])
+            response = yield [HumanMessage(content=prompt)]
             response_json = json.loads(response.content)
 
             logger.info("Structured email response generated successfully")
@@ -259,7 +322,7 @@ class EmailResponseFlow:
             Provide only a single number between 1 and 10 as your response.
             """
 
-            response = self.llm.invoke([HumanMessage(content=prompt)])
+            response = yield [HumanMessage(content=prompt)]
 
             # Extract numeric score
             try:
@@ -287,7 +350,35 @@ class EmailResponseFlow:
         """Main method to process an email through the entire flow"""
         logger.info("Starting email response generation flow")
 
-        initial_state = EmailResponseState(
+        initial_state = self._initial_state(user_email, current_user)
+        try:
+            final_state = self.graph.invoke(initial_state)
+            logger.info("Email response flow completed successfully")
+            return final_state
+        except Exception as e:
+            logger.error(f"Error in email processing flow: {e}")
+            return {**initial_state, "error": f"Flow execution failed: {str(e)}"}
+
+    async def aprocess_email(
+        self, user_email: str, current_user: CurrentUser
+    ) -> EmailResponseState:
+        """process_email for coroutines; LLM calls do not hold a thread"""
+        logger.info("Starting email response generation flow")
+
+        initial_state = self._initial_state(user_email, current_user)
+        try:
+            final_state = await self.async_graph.ainvoke(initial_state)
+            logger.info("Email response flow completed successfully")
+            return final_state
+        except Exception as e:
+            logger.error(f"Error in email processing flow: {e}")
+            return {**initial_state, "error": f"Flow execution failed: {str(e)}"}
+
+    @staticmethod
+    def _initial_state(
+        user_email: str, current_user: CurrentUser
+    ) -> EmailResponseState:
+        return EmailResponseState(
             user_email=user_email,
             current_user=current_user,
             email_summary="",
@@ -297,18 +388,38 @@ class EmailResponseFlow:
             error="",
         )
 
-        try:
-            final_state = self.graph.invoke(initial_state)
-            logger.info("Email response flow completed successfully")
-            return final_state
-        except Exception as e:
-            logger.error(f"Error in email processing flow: {e}")
-            return {**initial_state, "error": f"Flow execution failed: {str(e)}"}
+
+def get_flow() -> EmailResponseFlow:
+    """The process-wide, warmed-up flow, built on first use"""
+    global _flow
+    with _flow_lock:
+        if _flow is None:
+            flow = EmailResponseFlow()
+            flow.warm_up()
+            _flow = flow
+            logger.info("Email response flow ready")
+        return _flow
+
+
+def warm_up():
+    """Build the shared flow before the first email; failures retry on use"""
+    try:
+        get_flow()
+    except Exception as e:
+        logger.error(f"Could not prepare the email response flow: {e}")
+
+
+def _reply_fields(result: EmailResponseState) -> dict:
+    return {
+        "subject": result["response_email"]["response_email_subject"],
+        "email_body": result["response_email"]["response_email_body"],
+        "confidence_score": result["validation_score"],
+    }
 
 
 def ai_reponse(user_id, user_name, user_email, customer_subject, customer_email):
-    # Initialize the flow
-    email_flow = EmailResponseFlow()
+    # The shared flow
+    email_flow = get_flow()
 
     # Example user
     current_user = CurrentUser(
@@ -321,11 +432,7 @@ def ai_reponse(user_id, user_name, user_email, customer_subject, customer_email)
     result = email_flow.process_email(
         "Subject: " + customer_subject + customer_email, current_user
     )
-    return {
-        "subject": result["response_email"]["response_email_subject"],
-        "email_body": result["response_email"]["response_email_body"],
-        "confidence_score": result["validation_score"],
-    }
+    return _reply_fields(result)
 
     # Process the email
     # result = email_flow.process_email(user_email, current_user)
@@ -357,3 +464,15 @@ def ai_reponse(user_id, user_name, user_email, customer_subject, customer_email)
 
     # print(f"⭐ Validation Score: {result['validation_score']}/10")
     # print("=" * 60)
+
+
+async def ai_reponse_async(
+    user_id, user_name, user_email, customer_subject, customer_email
+):
+    """ai_reponse for async callers; only the knowledge base search uses a thread"""
+    email_flow = await asyncio.to_thread(get_flow)
+    current_user = CurrentUser(user_id=user_id, name=user_name, email=user_email)
+    result = await email_flow.aprocess_email(
+        "Subject: " + customer_subject + customer_email, current_user
+    )
+    return _reply_fields(result)
@@ -1,13 +1,13 @@
-from datetime import datetime
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import FileResponse
 from sqlalchemy import func, select
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
-from db_sync import SyncSessionLocal
-from email_service import EmailService
+import os
 import schemas
 import crud
 import models
+import pipeline
 from database import get_db
 from auth import get_current_user
 from sqlalchemy.orm import selectinload
@@ -48,6 +48,10 @@ async def get_inbox_emails(
 
     total_pages = (total_count + limit - 1) // limit  # Calculate total pages
 
+    replied = await crud.get_replied_email_ids(
+        db, [email.id for email in emails], current_user.id
+    )
+
     email_responses = []
     for email in emails:
         email_dict = {
@@ -67,7 +71,7 @@ async def get_inbox_emails(
             "labels": email.labels or [],
             "thread_id": email.thread_id,
             "ai_analysis": email.ai_analysis,
-            "replied": await crud.check_if_email_replied(db, email.id, current_user.id),
+            "replied": email.id in replied,
         }
         email_responses.append(email_dict)
 
@@ -109,7 +113,7 @@ async def get_sent_emails(
         sent_email_records = [
             email
             for email in sent_email_records
-            if search.lower() in email.subject.lower()
+            if search.lower() in (email.subject or "").lower()
             or search.lower() in (email.content or "")
         ]
 
@@ -169,6 +173,24 @@ async def get_email_details(
             }
         )
 
+    thread = []
+    if email.thread_id:
+        for message in await crud.get_thread_emails(
+            db, email.thread_id, current_user.id
+        ):
+            if message.id == email.id:
+                continue
+            thread.append(
+                {
+                    "id": message.id,
+                    "from": message.from_email,
+                    "from_name": message.from_name,
+                    "subject": message.subject,
+                    "timestamp": message.timestamp,
+                    "is_read": message.is_read,
+                }
+            )
+
     return schemas.StandardResponse(
         success=True,
         data={
@@ -186,13 +208,34 @@ async def get_email_details(
             "priority": email.priority,
             "category": email.category.name if email.category else None,
             "labels": email.labels or [],
-            "thread": [],  # Would implement thread retrieval
+            "thread": thread,
             "attachments": attachments,
             "replied": await crud.check_if_email_replied(db, email_id, current_user.id),
         },
     )
 
 
+@router.get("/{email_id}/attachments/{attachment_id}")
+async def download_attachment(
+    email_id: int,
+    attachment_id: int,
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    attachment = await crud.get_email_attachment(
+        db, email_id, attachment_id, current_user.id
+    )
+    if (
+        not attachment
+        or not attachment.file_path
+        or not os.path.exists(attachment.file_path)
+    ):
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    return FileResponse(
+        attachment.file_path, media_type=attachment.type, filename=attachment.name
+    )
+
+
 @router.patch("/{email_id}/read-status", response_model=schemas.StandardResponse)
 async def update_read_status(
     email_id: int,
@@ -261,48 +304,36 @@ async def send_reply(
     if not original_email or original_email.user_id != current_user.id:
         raise HTTPException(status_code=404, detail="Original email not found")
 
-    # Step 2: Get mailbox config (from synchronous DB session)
-    with SyncSessionLocal() as sync_db:
-        mailbox_config = (
-            sync_db.query(models.MailboxConfig)
-            .filter_by(user_id=current_user.id, email=original_email.to_email)
-            .first()
+    # Step 2: Get mailbox config
+    result = await db.execute(
+        select(models.MailboxConfig).where(
+            models.MailboxConfig.user_id == current_user.id,
+            models.MailboxConfig.email == original_email.to_email,
         )
-        if not mailbox_config:
-            raise HTTPException(status_code=404, detail="Mailbox config not found")
-
-    # Step 3: Send email
-    email_service = EmailService(mailbox_config)
-    message_id = email_service.send_reply_email(
+    )
+    mailbox_config = result.scalars().first()
+    if not mailbox_config:
+        raise HTTPException(status_code=404, detail="Mailbox config not found")
+
+    # Step 3: Queue the reply; the send stage delivers it with retries
+    new_sent_email = pipeline.new_reply(
+        original_email,
+        mailbox_config,
         to_email=reply_data.to if reply_data.to else original_email.from_email,
         subject=reply_data.subject,
-        body_text=reply_data.body,
-        in_reply_to=original_email.thread_id,
-        references=original_email.thread_id,
-    )
-
-    # Step 4: Save to SentEmail table
-    new_sent_email = models.SentEmail(
-        message_id=message_id,
-        original_email_id=original_email.id,
-        sent_at=datetime.utcnow(),
-        status="sent",
-        recipients=[reply_data.to],
-        delivery_status="success",
-        content=reply_data.body,
-        html_content=reply_data.body,
-        user_id=current_user.id,
+        body=reply_data.body,
     )
     db.add(new_sent_email)
+    await db.flush()
+    pipeline.enqueue_delivery(db, new_sent_email)
     await db.commit()
-    await db.refresh(new_sent_email)
 
     return schemas.StandardResponse(
         success=True,
         data={
             "sent_email_id": str(new_sent_email.id),
             "message_id": new_sent_email.message_id,
-            "sent_at": new_sent_email.sent_at.isoformat(),
+            "sent_at": None,
             "status": new_sent_email.status,
             "recipients": new_sent_email.recipients,
             "delivery_status": new_sent_email.delivery_status,
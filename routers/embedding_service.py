@@ -2,14 +2,14 @@ import json
 import uuid
 from qdrant_client import QdrantClient
 from qdrant_client.models import VectorParams, Distance, PointStruct
-from sentence_transformers import SentenceTransformer
 import os
 
+from .ai_service import get_encoder
+
 client = QdrantClient(
     os.getenv("QDRANT_CLIENT", "http://localhost"),
     port=int(os.getenv("QDRANT_PORT", 6334)),
 )
-model = SentenceTransformer(os.getenv("SENTENCE_TRANSFORMER_MODEL", "all-MiniLM-L6-v2"))
 collection_name = os.getenv("QDRANT_COLLECTION_NAME", "Crail_data")
 
 
@@ -41,7 +41,7 @@ def generate_and_save_embeddings(user_id, data_list):
         doc_id = str(uuid.uuid4())
         flattened = flatten_doc(data)
 
-        embedding = model.encode(flattened).tolist()
+        embedding = get_encoder().encode(flattened).tolist()
 
         point = PointStruct(
             id=doc_id,
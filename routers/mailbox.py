@@ -4,10 +4,11 @@ from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 import schemas
+import crud
+import config_cache
 import models
 from database import get_db
 from auth import get_current_user
-from .moniter import manager as monitor_manager
 
 router = APIRouter(prefix="/mailbox", tags=["Mailbox"])
 
@@ -41,6 +42,7 @@ async def configure_mailbox(
     )
 
     db.add(new_config)
+    await config_cache.notify_changed(db, current_user.id)
     await db.commit()
     await db.refresh(new_config)
 
@@ -125,6 +127,7 @@ async def get_mailbox_configuration(
         )
     )
     configs = result.scalars().all()
+    monitored = await crud.get_monitored_mailbox_ids(db, [c.id for c in configs])
 
     # if not configs:
     #     raise HTTPException(status_code=400, detail="No mailbox configurations found")
@@ -139,7 +142,7 @@ async def get_mailbox_configuration(
                 "auto_reply_emails": config.auto_reply_emails,
                 "confidence_threshold": config.confidence_threshold,
                 "enabled": config.enabled,
-                "monitoring_status": monitor_manager.is_monitoring(config.id),
+                "monitoring_status": config.id in monitored,
                 "auto_reply_enabled": config.auto_reply_enabled,
             }
             for config in configs
@@ -168,6 +171,7 @@ async def toggle_auto_reply_enabled(
         raise HTTPException(status_code=403, detail="Not authorized")
 
     mailbox.auto_reply_enabled = not mailbox.auto_reply_enabled
+    await config_cache.notify_changed(db, current_user.id)
     await db.commit()
     await db.refresh(mailbox)
 
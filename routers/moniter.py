@@ -1,13 +1,20 @@
-from fastapi import APIRouter, Depends, BackgroundTasks, HTTPException
+from fastapi import APIRouter, Depends, BackgroundTasks, HTTPException, Query
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from database import get_db
+from db_sync import SyncSessionLocal
 from models import MailboxConfig, User
 from email_service import EmailService
-from auth import get_current_user
-from threading import Thread
-from typing import Dict
+from auth import get_current_admin, get_current_user
+from imap_pool import imap_pool
+from monitor_engine import engine
+from typing import Dict, Optional
+import asyncio
+import backfill
+import crud
 import logging
+import mailbox_leases
+import threading
 
 router = APIRouter(prefix="/monitor", tags=["Email Monitor"])
 
@@ -15,40 +22,114 @@ logger = logging.getLogger(__name__)
 
 
 class EmailMonitorManager:
+    """
+    Coordinates mailbox monitoring across workers through Postgres leases.
+    Each worker claims its share of requested mailboxes, renews the leases on
+    every heartbeat and takes over leases of workers that stopped renewing.
+    The monitors themselves run on the local engine.
+    """
+
     def __init__(self):
-        self.active_monitors: Dict[int, Thread] = {}
+        self.engine = engine
         self.services: Dict[int, EmailService] = {}
+        self._lease_future = None
+        # Held by the request threads and the heartbeat while they start or
+        # stop monitors, so both never act on the same mailbox at once
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Join the worker group; called once per process at startup"""
+        self.engine.start()
+        if self._lease_future is None:
+            self._lease_future = self.engine.submit(self._lease_loop())
+
+    async def _lease_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.lease_tick)
+            except Exception as e:
+                logger.error(f"Lease heartbeat failed: {str(e)}")
+            await asyncio.sleep(mailbox_leases.HEARTBEAT_INTERVAL)
+
+    def lease_tick(self):
+        with self._lock:
+            self._lease_tick()
+
+    def _lease_tick(self):
+        owned = mailbox_leases.heartbeat()
+        for mailbox_id in list(self.services):
+            if mailbox_id not in owned:
+                # Stopped through the API or taken over after a missed heartbeat
+                self._stop_local(mailbox_id)
+
+        share = mailbox_leases.fair_share()
+        if len(owned) > share + 1:
+            # Shed the surplus so workers that joined later get their share
+            surplus = sorted(owned)[share:]
+            for mailbox_id in surplus:
+                self._stop_local(mailbox_id)
+            mailbox_leases.yield_leases(surplus)
+            owned -= set(surplus)
+        else:
+            owned |= mailbox_leases.claim_orphans(share - len(owned))
+
+        for mailbox_id in owned:
+            if not self.engine.is_running(mailbox_id):
+                self._start_local(mailbox_id)
 
     def is_monitoring(self, mailbox_id: int) -> bool:
-        return mailbox_id in self.active_monitors
+        return mailbox_leases.is_leased(mailbox_id)
 
-    def start_monitoring(self, mailbox: MailboxConfig, db: AsyncSession):
-        if self.is_monitoring(mailbox.id):
-            logger.info(f"Already monitoring mailbox {mailbox.email}")
-            return
+    def _start_local(self, mailbox_id: int, mailbox: MailboxConfig = None):
+        if mailbox is None:
+            with SyncSessionLocal() as session:
+                mailbox = session.get(MailboxConfig, mailbox_id)
+            if mailbox is None or not mailbox.enabled:
+                mailbox_leases.release(mailbox_id)
+                return
 
         service = EmailService(mailbox)
-        thread = Thread(target=service.start_monitoring, daemon=True)
-        self.services[mailbox.id] = service
-        self.active_monitors[mailbox.id] = thread
-
-        thread.start()
+        if not self.engine.start_monitor(mailbox_id, service):
+            return
+        self.services[mailbox_id] = service
         logger.info(f"Started monitoring for mailbox {mailbox.email}")
 
-    def stop_monitoring(self, mailbox_id: int):
-        if not self.is_monitoring(mailbox_id):
-            logger.warning(f"Monitor not running for mailbox ID {mailbox_id}")
-            return
+    def _stop_local(self, mailbox_id: int):
+        self.engine.stop_monitor(mailbox_id)
+        service = self.services.pop(mailbox_id, None)
+        if service is not None:
+            imap_pool.close(service.username)
+            logger.info(f"Stopped monitoring mailbox ID {mailbox_id}")
 
-        service = self.services[mailbox_id]
-        service.stop_monitoring()
-        thread = self.active_monitors[mailbox_id]
-        thread.join(timeout=5)
+    def start_monitoring(self, mailbox: MailboxConfig, db: AsyncSession):
+        mailbox_leases.request(mailbox.id)
+        if not mailbox_leases.claim(mailbox.id):
+            logger.info(f"Mailbox {mailbox.email} is monitored by another worker")
+            return
+        with self._lock:
+            if not self.engine.is_running(mailbox.id):
+                self._start_local(mailbox.id, mailbox)
 
-        del self.services[mailbox_id]
-        del self.active_monitors[mailbox_id]
+    def stop_monitoring(self, mailbox_id: int):
+        mailbox_leases.release(mailbox_id)
+        # The owning worker, if it is not this one, stops on its next heartbeat
+        with self._lock:
+            if mailbox_id in self.services:
+                self._stop_local(mailbox_id)
 
-        logger.info(f"Stopped monitoring mailbox ID {mailbox_id}")
+    def shutdown(self):
+        if self._lease_future is not None:
+            self._lease_future.cancel()
+            self._lease_future = None
+        with self._lock:
+            self.engine.shutdown()
+            imap_pool.close_all()
+            self.services.clear()
+        try:
+            mailbox_leases.retire()
+        except Exception as e:
+            logger.error(f"Failed to release monitor leases: {str(e)}")
 
 
 manager = EmailMonitorManager()
@@ -70,7 +151,7 @@ async def start_monitoring_mailbox(
         if not mailbox or not mailbox.enabled:
             raise HTTPException(status_code=404, detail="Mailbox not found or disabled")
 
-        if manager.is_monitoring(mailbox_id):
+        if mailbox_id in await crud.get_monitored_mailbox_ids(db, [mailbox_id]):
             return {"message": f"Already monitoring mailbox {mailbox_id}"}
 
         background_tasks.add_task(manager.start_monitoring, mailbox, db)
@@ -88,6 +169,8 @@ def stop_monitoring_mailbox(
     current_user: User = Depends(get_current_user),
 ):
     if not manager.is_monitoring(mailbox_id):
+        # Drop a pending request that no worker has picked up yet
+        mailbox_leases.release(mailbox_id)
         raise HTTPException(
             status_code=404, detail="Monitor not running for this mailbox"
         )
@@ -115,9 +198,10 @@ async def start_all_monitors(
             status_code=404, detail="No enabled mailboxes found for user"
         )
 
+    monitored = await crud.get_monitored_mailbox_ids(db, [m.id for m in mailboxes])
     started = 0
     for mailbox in mailboxes:
-        if not manager.is_monitoring(mailbox.id):
+        if mailbox.id not in monitored:
             background_tasks.add_task(manager.start_monitoring, mailbox, db)
             started += 1
 
@@ -137,12 +221,54 @@ async def stop_all_monitors(
     )
     mailboxes = result.scalars().all()
 
+    monitored = await crud.get_monitored_mailbox_ids(db, [m.id for m in mailboxes])
     stopped = 0
     for mailbox in mailboxes:
-        if manager.is_monitoring(mailbox.id):
-            manager.stop_monitoring(mailbox.id)
+        if mailbox.id in monitored:
+            await asyncio.to_thread(manager.stop_monitoring, mailbox.id)
             stopped += 1
 
     return {
         "message": f"Stopped monitoring {stopped} out of {len(mailboxes)} mailboxes"
     }
+
+
+@router.post("/backfill/{mailbox_id}")
+async def start_backfill(
+    mailbox_id: int,
+    categorize: str = Query("defer", pattern="^(defer|skip)$"),
+    workers: int = Query(backfill.BACKFILL_WORKERS, ge=1, le=10),
+    folder: Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_admin),
+):
+    mailbox = await db.get(MailboxConfig, mailbox_id)
+    if not mailbox:
+        raise HTTPException(status_code=404, detail="Mailbox not found")
+
+    if folder and folder not in backfill.FOLDERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Only {', '.join(backfill.FOLDERS)} can be backfilled",
+        )
+    options = {"categorize": categorize, "workers": workers}
+    if folder:
+        options["folders"] = (folder,)
+    if not backfill.start_background(mailbox_id, **options):
+        return {"message": f"Backfill already running for mailbox {mailbox_id}"}
+    return {"message": f"Started backfill of mailbox {mailbox_id}"}
+
+
+@router.get("/backfill/{mailbox_id}")
+async def get_backfill_status(
+    mailbox_id: int,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_admin),
+):
+    mailbox = await db.get(MailboxConfig, mailbox_id)
+    if not mailbox:
+        raise HTTPException(status_code=404, detail="Mailbox not found")
+    return {
+        "running": backfill.is_running(mailbox_id),
+        "state": mailbox.backfill_state or {},
+    }
@@ -0,0 +1,76 @@
+"""
+Per-mailbox token bucket for outbound mail, kept in Postgres so every worker
+and restart shares one budget. Bursts are capped by SEND_BURST, sustained
+throughput by SEND_RATE_PER_MINUTE and the total by SEND_DAILY_LIMIT, which
+should stay below the provider's own daily quota (500 for Gmail accounts).
+"""
+
+import logging
+import os
+from datetime import datetime, time, timedelta, timezone
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from db_sync import SyncSessionLocal
+from models import SendQuota
+
+logger = logging.getLogger(__name__)
+
+SEND_BURST = float(os.getenv("SEND_BURST", 10))
+SEND_RATE_PER_MINUTE = float(os.getenv("SEND_RATE_PER_MINUTE", 6))
+SEND_DAILY_LIMIT = int(os.getenv("SEND_DAILY_LIMIT", 400))
+
+
+def _take(quota: SendQuota, now: datetime) -> float:
+    today = now.date()
+    if quota.day != today:
+        quota.day = today
+        quota.sent_today = 0
+    if quota.sent_today >= SEND_DAILY_LIMIT:
+        midnight = datetime.combine(today + timedelta(days=1), time.min, timezone.utc)
+        return (midnight - now).total_seconds()
+
+    rate = SEND_RATE_PER_MINUTE / 60
+    elapsed = max((now - quota.refilled_at).total_seconds(), 0.0)
+    quota.tokens = min(SEND_BURST, quota.tokens + elapsed * rate)
+    quota.refilled_at = now
+    if quota.tokens < 1:
+        return (1 - quota.tokens) / rate
+    quota.tokens -= 1
+    quota.sent_today += 1
+    return 0.0
+
+
+def acquire(mailbox_config_id: int) -> float:
+    """
+    Take one send from the mailbox's budget; otherwise return the seconds
+    until one is available. Commits on its own, so a send that fails
+    afterwards still counts, as it may have reached the provider.
+    """
+    with SyncSessionLocal() as session:
+        # Database time only, so workers with skewed clocks share one bucket
+        now = session.execute(select(func.now())).scalar().astimezone(timezone.utc)
+        session.execute(
+            insert(SendQuota)
+            .values(
+                mailbox_config_id=mailbox_config_id,
+                tokens=SEND_BURST,
+                refilled_at=now,
+                day=now.date(),
+                sent_today=0,
+            )
+            .on_conflict_do_nothing(index_elements=["mailbox_config_id"])
+        )
+        quota = session.execute(
+            select(SendQuota)
+            .where(SendQuota.mailbox_config_id == mailbox_config_id)
+            .with_for_update()
+        ).scalar_one()
+        wait = _take(quota, now)
+        session.commit()
+    if wait:
+        logger.info(
+            f"Send budget of mailbox {mailbox_config_id} exhausted for {wait:.0f}s"
+        )
+    return wait
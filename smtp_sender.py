@@ -0,0 +1,211 @@
+import logging
+import os
+import smtplib
+import ssl
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 465))
+# Authenticated connections kept per account
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 2))
+# Connections idle for longer get a NOOP before reuse
+SMTP_NOOP_INTERVAL = int(os.getenv("SMTP_NOOP_INTERVAL", 30))
+# Servers drop idle sessions after a few minutes; close ours first
+SMTP_MAX_IDLE = int(os.getenv("SMTP_MAX_IDLE", 240))
+# Reconnect after this many messages to stay under per-session limits
+SMTP_MAX_MESSAGES = int(os.getenv("SMTP_MAX_MESSAGES", 100))
+
+# Reused connections failing like this are assumed stale, not the message
+STALE_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, ssl.SSLError)
+
+
+def is_permanent(error: Exception) -> bool:
+    """Whether retrying ``error`` cannot succeed, e.g. a rejected recipient"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        # The app password may be fixed before the retries run out
+        return False
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+def new_message_id(from_email: str) -> str:
+    return make_msgid(domain=from_email.rpartition("@")[2] or None)
+
+
+def build_reply(
+    from_email: str,
+    to_email: str,
+    subject: str,
+    body_text: str,
+    in_reply_to: str = None,
+    references: str = None,
+    message_id: str = None,
+    auto_submitted: bool = False,
+) -> MIMEMultipart:
+    msg = MIMEMultipart()
+    msg["From"] = from_email
+    msg["To"] = to_email
+    msg["Subject"] = subject
+    msg["Date"] = formatdate(localtime=True)
+    # Fixed when the reply is queued, so a retried send keeps its identity
+    msg["Message-ID"] = message_id or new_message_id(from_email)
+
+    if in_reply_to:
+        msg["In-Reply-To"] = in_reply_to
+    if references:
+        msg["References"] = references
+    if auto_submitted:
+        # RFC 3834, so the recipient's autoresponder does not answer back
+        msg["Auto-Submitted"] = "auto-replied"
+
+    msg.attach(MIMEText(body_text, "plain"))
+    return msg
+
+
+class PooledSMTP:
+    def __init__(self, server: smtplib.SMTP):
+        self.server = server
+        self.last_used = time.monotonic()
+        self.sent = 0
+
+    def healthy(self) -> bool:
+        idle_for = time.monotonic() - self.last_used
+        if idle_for >= SMTP_MAX_IDLE or self.sent >= SMTP_MAX_MESSAGES:
+            return False
+        if idle_for < SMTP_NOOP_INTERVAL:
+            return True
+        try:
+            return self.server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self):
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+
+
+class SMTPAccountPool:
+    """Up to SMTP_POOL_SIZE authenticated connections for one account"""
+
+    def __init__(self, username: str, password: str, ssl_context):
+        self.username = username
+        self.password = password
+        self.ssl_context = ssl_context
+        self.idle = deque()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(SMTP_POOL_SIZE)
+
+    def _open(self) -> PooledSMTP:
+        server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=self.ssl_context)
+        try:
+            server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        logger.info(f"Opened SMTP session for {self.username}")
+        return PooledSMTP(server)
+
+    def _checkout(self, fresh: bool):
+        while not fresh:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn = self.idle.pop()
+            if conn.healthy():
+                return conn, True
+            conn.close()
+        return self._open(), False
+
+    @contextmanager
+    def connection(self, fresh: bool = False):
+        """Yield (connection, reused); broken connections are not returned"""
+        self.slots.acquire()
+        try:
+            conn, reused = self._checkout(fresh)
+            try:
+                yield conn, reused
+            except BaseException:
+                conn.close()
+                raise
+            conn.last_used = time.monotonic()
+            with self.lock:
+                self.idle.append(conn)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = list(self.idle), deque()
+        for conn in idle:
+            conn.close()
+
+
+class SMTPSender:
+    """
+    Sends mail over pooled, logged-in SMTP connections per account, so a
+    reply costs one round of SMTP commands instead of a TLS handshake and
+    AUTH every time
+    """
+
+    def __init__(self):
+        self.ssl_context = ssl.create_default_context()
+        self._pools: Dict[str, SMTPAccountPool] = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, username: str, password: str) -> SMTPAccountPool:
+        with self._lock:
+            pool = self._pools.get(username)
+            if pool is None:
+                pool = SMTPAccountPool(username, password, self.ssl_context)
+                self._pools[username] = pool
+            elif pool.password != password:
+                # Sessions logged in with the old app password are retired
+                pool.password = password
+                pool.close()
+            return pool
+
+    def send(self, username: str, password: str, msg) -> str:
+        """Send ``msg`` as ``username`` and return its Message-ID"""
+        pool = self._pool(username, password)
+        fresh = False
+        while True:
+            reused = False
+            try:
+                with pool.connection(fresh) as (conn, reused):
+                    conn.server.send_message(msg)
+                    conn.sent += 1
+                return msg["Message-ID"]
+            except STALE_ERRORS as e:
+                if not reused or fresh:
+                    raise
+                logger.warning(
+                    f"Pooled SMTP session for {username} went stale, reconnecting: {str(e)}"
+                )
+                fresh = True
+
+    def close(self, username: str):
+        with self._lock:
+            pool = self._pools.pop(username, None)
+        if pool is not None:
+            pool.close()
+
+    def close_all(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.close()
+
+
+smtp_sender = SMTPSender()
@@ -0,0 +1,116 @@
+"""
+Reduces an email body to what its sender newly wrote before any LLM sees it:
+quoted replies, forwarded history, signatures and legal disclaimers are
+dropped and the rest is cut to a token budget. Runs once at ingestion; the
+result is stored as emails.clean_body.
+"""
+
+import math
+import os
+import re
+
+# Budget for the cleaned text, in approximate LLM tokens
+CLEAN_BODY_MAX_TOKENS = int(os.getenv("CLEAN_BODY_MAX_TOKENS", 1500))
+
+# Lines where the quoted history of a reply or forward starts
+_REPLY_HEADER_RES = [
+    re.compile(r"^\s*On\b.{0,300}\bwrote:\s*$", re.IGNORECASE | re.DOTALL),
+    re.compile(r"^\s*Am\b.{0,300}\bschrieb\b.{0,100}:\s*$", re.IGNORECASE | re.DOTALL),
+    re.compile(r"^\s*Le\b.{0,300}\ba écrit\s*:\s*$", re.IGNORECASE | re.DOTALL),
+    re.compile(r"^\s*-{2,}\s*(Original|Forwarded) Message\s*-{2,}", re.IGNORECASE),
+    re.compile(r"^\s*Begin forwarded message:", re.IGNORECASE),
+]
+# Outlook quotes history as a header block: "From: ..." then "Sent:"/"Date:"
+_HEADER_BLOCK_START_RE = re.compile(r"^\s*\*?From:\*?\s", re.IGNORECASE)
+_HEADER_BLOCK_NEXT_RE = re.compile(
+    r"^\s*\*?(Sent|Date|To|Subject|Cc):\*?\s", re.IGNORECASE
+)
+# A numeric date, a time, a year or an address, as attribution lines carry
+_ATTRIBUTION_HINT_RE = re.compile(
+    r"\b\d{1,2}[/.:-]\d{1,2}\b|\b(19|20)\d{2}\b|@|<[^<>\s]+>"
+)
+_OUTLOOK_RULE_RE = re.compile(r"^\s*_{10,}\s*$")
+# RFC 3676 "-- " delimiter and the usual mobile footers
+_SIGNATURE_RE = re.compile(r"^\s*--\s*$")
+_MOBILE_FOOTER_RE = re.compile(
+    r"^\s*(Sent from my \w+|Get Outlook for \w+|Sent from (Mail|Yahoo Mail) for)",
+    re.IGNORECASE,
+)
+_DISCLAIMER_RE = re.compile(
+    r"^\s*(CONFIDENTIALITY NOTICE|DISCLAIMER|This (e-?mail|message)\b.{0,80}"
+    r"\b(confidential|intended (solely |only )?for))",
+    re.IGNORECASE,
+)
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
+def _history_start(lines) -> int:
+    """Index of the first line of quoted history, or len(lines)
+
+    >>> _history_start(["Hi", "On 5 Jan 2026, Ann <a@b.c>", "wrote:", "> x"])
+    1
+    >>> _history_start(["Plan", "On Monday we deploy.", "On Tuesday we wrote:"])
+    2
+    """
+    for i, line in enumerate(lines):
+        # Clients wrap long "On ... wrote:" lines, so a line that looks like
+        # the start of one is also tried joined with the next
+        wrapped = (
+            i + 1 < len(lines)
+            and not line.rstrip().endswith(":")
+            and _ATTRIBUTION_HINT_RE.search(line)
+        )
+        for pattern in _REPLY_HEADER_RES:
+            if pattern.match(line) or (
+                wrapped and pattern.match(line + " " + lines[i + 1])
+            ):
+                return i
+        if _OUTLOOK_RULE_RE.match(line) and i + 1 < len(lines):
+            if _HEADER_BLOCK_START_RE.match(lines[i + 1]):
+                return i
+        if _HEADER_BLOCK_START_RE.match(line) and any(
+            _HEADER_BLOCK_NEXT_RE.match(next_line) for next_line in lines[i + 1 : i + 4]
+        ):
+            return i
+    return len(lines)
+
+
+def strip_quotes(text: str) -> str:
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    lines = lines[: _history_start(lines)]
+    return "\n".join(line for line in lines if not line.lstrip().startswith(">"))
+
+
+def strip_signature(text: str) -> str:
+    lines = text.split("\n")
+    for i, line in enumerate(lines):
+        if _SIGNATURE_RE.match(line) or _DISCLAIMER_RE.match(line):
+            lines = lines[:i]
+            break
+    return "\n".join(line for line in lines if not _MOBILE_FOOTER_RE.match(line))
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough LLM token count: words of up to four characters are one token"""
+    return sum(math.ceil(len(match.group()) / 4) for match in _TOKEN_RE.finditer(text))
+
+
+def truncate_tokens(text: str, max_tokens: int = CLEAN_BODY_MAX_TOKENS) -> str:
+    """Keep the start of ``text`` up to about ``max_tokens`` tokens"""
+    used = 0
+    for match in _TOKEN_RE.finditer(text):
+        used += math.ceil(len(match.group()) / 4)
+        if used > max_tokens:
+            return text[: match.start()].rstrip() + " [...]"
+    return text
+
+
+def clean_body(text: str, max_tokens: int = CLEAN_BODY_MAX_TOKENS) -> str:
+    """What the sender newly wrote, within ``max_tokens``"""
+    if not text:
+        return ""
+    cleaned = strip_signature(strip_quotes(text))
+    cleaned = _BLANK_LINES_RE.sub("\n\n", cleaned).strip()
+    # A bare forward has nothing new; its history is the content then
+    return truncate_tokens(cleaned or text.strip(), max_tokens)
@@ -0,0 +1,67 @@
+"""
+Cheap header checks for mail that must never be answered automatically:
+bounces, autoresponders (RFC 3834), mailing lists (RFC 2369/2919) and bulk
+mail. Such mail is categorized without the LLM and never drafted, which
+also keeps two autoresponders from answering each other forever.
+"""
+
+from email.utils import parseaddr
+from typing import Optional
+
+BOUNCE = "bounce"
+AUTO_GENERATED = "auto-generated"
+MAILING_LIST = "mailing-list"
+BULK = "bulk"
+
+# Name of the default category each kind is filed under, if the user has it
+CATEGORY_HINTS = {
+    BOUNCE: "Others",
+    AUTO_GENERATED: "Others",
+    MAILING_LIST: "Marketing",
+    BULK: "Marketing",
+}
+
+_DAEMON_SENDERS = ("mailer-daemon", "postmaster")
+_NOREPLY_SENDERS = ("noreply", "donotreply")
+
+
+def _header(message, name: str) -> str:
+    return str(message.get(name) or "").strip().lower()
+
+
+def classify(message) -> Optional[str]:
+    """
+    The kind of automated mail ``message`` is, or None for mail from a
+    person. ``message`` is anything with a header ``get``, e.g. ParsedEmail.
+    """
+    _, sender = parseaddr(str(message.get("From") or ""))
+    local_part = sender.rpartition("@")[0].lower()
+    if _header(message, "Return-Path") == "<>" or local_part in _DAEMON_SENDERS:
+        return BOUNCE
+
+    auto_submitted = _header(message, "Auto-Submitted")
+    if (
+        (auto_submitted and auto_submitted != "no")
+        or message.get("X-Autoreply")
+        or message.get("X-Autorespond")
+    ):
+        return AUTO_GENERATED
+
+    precedence = _header(message, "Precedence")
+    if precedence == "list" or message.get("List-Id"):
+        return MAILING_LIST
+    if precedence in ("bulk", "junk") or message.get("List-Unsubscribe"):
+        return BULK
+
+    if local_part.replace("-", "").replace("_", "") in _NOREPLY_SENDERS:
+        # Answers would bounce anyway
+        return AUTO_GENERATED
+    return None
+
+
+def hinted_category(kind: str, categories) -> Optional[int]:
+    name = CATEGORY_HINTS.get(kind, "").lower()
+    for category in categories:
+        if category.name.lower() == name:
+            return category.id
+    return None